@@ -1,118 +1,1042 @@
 """Run an analysis for 3 Counter Machine
 
 Usage:
-    analyze [options] (parity|bounds|interval) PATH
+    analyze [options] (parity|bounds|interval|zone|all)... PATH...
 
+Every PATH is a program file, a directory searched recursively for *.3cm
+files or a glob pattern. When several programs or analyses are given, the
+results are printed one after another in the order of paths and analyses,
+each preceded by a header line. The `all` analysis runs parity, bounds and
+interval analyses as one reduced product.
+
+The json, ndjson and csv formats are meant for other programs. They identify
+results by the path and the analysis and encode states in a stable way, with
+infinite bounds as the strings "inf" and "-inf". The json output is an array
+of results with their states, ndjson and csv have a record per program point.
 
 Options:
     --help          Show help message
+    --bitvector     Use the vectorized engine for finite domains
+    --scc           Solve strongly connected components one at a time
+    --jobs N        Number of worker processes, for a single program and
+                    analysis with --scc they solve independent components
+                    [default: 1]
+    --stats         Print fixed point statistics as JSON to stderr without
+                    using the cache
+    --no-cache      Do not use the cache of analysis results
+    --cache-dir DIR Directory of the cache of analysis results
+    --format FMT    Output format, text, json, ndjson or csv [default: text]
+    --output PATH   Write the results to a file instead of the standard
+                    output
+    --gzip          Compress the output, implied by a PATH ending with .gz
+
+Interval analysis options:
+    --widening-delay N  Updates of a loop head before widening [default: 0]
+    --thresholds        Widen to constants of the program before infinity
+    --narrowing N       Maximum number of narrowing iterations [default: 0]
+
+Product analysis options:
+    --no-reduction      Do not refine the components of `all` by each other
 """
 
 
-import functools
+from collections import defaultdict, deque
+import contextlib
+import csv
+import glob
+import importlib
+import io
+import itertools
+import json
+import os
 import sys
+import time
+import unittest
 
 from docopt import docopt
-from bounds import BoundsAnalysis
-from exercise04 import IntervalAnalysis
+from cfg import ControlFlowGraph
+from funcutils import (FixedPointNotReached, MAX_RECURSIONS, Lattice,
+                       Statistics, count_changes)
+from program import load
+from threecm import Instruction, Analysis, format_instruction, parse
+
+
+def join_states(states1, states2):
+    x1, y1, z1 = states1
+    x2, y2, z2 = states2
+    return x1.join(x2), y1.join(y2), z1.join(z2)
+
+
+def join_relational(state1, state2):
+    return state1.join(state2)
+
+
+def state_join(analysis):
+    """Join of the states of program points of an analysis.
+
+    :type analysis: Analysis
+    :rtype: (T, T) -> T
+    """
+    return join_relational if analysis.relational else join_states
 
-from funcutils import fixed_point, Lattice
-from exercise03 import ParityAnalysis
-from threecm import Inc, Dec, Zero, Stop, parse, Instruction, Analysis
 
+def initial_states(cfg, analysis):
+    """States of all program points before the analysis.
 
-def analyze(program, analysis):
+    :type cfg: ControlFlowGraph
+    :type analysis: Analysis
+    :rtype: dict[int, (Lattice, Lattice, Lattice)]
+    """
+    if analysis.relational:
+        bottom = analysis.bottom
+    else:
+        bottom = analysis.bottom, analysis.bottom, analysis.bottom
+    s_hat = {pc: bottom for pc in cfg.pcs}
+    if cfg.size:
+        s_hat[1] = state_join(analysis)(bottom, analysis.initial)
+    return s_hat
+
+
+def analyze(program, analysis, cfg=None, stats=None):
     """Perform program analysis.
 
+    The fixed point is computed by a worklist algorithm: only the successors
+    of program points whose abstract state has changed are recomputed.
+
     :type program: list[Instruction]
     :type analysis: Analysis
+    :param cfg: Control-flow graph of the program to reuse between analyses
+    :type cfg: ControlFlowGraph | None
+    :param stats: Statistics to collect, one iteration per worklist pass
+    :type stats: Statistics | None
     :rtype: dict[int, (Lattice, Lattice, Lattice)]
     """
+    if cfg is None:
+        cfg = ControlFlowGraph(program)
+    s_hat = solve(cfg, analysis, initial_states(cfg, analysis), cfg.pcs, stats)
+    return narrow(cfg, analysis, s_hat, stats)
 
-    def instruction(pc):
-        return program[pc - 1]
 
-    def var_function(f, v, states):
-        x, y, z = states
-        if v == 'x':
-            return f(x), y, z
-        elif v == 'y':
-            return x, f(y), z
-        elif v == 'z':
-            return x, y, f(z)
-        else:
-            raise ValueError('unknown variable: {}'.format(v))
+def solve(cfg, analysis, s_hat, pcs, stats=None, component=None):
+    """Iterate the transfer functions of a program until a fixed point.
 
-    def f_hat(s_hat):
-        """
+    Widening is applied only at loop heads of the control-flow graph, once
+    they have been updated `analysis.widening_delay` times. Equal states are
+    stored as a single shared tuple.
 
-        :type s_hat: dict[int, (Lattice, Lattice, Lattice)]
-        :rtype: dict[int, (Lattice, Lattice, Lattice)]
+    :type cfg: ControlFlowGraph
+    :type analysis: Analysis
+    :param s_hat: States to start from, updated in place
+    :type s_hat: dict[int, (Lattice, Lattice, Lattice)]
+    :param pcs: Program points whose successors have to be recomputed first
+    :type pcs: collections.Iterable[int]
+    :type stats: Statistics | None
+    :param component: Program points to iterate, edges leaving them are not
+        followed
+    :type component: collections.Sized[int] | None
+    :rtype: dict[int, (Lattice, Lattice, Lattice)]
+    """
+    edges = cfg.transfers(analysis)
+    size = cfg.size
+    if component is not None:
+        members = set(component)
+        edges = {pc: [(index, f) for index, f in edges[pc]
+                      if index in members]
+                 for pc in component}
+        size = len(component)
+    join = state_join(analysis)
+    loop_heads = cfg.loop_heads()
+    delay = analysis.widening_delay
+    updates = defaultdict(int)
+    interned = {}
+    worklist = deque(pcs)
+    pending = set(worklist)
+    budget = MAX_RECURSIONS * max(size, 1)
+    if stats is not None:
+        stats.start()
+        remaining = len(worklist)
+        changed = set()
+    while worklist:
+        budget -= 1
+        if budget < 0:
+            raise FixedPointNotReached(s_hat)
+        pc = worklist.popleft()
+        pending.discard(pc)
+        for index, f in edges[pc]:
+            previous = s_hat[index]
+            joined = join(previous, f(s_hat[pc]))
+            if index in loop_heads and updates[index] >= delay:
+                new = analysis.widen({index: previous},
+                                     {index: joined})[index]
+            else:
+                new = joined
+            if stats is not None:
+                stats.transfers += 1
+                if new != joined:
+                    stats.widenings += 1
+            if new != previous:
+                new = interned.setdefault(new, new)
+                s_hat[index] = new
+                if index in loop_heads:
+                    updates[index] += 1
+                if stats is not None:
+                    changed.add(index)
+                if index not in pending:
+                    pending.add(index)
+                    worklist.append(index)
+        if stats is not None:
+            remaining -= 1
+            if remaining == 0:
+                stats.iteration(len(changed))
+                remaining = len(worklist)
+                changed = set()
+
+    return s_hat
+
+
+def narrow(cfg, analysis, s_hat, stats=None):
+    """Refine a fixed point by at most `analysis.narrowing_steps` rounds of
+    decreasing iteration with narrowing.
+
+    :type cfg: ControlFlowGraph
+    :type analysis: Analysis
+    :type s_hat: dict[int, (Lattice, Lattice, Lattice)]
+    :type stats: Statistics | None
+    :rtype: dict[int, (Lattice, Lattice, Lattice)]
+    """
+    edges = cfg.transfers(analysis)
+    join = state_join(analysis)
+    for _ in range(analysis.narrowing_steps):
+        if stats is not None:
+            stats.start()
+        f_hat = initial_states(cfg, analysis)
+        for pc in cfg.pcs:
+            for index, f in edges[pc]:
+                f_hat[index] = join(f_hat[index], f(s_hat[pc]))
+        new_s_hat = analysis.narrow(s_hat, f_hat)
+        if stats is not None:
+            stats.transfers += len(cfg.edges)
+            stats.iteration(count_changes(s_hat, new_s_hat))
+        if new_s_hat == s_hat:
+            break
+        s_hat = new_s_hat
+    return s_hat
+
+
+# Components with fewer program points are solved in the main process
+PARALLEL_THRESHOLD = 256
+
+
+def solve_components(cfg, analysis, s_hat, stats=None, executor=None):
+    """Stabilize strongly connected components in topological order.
+
+    Every component is iterated on its own once all components before it are
+    stable, and its states are then propagated along the edges leaving it.
+    Components without cycles need no iteration at all. If an executor is
+    given, large components whose predecessors are stable are solved in
+    parallel by `solve_task` in worker processes set up by `init_worker`.
+
+    :type cfg: ControlFlowGraph
+    :type analysis: Analysis
+    :param s_hat: Initial states, updated in place
+    :type s_hat: dict[int, (Lattice, Lattice, Lattice)]
+    :type stats: Statistics | None
+    :type executor: concurrent.futures.Executor | None
+    :rtype: dict[int, (Lattice, Lattice, Lattice)]
+    """
+    edges = cfg.transfers(analysis)
+    join = state_join(analysis)
+    components = cfg.components()
+    component_of = [0] * (cfg.size + 1)
+    for i, component in enumerate(components):
+        for pc in component:
+            component_of[pc] = i
+    interned = {}
+
+    def propagate(i):
+        """Follow the edges leaving a stable component.
+
+        This is not an iteration of the statistics, only its transfers and
+        time are recorded.
         """
+        start = time.perf_counter()
+        transfers = 0
+        for pc in components[i]:
+            state = s_hat[pc]
+            for index, f in edges[pc]:
+                if component_of[index] != i:
+                    new = join(s_hat[index], f(state))
+                    s_hat[index] = interned.setdefault(new, new)
+                    transfers += 1
+        if stats is not None:
+            stats.transfers += transfers
+            stats.time += time.perf_counter() - start
+
+    def cyclic(component):
+        return len(component) > 1 or any(index == component[0]
+                                         for index, _ in edges[component[0]])
+
+    if executor is None:
+        for i, component in enumerate(components):
+            if cyclic(component):
+                solve(cfg, analysis, s_hat, component, stats, component)
+            propagate(i)
+        return s_hat
+
+    successors = [set() for _ in components]
+    waiting = [0] * len(components)
+    for edge in cfg.edges:
+        source, target = component_of[edge.source], component_of[edge.target]
+        if source != target and target not in successors[source]:
+            successors[source].add(target)
+            waiting[target] += 1
+    ready = deque(i for i, count in enumerate(waiting) if count == 0)
+    running = {}
+
+    def finish(i):
+        propagate(i)
+        for j in successors[i]:
+            waiting[j] -= 1
+            if waiting[j] == 0:
+                ready.append(j)
+
+    while ready or running:
+        while ready:
+            i = ready.popleft()
+            component = components[i]
+            if len(component) >= PARALLEL_THRESHOLD:
+                states = {pc: s_hat[pc] for pc in component}
+                future = executor.submit(solve_task, component, states,
+                                         stats is not None)
+                running[future] = i
+                continue
+            if cyclic(component):
+                solve(cfg, analysis, s_hat, component, stats, component)
+            finish(i)
+        if running:
+            from concurrent.futures import FIRST_COMPLETED, wait
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                states, record = future.result()
+                s_hat.update(states)
+                if record is not None:
+                    stats.merge(record)
+                finish(running.pop(future))
+    return s_hat
+
+
+_worker = None
+
+
+def init_worker(program, analysis):
+    """Set up a worker process of `solve_components`.
+
+    :type program: list[Instruction]
+    :type analysis: Analysis
+    """
+    global _worker
+    _worker = ControlFlowGraph(program), analysis
+
+
+def solve_task(component, states, stats=False):
+    """Stabilize a component in a worker process.
+
+    :type component: tuple[int]
+    :param states: States of the program points of the component
+    :type states: dict[int, (Lattice, Lattice, Lattice)]
+    :type stats: bool
+    :return: The states and the statistics if requested
+    :rtype: (dict[int, (Lattice, Lattice, Lattice)], dict | None)
+    """
+    cfg, analysis = _worker
+    statistics = Statistics() if stats else None
+    states = solve(cfg, analysis, states, component, statistics, component)
+    return states, statistics.as_dict() if stats else None
+
+
+def analyze_components(program, analysis, cfg=None, stats=None, workers=1):
+    """Perform program analysis one strongly connected component at a time.
+
+    :type program: list[Instruction]
+    :type analysis: Analysis
+    :type cfg: ControlFlowGraph | None
+    :type stats: Statistics | None
+    :param workers: Number of processes solving independent components
+    :type workers: int
+    :rtype: dict[int, (Lattice, Lattice, Lattice)]
+    """
+    if cfg is None:
+        cfg = ControlFlowGraph(program)
+    s_hat = initial_states(cfg, analysis)
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers, initializer=init_worker,
+                                 initargs=(program, analysis)) as executor:
+            s_hat = solve_components(cfg, analysis, s_hat, stats, executor)
+    else:
+        s_hat = solve_components(cfg, analysis, s_hat, stats)
+    return narrow(cfg, analysis, s_hat, stats)
+
+
+# Analyses are imported on demand to keep the startup time low
+ANALYSES = [
+    ('parity', 'exercise03.ParityAnalysis'),
+    ('bounds', 'bounds.BoundsAnalysis'),
+    ('interval', 'exercise04.IntervalAnalysis'),
+    ('zone', 'zones.ZoneAnalysis'),
+    ('all', 'product.ProductAnalysis'),
+]
+
+
+def analysis_class(name):
+    """
+    :type name: str
+    :rtype: type
+    """
+    module, _, cls = dict(ANALYSES)[name].rpartition('.')
+    return getattr(importlib.import_module(module), cls)
+
+
+def find_programs(paths):
+    """Expand directories and glob patterns into program files.
+
+    :type paths: list[str]
+    :raise ValueError: A directory or a pattern matches no programs
+    :rtype: list[str]
+    """
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            pattern = os.path.join(path, '**', '*.3cm')
+            matches = glob.glob(pattern, recursive=True)
+        elif glob.has_magic(path):
+            matches = glob.glob(path, recursive=True)
+        else:
+            matches = [path]
+        if not matches:
+            raise ValueError('{}: no programs found'.format(path))
+        result.extend(sorted(matches))
+    return result
+
+
+def create_analysis(name, program, options=None):
+    """
+    :type name: str
+    :type program: list[Instruction]
+    :param options: Options of the interval and product analyses
+    :type options: dict | None
+    :rtype: Analysis
+    """
+    options = options or {}
+    if name == 'interval':
+        from exercise04 import program_thresholds
+        if options.get('thresholds'):
+            thresholds = program_thresholds(program)
+        else:
+            thresholds = ()
+        return analysis_class(name)(options.get('widening_delay', 0),
+                                    thresholds,
+                                    options.get('narrowing_steps', 0))
+    elif name == 'all':
+        return analysis_class(name)(
+            [create_analysis('parity', program),
+             create_analysis('bounds', program),
+             create_analysis('interval', program, options)],
+            options.get('reduction', True))
+    return analysis_class(name)()
+
+
+def analyze_file(path, name, engine='worklist', stats=False, cache=None,
+                 options=None, workers=1, format='text'):
+    """Analyze a program file and format the result.
+
+    :type path: str
+    :type name: str
+    :param engine: One of 'worklist', 'bitvector' or 'scc'
+    :type engine: str
+    :param stats: Collect fixed point statistics
+    :type stats: bool
+    :type cache: ResultCache | None
+    :param options: Options of the interval and product analyses
+    :type options: dict | None
+    :param workers: Number of processes of the 'scc' engine
+    :type workers: int
+    :param format: One of FORMATS
+    :type format: str
+    :return: Lines of the result, produced lazily, and the statistics if
+        requested
+    :rtype: (collections.Iterator[str], dict | None)
+    """
+    program = load(path)
+    analysis = create_analysis(name, program, options)
+    statistics = Statistics() if stats else None
+    result = run_analysis(program, analysis, engine, statistics, cache,
+                          workers=workers)
+    lines = format_result(program, result, format, analysis,
+                          {'path': path, 'analysis': name})
+    if statistics is not None:
+        record = {'path': path, 'analysis': name}
+        record.update(statistics.as_dict())
+        return lines, record
+    return lines, None
 
-        result = bottom_hat.copy()
-        result[1] = analysis.initial
-
-        def map_and_join(index, f):
-            x, y, z = f(s_hat[pc])
-            rx, ry, rz = result[index]
-            return rx.join(x), ry.join(y), rz.join(z)
-
-        for pc, i in instructions.items():
-            if isinstance(i, Inc):
-                index = pc + 1
-                function = functools.partial(var_function, analysis.plus_1, i.v)
-                result[index] = map_and_join(index, function)
-            elif isinstance(i, Dec):
-                index = pc + 1
-                function = functools.partial(var_function, analysis.minus_1,
-                                             i.v)
-                result[index] = map_and_join(index, function)
-            elif isinstance(i, Zero):
-                index1 = i.pc1
-                function1 = functools.partial(var_function, analysis.is_zero,
-                                              i.v)
-                result[index1] = map_and_join(index1, function1)
-
-                index2 = i.pc2
-                function2 = functools.partial(var_function, analysis.non_zero,
-                                              i.v)
-                result[index2] = map_and_join(index2, function2)
-            elif isinstance(i, Stop):
-                pass
-            else:
-                raise ValueError('unknown instruction: {}'.format(i))
 
+def run_analysis(program, analysis, engine='worklist', stats=None,
+                 cache=None, cfg=None, workers=1):
+    """Analyze a program with an engine, using the cache if given.
+
+    :type program: list[Instruction]
+    :type analysis: Analysis
+    :param engine: One of 'worklist', 'bitvector' or 'scc'
+    :type engine: str
+    :type stats: Statistics | None
+    :type cache: ResultCache | None
+    :type cfg: ControlFlowGraph | None
+    :param workers: Number of processes of the 'scc' engine
+    :type workers: int
+    :rtype: dict[int, (Lattice, Lattice, Lattice)]
+    """
+    result = None
+    if cache is not None:
+        result = cache.get(program, analysis, engine)
+    if result is None:
+        if engine == 'bitvector':
+            import bitvector
+            if stats is not None:
+                raise ValueError('statistics are not supported by the bit '
+                                 'mask engine')
+            result = bitvector.analyze(program, analysis, cfg)
+        elif engine == 'scc':
+            result = analyze_components(program, analysis, cfg, stats,
+                                        workers)
+        elif engine == 'worklist':
+            result = analyze(program, analysis, cfg, stats)
+        else:
+            raise ValueError('unknown engine: {}'.format(engine))
+        if cache is not None:
+            cache.put(program, analysis, result, engine)
+    return result
+
+
+FORMATS = ('text', 'json', 'ndjson', 'csv')
+
+CSV_COLUMNS = ('path', 'analysis', 'pc', 'instruction', 'x', 'y', 'z',
+               'y - x', 'z - x', 'z - y')
+
+
+def state_encoder(analysis, format):
+    """Function encoding states of an analysis for an output format.
+
+    States are encoded as JSON text or as CSV cells. Solvers share equal
+    states between program points, so every distinct state is encoded only
+    once.
+
+    :type analysis: Analysis
+    :param format: One of FORMATS except 'text'
+    :type format: str
+    :rtype: ((Lattice, Lattice, Lattice) | Lattice) -> str | list[str]
+    """
+    encoded = {}
+
+    def encode(states):
+        try:
+            return encoded[states]
+        except KeyError:
+            pass
+        if analysis.relational:
+            value = states.to_json()
+        else:
+            value = {v: s.to_json() for v, s in zip('xyz', states)}
+        if format != 'csv':
+            result = json.dumps(value)
+        elif isinstance(value, str):
+            result = [value] * (len(CSV_COLUMNS) - 4)
+        else:
+            result = [csv_cell(value.get(column, ''))
+                      for column in CSV_COLUMNS[4:]]
+        encoded[states] = result
         return result
 
-    pcs = set(range(1, len(program) + 1))
-    instructions = {pc: instruction(pc) for pc in pcs}
-    bottom_hat = {pc: (analysis.bottom, analysis.bottom, analysis.bottom)
-                  for pc in pcs}
+    return encode
 
-    def f_hat_with_widening(s_hat):
-        new_s_hat = f_hat(s_hat)
-        return analysis.widen(s_hat, new_s_hat)
 
-    return fixed_point(f_hat_with_widening)(bottom_hat)
+def format_result(program, result, format='text', analysis=None,
+                  header=None):
+    """Lines of instructions followed by their states.
+
+    The text format shows the `repr` of states. The machine-readable formats
+    encode instructions like `threecm.format_instruction` and elements of
+    lattices by their `to_json` method:
+
+        json    An object of the header fields and a `states` array of
+                records {"pc", "instruction", "state"}
+        ndjson  A record per line with the header fields
+        csv     A row of CSV_COLUMNS per program point without the header row,
+                cells are JSON values unless they are strings
+
+    States of non-relational analyses are objects of the values of x, y and
+    z, states of relational ones are the encoding of the element.
+
+    :type program: list[Instruction]
+    :type result: dict[int, (Lattice, Lattice, Lattice)]
+    :param format: One of FORMATS
+    :type format: str
+    :param analysis: The analysis, required by the machine-readable formats
+    :type analysis: Analysis | None
+    :param header: Fields identifying the result like the path and the
+        analysis name
+    :type header: dict | None
+    :rtype: collections.Iterator[str]
+    """
+    if format == 'text':
+        for i, instruction in enumerate(program):
+            yield '{} {}'.format(repr(instruction).ljust(30), result[i + 1])
+        return
+    elif format not in FORMATS:
+        raise ValueError('unknown format: {}'.format(format))
+    header = header or {}
+    encode = state_encoder(analysis, format)
+    instructions = enumerate(map(format_instruction, program), 1)
+    if format == 'csv':
+        fields = [header.get(column, '') for column in CSV_COLUMNS[:2]]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='')
+        for pc, instruction in instructions:
+            writer.writerow(fields + [pc, instruction] + encode(result[pc]))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        return
+    # Records are formatted directly since the header and the states are
+    # encoded already
+    if format == 'ndjson':
+        prefix = json.dumps(header)[:-1] + (', ' if header else '')
+        for pc, instruction in instructions:
+            yield '{}"pc": {}, "instruction": "{}", "state": {}}}'.format(
+                prefix, pc, instruction, encode(result[pc]))
+    else:
+        yield json.dumps(header)[:-1] + (', ' if header else '') + \
+            '"states": ['
+        record = None
+        for pc, instruction in instructions:
+            if record is not None:
+                yield record + ','
+            record = '{{"pc": {}, "instruction": "{}", "state": {}}}'.format(
+                pc, instruction, encode(result[pc]))
+        if record is not None:
+            yield record
+        yield ']}'
+
+
+def csv_cell(value):
+    """
+    :type value: object
+    :rtype: str
+    """
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, separators=(',', ':'))
+
+
+# Number of lines written at once
+WRITE_BATCH = 4096
+
+
+def write_lines(out, lines):
+    """Write lines in large batches.
+
+    :type out: io.TextIOBase
+    :type lines: collections.Iterable[str]
+    """
+    lines = iter(lines)
+    while True:
+        batch = list(itertools.islice(lines, WRITE_BATCH))
+        if not batch:
+            break
+        batch.append('')
+        out.write('\n'.join(batch))
+
+
+@contextlib.contextmanager
+def open_output(path=None, compress=False):
+    """Text stream of a file or of the standard output.
+
+    :type path: str | None
+    :param compress: Compress the output with gzip
+    :type compress: bool
+    :rtype: io.TextIOWrapper
+    """
+    binary = sys.stdout.buffer if path is None else open(path, 'wb')
+    try:
+        compressed = None
+        if compress:
+            import gzip
+            compressed = gzip.GzipFile(fileobj=binary, mode='wb')
+        out = io.TextIOWrapper(compressed or binary, encoding='utf-8',
+                               newline='\n')
+        yield out
+        out.flush()
+        out.detach()
+        if compressed is not None:
+            compressed.close()
+    finally:
+        if path is not None:
+            binary.close()
+        else:
+            binary.flush()
+
+
+def run_job(job):
+    try:
+        lines, record = analyze_file(*job)
+        return (list(lines), record), None
+    except Exception as e:
+        return (None, None), '{}: {}'.format(type(e).__name__, e)
+
+
+def print_stats(record):
+    if record is not None:
+        print(json.dumps(record), file=sys.stderr)
 
 
 def main(argv):
     opts = docopt(__doc__, argv=argv)
-    with open(opts['PATH'], 'r') as fd:
-        data = fd.read()
-    program = parse(data)
-    if opts['parity']:
-        analysis = ParityAnalysis()
-    elif opts['bounds']:
-        analysis = BoundsAnalysis()
-    elif opts['interval']:
-        analysis = IntervalAnalysis()
-    else:
+    names = [name for name, _ in ANALYSES if opts[name]]
+    if not names:
         raise ValueError('specify an analysis to run')
-    result = analyze(program, analysis)
-    for i, instruction in enumerate(program):
-        print('{} {}'.format(repr(instruction).ljust(30), result[i + 1]))
+    try:
+        paths = find_programs(opts['PATH'])
+    except ValueError as e:
+        raise SystemExit(e)
+    if opts['--no-cache'] or opts['--stats']:
+        cache = None
+    else:
+        from cache import ResultCache
+        cache = ResultCache(opts['--cache-dir'])
+    options = {
+        'widening_delay': int(opts['--widening-delay']),
+        'thresholds': opts['--thresholds'],
+        'narrowing_steps': int(opts['--narrowing']),
+        'reduction': not opts['--no-reduction'],
+    }
+    if opts['--bitvector'] and opts['--scc']:
+        raise ValueError('--bitvector and --scc cannot be combined')
+    elif opts['--bitvector']:
+        engine = 'bitvector'
+    elif opts['--scc']:
+        engine = 'scc'
+    else:
+        engine = 'worklist'
+    format = opts['--format']
+    if format not in FORMATS:
+        raise ValueError('unknown format: {}'.format(format))
+    jobs = [(path, name, engine, opts['--stats'], cache, options, 1, format)
+            for path in paths for name in names]
+    workers = int(opts['--jobs'])
+    output = opts['--output']
+    compress = opts['--gzip'] or (output or '').endswith('.gz')
+
+    if len(jobs) == 1:
+        results = None
+        executor = None
+    elif workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(workers)
+        chunksize = max(1, len(jobs) // (4 * workers))
+        results = executor.map(run_job, jobs, chunksize=chunksize)
+    else:
+        executor = None
+        results = map(run_job, jobs)
+    failed = False
+    try:
+        with open_output(output, compress) as out:
+            if format == 'csv':
+                write_lines(out, [','.join(CSV_COLUMNS)])
+            elif format == 'json':
+                out.write('[\n')
+            if results is None:
+                # A single result is streamed while it is being formatted
+                lines, record = analyze_file(*jobs[0][:-2], workers=workers,
+                                             format=format)
+                write_lines(out, lines)
+                out.flush()
+                print_stats(record)
+            else:
+                failed = write_results(out, jobs, results, format)
+            if format == 'json':
+                out.write(']\n')
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if failed:
+        sys.exit(1)
+
+
+def write_results(out, jobs, results, format):
+    """Write results of several jobs, preceded by headers in text format.
+
+    :return: Whether any of the jobs failed
+    :rtype: bool
+    """
+    failed = False
+    separator = ''
+    for (path, name, *_), ((lines, record), error) in zip(jobs, results):
+        if format == 'text':
+            write_lines(out, ['==> {} ({}) <=='.format(path, name)])
+        if error is not None:
+            failed = True
+            out.flush()
+            print(error, file=sys.stderr)
+        else:
+            if format == 'json':
+                out.write(separator)
+                separator = ',\n'
+            write_lines(out, lines)
+            out.flush()
+            print_stats(record)
+        if format == 'text':
+            write_lines(out, [''])
+    return failed
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.TemporaryDirectory()
+        root = self.directory.name
+        os.makedirs(os.path.join(root, 'a', 'b'))
+        self.files = {
+            'a/one.3cm': 'inc y\nstop\n',
+            'a/b/two.3cm': 'zero x 3 else 2\ndec x\nstop\n',
+            'a/bad.3cm': 'inc w\n',
+            'a/notes.txt': 'not a program\n',
+        }
+        for name, text in self.files.items():
+            with open(self.path(name), 'w') as fd:
+                fd.write(text)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, *name.split('/'))
+
+    def run_main(self, *argv):
+        """Output, error output and exit status of `main`."""
+        output = self.path('output')
+        stderr = io.StringIO()
+        status = 0
+        with contextlib.redirect_stderr(stderr):
+            try:
+                main(['--no-cache', '--output', output] + list(argv))
+            except SystemExit as e:
+                status = e.code
+        with open(output) as fd:
+            return fd.read(), stderr.getvalue(), status
+
+    def test_find_programs(self):
+        expected = [self.path(name) for name in ['a/b/two.3cm', 'a/bad.3cm',
+                                                 'a/one.3cm']]
+        self.assertEqual(expected, find_programs([self.path('a')]))
+        self.assertEqual(expected[1:],
+                         find_programs([self.path('a/*.3cm')]))
+        self.assertEqual([self.path('a/notes.txt'), expected[0]],
+                         find_programs([self.path('a/notes.txt'),
+                                        self.path('a/**/t*.3cm')]))
+        with self.assertRaisesRegex(ValueError, 'no programs found'):
+            find_programs([self.path('a'), self.path('a/*.txt.3cm')])
+
+    def test_no_programs(self):
+        os.makedirs(self.path('empty'))
+        for path in [self.path('empty'), self.path('a/*.3cmx')]:
+            # The message is printed to stderr with exit status 1
+            with self.assertRaises(SystemExit) as context:
+                main(['parity', self.path('a/one.3cm'), path])
+            self.assertEqual('{}: no programs found'.format(path),
+                             str(context.exception.code))
+
+    def test_order_and_failures(self):
+        output, errors, status = self.run_main('parity', 'bounds',
+                                               self.path('a'))
+        self.assertEqual(1, status)
+        self.assertIn('ParseError', errors)
+        headers = [line for line in output.splitlines()
+                   if line.startswith('==>')]
+        self.assertEqual(['==> {} ({}) <=='.format(self.path(name), analysis)
+                          for name in ['a/b/two.3cm', 'a/bad.3cm',
+                                       'a/one.3cm']
+                          for analysis in ['parity', 'bounds']], headers)
+        # The results of the programs after the failing one are written
+        self.assertIn('Stop()', output.split(headers[-1])[1])
+        self.assertEqual((output, errors, status),
+                         self.run_main('--jobs', '2', 'parity', 'bounds',
+                                       self.path('a')))
+
+
+class WorklistTest(unittest.TestCase):
+    def kleene(self, program, analysis):
+        """Fixed point of the sweep over all program points with widening
+        everywhere, which `solve` replaced."""
+        from funcutils import fixed_point
+
+        cfg = ControlFlowGraph(program)
+        transfers = cfg.transfers(analysis)
+        join = state_join(analysis)
+        start = initial_states(cfg, analysis)
+
+        def f_hat(s_hat):
+            result = dict(start)
+            for pc in cfg.pcs:
+                for index, f in transfers[pc]:
+                    result[index] = join(result[index], f(s_hat[pc]))
+            return analysis.widen(s_hat, result)
+
+        return fixed_point(f_hat)(start)
+
+    def test_same_as_kleene(self):
+        from bounds import BoundsAnalysis
+        from exercise03 import ParityAnalysis
+        from generate import generate
+
+        directory = os.path.dirname(os.path.abspath(__file__))
+        programs = [parse(text) for text in ComponentsTest.programs]
+        programs += [load(os.path.join(directory, name))
+                     for name in ['exercise02-test1.3cm',
+                                  'exercise03-test1.3cm',
+                                  'exercise03-test2.3cm']]
+        programs += [generate(100, seed=seed) for seed in range(3)]
+        for program in programs:
+            for analysis in [ParityAnalysis(), BoundsAnalysis()]:
+                self.assertEqual(self.kleene(program, analysis),
+                                 analyze(program, analysis))
+
+    def test_loop_head_widening(self):
+        from exercise04 import Interval, IntervalAnalysis
+
+        # z is counted up in the loop of 4-6, y is set before it
+        program = parse('inc y\n'
+                        'inc y\n'
+                        'zero x 7 else 4\n'
+                        'dec x\n'
+                        'inc z\n'
+                        'zero x 7 else 4\n'
+                        'stop\n')
+        analysis = IntervalAnalysis()
+        result = analyze(program, analysis)
+        self.assertEqual((Interval(0, 0), Interval(2, 2),
+                          Interval(0, float('inf'))), result[7])
+        # Widening everywhere loses the bounds of y as well
+        swept = self.kleene(program, analysis)
+        self.assertEqual(Interval(1, float('inf')), swept[7][1])
+        for pc in result:
+            self.assertEqual(swept[pc], join_states(result[pc], swept[pc]))
+
+
+class ComponentsTest(unittest.TestCase):
+    programs = [
+        'inc y\n'
+        'zero x 5 else 3\n'
+        'dec x\n'
+        'zero x 2 else 2\n'
+        'zero y 9 else 6\n'
+        'inc z\n'
+        'dec y\n'
+        'zero y 9 else 6\n'
+        'stop\n',
+        'zero x 6 else 2\n'
+        'inc y\n'
+        'dec x\n'
+        'zero x 1 else 1\n'
+        'inc z\n'
+        'stop\n',
+    ]
+
+    def test_same_as_worklist(self):
+        from bounds import BoundsAnalysis
+        from exercise03 import ParityAnalysis
+        from generate import generate
+
+        programs = [parse(text) for text in self.programs]
+        programs.append(generate(300, seed=1))
+        for program in programs:
+            for analysis in [ParityAnalysis(), BoundsAnalysis()]:
+                self.assertEqual(analyze(program, analysis),
+                                 analyze_components(program, analysis))
+
+    def test_fixed_point(self):
+        from exercise04 import IntervalAnalysis
+        from zones import ZoneAnalysis
+
+        for text in self.programs:
+            program = parse(text)
+            cfg = ControlFlowGraph(program)
+            for analysis in [IntervalAnalysis(), ZoneAnalysis()]:
+                join = state_join(analysis)
+                result = analyze_components(program, analysis, cfg)
+                for pc, edges in enumerate(cfg.transfers(analysis)):
+                    for index, f in edges:
+                        self.assertEqual(result[index],
+                                         join(result[index], f(result[pc])))
+
+    def test_parallel(self):
+        from exercise04 import IntervalAnalysis
+        from product import ProductAnalysis
+
+        global PARALLEL_THRESHOLD
+        threshold = PARALLEL_THRESHOLD
+        PARALLEL_THRESHOLD = 2
+        try:
+            for text in self.programs:
+                program = parse(text)
+                for analysis in [IntervalAnalysis(), ProductAnalysis()]:
+                    stats = Statistics()
+                    self.assertEqual(
+                        analyze_components(program, analysis),
+                        analyze_components(program, analysis, stats=stats,
+                                           workers=2))
+                    self.assertGreater(stats.iterations, 0)
+        finally:
+            PARALLEL_THRESHOLD = threshold
+
+
+class FormatTest(unittest.TestCase):
+    text = ('zero x 6 else 2\n'
+            'inc y\n'
+            'dec x\n'
+            'zero x 1 else 1\n'
+            'inc z\n'
+            'stop\n')
+
+    def format(self, name, format):
+        program = parse(self.text)
+        analysis = create_analysis(name, program)
+        result = analyze(program, analysis)
+        return list(format_result(program, result, format, analysis,
+                                  {'path': 'p.3cm', 'analysis': name}))
+
+    def test_ndjson(self):
+        records = [json.loads(line) for line in self.format('interval',
+                                                            'ndjson')]
+        self.assertEqual({'path': 'p.3cm', 'analysis': 'interval', 'pc': 2,
+                          'instruction': 'inc y',
+                          'state': {'x': ['-inf', 'inf'], 'y': [0, 'inf'],
+                                    'z': [0, 0]}}, records[1])
+        self.assertEqual('Bottom', records[4]['state']['z'])
+
+    def test_json(self):
+        for name in ['parity', 'zone', 'all']:
+            result = json.loads('\n'.join(self.format(name, 'json')))
+            self.assertEqual(6, len(result['states']))
+            self.assertEqual('stop', result['states'][-1]['instruction'])
+        self.assertEqual([0, 0], result['states'][-1]['state']['x'][2])
+
+    def test_csv(self):
+        rows = list(csv.DictReader([','.join(CSV_COLUMNS)] +
+                                   self.format('zone', 'csv')))
+        self.assertEqual('[0,0]', rows[5]['x'])
+        self.assertEqual('["-inf",0]', rows[5]['z - y'])
+        self.assertEqual('Bottom', rows[4]['y - x'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,169 @@
+"""Benchmarks for 3 Counter Machine tools on generated programs
+
+Usage:
+    benchmark [options] [BENCHMARK...]
+
+Every benchmark is run on generated programs of every size and reported as a
+JSON object per line. Without BENCHMARK arguments all benchmarks are run:
+
+    parse, load, load-compiled, evaluate, evaluate-compiled, evaluate-lockstep,
+    analyze-parity, analyze-bounds, analyze-interval,
+    bitvector-parity, bitvector-bounds
+
+Analysis benchmarks also report the iterations, transfers and widenings of
+their fixed point computation.
+
+Options:
+    --sizes N,...       Program sizes [default: 100,1000,10000]
+    --seed N            Random seed of the generator [default: 0]
+    --repeat N          Number of timed runs per benchmark [default: 3]
+    --input N           Input value of x for evaluation [default: 10]
+    --lanes N           Number of inputs for lockstep evaluation [default: 100]
+    --help              Show help message
+"""
+
+
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from docopt import docopt
+import bitvector
+from analyze import analyze
+from bounds import BoundsAnalysis
+from exercise02 import evaluate
+from exercise03 import ParityAnalysis
+from exercise04 import IntervalAnalysis
+from funcutils import Statistics
+from generate import generate
+from lockstep import evaluate_batch
+from program import COMPILED_SUFFIX, Program, load, load_compiled, save
+from threecm import format_program, parse
+
+
+# Benchmarks of fixed point computations that report their work
+COUNTED = ('analyze-', 'bitvector-')
+
+
+def benchmarks(program, text, path, input, lanes):
+    """Benchmarked functions for a program by name.
+
+    :type program: list[Instruction]
+    :type text: str
+    :param path: Text file of the program
+    :type path: str
+    :type input: int
+    :type lanes: int
+    :return: Benchmarks, analyses take optional statistics to collect
+    :rtype: list[(str, () -> object)]
+    """
+    def quiet(f, *args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return f(*args, **kwargs)
+
+    compiled_path = os.path.splitext(path)[0] + COMPILED_SUFFIX
+    save(Program(program), compiled_path)
+
+    return [
+        ('parse', lambda: parse(text)),
+        ('load', lambda: load(path, compiled=False)),
+        ('load-compiled', lambda: load_compiled(compiled_path)),
+        ('evaluate', lambda: quiet(evaluate, program, input)),
+        ('evaluate-compiled',
+         lambda: quiet(evaluate, program, input, compiled=True)),
+        ('evaluate-lockstep', lambda: evaluate_batch(program, range(lanes))),
+        ('analyze-parity', lambda stats=None: analyze(
+            program, ParityAnalysis(), stats=stats)),
+        ('analyze-bounds', lambda stats=None: analyze(
+            program, BoundsAnalysis(), stats=stats)),
+        ('analyze-interval', lambda stats=None: analyze(
+            program, IntervalAnalysis(), stats=stats)),
+        ('bitvector-parity', lambda stats=None: bitvector.analyze(
+            program, ParityAnalysis(), stats=stats)),
+        ('bitvector-bounds', lambda stats=None: bitvector.analyze(
+            program, BoundsAnalysis(), stats=stats)),
+    ]
+
+
+def measure(f, repeat, counted=False):
+    """Time a function and measure its peak memory allocation.
+
+    Memory is measured in a separate run since tracing allocations slows the
+    function down. The work of an analysis is counted in another run.
+
+    :type f: () -> object
+    :type repeat: int
+    :param counted: Pass `Statistics` to the function and report the number
+        of fixed point iterations, transfers and widenings
+    :type counted: bool
+    :rtype: dict
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        f()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result = {
+        'time': min(times),
+        'times': times,
+        'repeat': repeat,
+        'peak_memory': peak,
+    }
+    if counted:
+        stats = Statistics()
+        f(stats=stats)
+        result.update(iterations=stats.iterations,
+                      transfers=stats.transfers,
+                      widenings=stats.widenings)
+    return result
+
+
+def main(argv):
+    opts = docopt(__doc__, argv=argv)
+    sizes = [int(size) for size in opts['--sizes'].split(',')]
+    seed = int(opts['--seed'])
+    repeat = int(opts['--repeat'])
+    input = int(opts['--input'])
+    lanes = int(opts['--lanes'])
+    selected = opts['BENCHMARK']
+
+    for size in sizes:
+        program = generate(size, seed=seed)
+        text = format_program(program)
+        # The compiled file is written next to the text file
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'program.3cm')
+            with open(path, 'w') as fd:
+                fd.write(text)
+            functions = benchmarks(program, text, path, input, lanes)
+            names = [name for name, _ in functions]
+            unknown = set(selected) - set(names)
+            if unknown:
+                raise ValueError('unknown benchmarks: {}'.format(
+                    ', '.join(sorted(unknown))))
+            for name, f in functions:
+                if selected and name not in selected:
+                    continue
+                record = {
+                    'benchmark': name,
+                    'size': len(program),
+                    'seed': seed,
+                }
+                counted = name.startswith(COUNTED)
+                record.update(measure(f, repeat, counted))
+                print(json.dumps(record), flush=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
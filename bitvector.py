@@ -0,0 +1,251 @@
+"""Vectorized analysis of 3 Counter Machine for finite abstract domains
+
+Elements of a finite lattice are encoded as bit masks of the atoms below
+them, so joins become bitwise ORs followed by a table lookup that maps the
+result back to a lattice element. The abstract state of the whole program is
+an (n_pcs + 1, 3) array of masks. While the worklist of changed program points
+is large, the transfer functions of all edges leaving them are applied in one
+round of vectorized gathers and scatters; short worklists are processed one
+program point at a time on the same masks.
+"""
+
+
+import heapq
+import unittest
+
+import numpy as np
+
+from cfg import ControlFlowGraph
+from funcutils import TRANSFER_FUNCTIONS
+from threecm import parse
+
+
+VARIABLES = 'xyz'
+
+# Worklists at least this long are processed as a single vectorized round
+VECTORIZE_THRESHOLD = 64
+
+
+class Encoding:
+    """Bit mask encoding of a finite lattice with tabulated operations."""
+
+    def __init__(self, analysis):
+        """
+        :type analysis: Analysis
+        """
+        elements = getattr(analysis.bottom, 'elements', None)
+        if elements is None:
+            raise ValueError('not a finite lattice: {!r}'.format(
+                analysis.bottom))
+
+        def le(a, b):
+            return a.join(b) == b
+
+        bottom = analysis.bottom
+        atoms = [a for a in elements
+                 if a != bottom and
+                 all(b == bottom or b == a or not le(b, a) for b in elements)]
+        self.masks = {a: sum(1 << i for i, atom in enumerate(atoms)
+                             if le(atom, a))
+                      for a in elements}
+        if len(set(self.masks.values())) != len(elements):
+            raise ValueError('lattice is not atomistic: {!r}'.format(
+                elements))
+        self.elements = [None] * (1 << len(atoms))
+        for a, mask in self.masks.items():
+            self.elements[mask] = a
+
+        self.closure = np.zeros(1 << len(atoms), dtype=np.uint8)
+        for mask in range(len(self.closure)):
+            upper = [a for a, m in self.masks.items() if mask & m == mask]
+            least = [a for a in upper if all(le(a, b) for b in upper)]
+            if not least:
+                raise ValueError('no least upper bound for atoms {:b}'.format(
+                    mask))
+            self.closure[mask] = self.masks[least[0]]
+        for a in elements:
+            for b in elements:
+                mask = self.closure[self.masks[a] | self.masks[b]]
+                if mask != self.masks[a.join(b)]:
+                    raise ValueError('join is not encoded by bitwise OR: '
+                                     '{!r}, {!r}'.format(a, b))
+
+        self.transfers = np.zeros((len(TRANSFER_FUNCTIONS),
+                                   len(self.closure)), dtype=np.uint8)
+        for op, name in enumerate(TRANSFER_FUNCTIONS):
+            f = getattr(analysis, name)
+            for a in elements:
+                self.transfers[op, self.masks[a]] = self.masks[f(a)]
+
+    def encode(self, states):
+        return [self.masks[a] for a in states]
+
+    def decode(self, masks):
+        return tuple(self.elements[m] for m in masks)
+
+
+def analyze(program, analysis, cfg=None, stats=None):
+    """Perform program analysis for a finite abstract domain.
+
+    The result is the same as the one of `analyze.analyze`.
+
+    :type program: list[Instruction]
+    :type analysis: Analysis
+    :type cfg: ControlFlowGraph | None
+    :param stats: Statistics to collect, one iteration per vectorized round
+        or per pass over a short worklist
+    :type stats: Statistics | None
+    :rtype: dict[int, (Lattice, Lattice, Lattice)]
+    """
+    if cfg is None:
+        cfg = ControlFlowGraph(program)
+    encoding = Encoding(analysis)
+    n = cfg.size
+    if n == 0:
+        return {}
+
+    edges = cfg.edges
+    source = np.array([e.source for e in edges], dtype=np.int64)
+    target = np.array([e.target for e in edges], dtype=np.int64)
+    op = np.array([TRANSFER_FUNCTIONS.index(e.operation) for e in edges],
+                  dtype=np.int64)
+    var = np.array([VARIABLES.index(e.v) for e in edges], dtype=np.int64)
+    # Edges are appended in order of their sources, so their indices can be
+    # recovered from the number of outgoing edges per program point.
+    counts = np.array([len(cfg.successors[pc]) for pc in range(n + 1)])
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    outgoing = np.empty((n + 1, 2), dtype=np.int64)
+    outgoing[:, 0] = np.where(counts > 0, starts, -1)
+    outgoing[:, 1] = np.where(counts > 1, starts + 1, -1)
+
+    # The state is shared between a bytearray used for scalar updates and an
+    # array view of it used for vectorized rounds.
+    buffer = bytearray(3 * (n + 1))
+    state = np.frombuffer(buffer, dtype=np.uint8).reshape((n + 1, 3))
+    state[1] = encoding.encode(analysis.initial)
+    closure = encoding.closure
+    transfers = encoding.transfers
+    closure_list = closure.tolist()
+    transfers_list = transfers.tolist()
+    operations = {name: transfers_list[i]
+                  for i, name in enumerate(TRANSFER_FUNCTIONS)}
+    variables = {v: i for i, v in enumerate(VARIABLES)}
+    successors = [[(e.target, operations[e.operation], variables[e.v])
+                   for e in cfg.successors[pc]]
+                  for pc in range(n + 1)]
+
+    # Program points are taken in increasing order, which follows the
+    # control flow of mostly straight-line programs.
+    worklist = list(cfg.pcs)
+    pending = set(cfg.pcs)
+    if stats is not None:
+        stats.start()
+        remaining = 0
+        changed_pcs = set()
+    while worklist:
+        if len(worklist) >= VECTORIZE_THRESHOLD:
+            frontier = np.fromiter(worklist, dtype=np.int64)
+            pending.clear()
+            e = outgoing[frontier].ravel()
+            e = e[e >= 0]
+            values = state[source[e]]
+            rows = np.arange(len(e))
+            values[rows, var[e]] = transfers[op[e], values[rows, var[e]]]
+            t = target[e]
+            previous = state[t]
+            np.bitwise_or.at(state, t, values)
+            current = closure[state[t]]
+            state[t] = current
+            worklist = np.unique(t[(current != previous).any(axis=1)]).tolist()
+            pending.update(worklist)
+            if stats is not None:
+                stats.transfers += len(e)
+                stats.iteration(len(worklist))
+        else:
+            if stats is not None and remaining == 0:
+                remaining = len(worklist)
+            pc = heapq.heappop(worklist)
+            pending.discard(pc)
+            base = 3 * pc
+            for index, table, v in successors[pc]:
+                values = [buffer[base], buffer[base + 1], buffer[base + 2]]
+                values[v] = table[values[v]]
+                changed = False
+                position = 3 * index
+                for value in values:
+                    previous = buffer[position]
+                    current = closure_list[previous | value]
+                    if current != previous:
+                        buffer[position] = current
+                        changed = True
+                    position += 1
+                if changed and stats is not None:
+                    changed_pcs.add(index)
+                if changed and index not in pending:
+                    pending.add(index)
+                    heapq.heappush(worklist, index)
+            if stats is not None:
+                stats.transfers += len(successors[pc])
+                remaining -= 1
+                # A pass also ends when the worklist grows long enough for
+                # a vectorized round
+                if remaining == 0 or len(worklist) >= VECTORIZE_THRESHOLD:
+                    stats.iteration(len(changed_pcs))
+                    remaining = 0
+                    changed_pcs = set()
+
+    # Decode every distinct state once and share the resulting tuples
+    states, inverse = np.unique(state[1:], axis=0, return_inverse=True)
+    decoded = [encoding.decode(masks) for masks in states.tolist()]
+    return dict(zip(cfg.pcs, map(decoded.__getitem__,
+                                 inverse.ravel().tolist())))
+
+
+class BitVectorTest(unittest.TestCase):
+    def test_same_as_worklist(self):
+        from analyze import analyze as reference
+        from bounds import BoundsAnalysis
+        from exercise03 import ParityAnalysis
+
+        program = parse('zero x 6 else 2\n'
+                        'inc y\n'
+                        'dec x\n'
+                        'zero x 1 else 1\n'
+                        'inc z\n'
+                        'stop\n')
+        for analysis in [ParityAnalysis(), BoundsAnalysis()]:
+            self.assertEqual(reference(program, analysis),
+                             analyze(program, analysis))
+
+    def test_statistics(self):
+        from exercise03 import ParityAnalysis
+        from funcutils import Statistics
+        from generate import generate
+
+        program = parse('zero x 6 else 2\n'
+                        'inc y\n'
+                        'dec x\n'
+                        'zero x 1 else 1\n'
+                        'inc z\n'
+                        'stop\n')
+        stats = Statistics()
+        analyze(program, ParityAnalysis(), stats=stats)
+        self.assertEqual((3, 13), (stats.iterations, stats.transfers))
+        self.assertEqual([5, 1, 0], stats.changes)
+
+        # The first round over all program points is vectorized
+        program = generate(VECTORIZE_THRESHOLD, seed=0)
+        cfg = ControlFlowGraph(program)
+        stats = Statistics()
+        analyze(program, ParityAnalysis(), cfg, stats)
+        self.assertGreaterEqual(stats.transfers, len(cfg.edges))
+        self.assertEqual(stats.iterations, len(stats.changes))
+        self.assertEqual(0, stats.changes[-1])
+
+    def test_bounds_encoding(self):
+        from bounds import BoundsAnalysis, Top, ZeroBound, OneBound
+
+        encoding = Encoding(BoundsAnalysis())
+        mask = encoding.closure[encoding.masks[ZeroBound()] |
+                                encoding.masks[OneBound()]]
+        self.assertIs(Top(), encoding.elements[mask])
@@ -1,13 +1,15 @@
 """Exercise 3.1. Bounds analysis for 3 Counter Machine"""
 
 import functools
-from funcutils import Lattice
+from funcutils import FiniteLattice, tabulate
 
 from threecm import Analysis
 
 
 @functools.total_ordering
-class Bounds(Lattice):
+class Bounds(FiniteLattice):
+    __slots__ = ()
+
     @property
     def bottom(self):
         return Bottom()
@@ -18,12 +20,11 @@ class Bounds(Lattice):
     def join(self, other):
         pass
 
-    def __eq__(self, other):
-        return type(self) == type(other)
-
 
 @functools.total_ordering
 class Bottom(Bounds):
+    __slots__ = ()
+
     def __le__(self, other):
         return True
 
@@ -36,6 +37,8 @@ class Bottom(Bounds):
 
 @functools.total_ordering
 class Top(Bounds):
+    __slots__ = ()
+
     def __le__(self, other):
         return isinstance(other, Top)
 
@@ -48,6 +51,8 @@ class Top(Bounds):
 
 @functools.total_ordering
 class ZeroBound(Bounds):
+    __slots__ = ()
+
     def __le__(self, other):
         return isinstance(other, (ZeroBound, Top))
 
@@ -63,6 +68,8 @@ class ZeroBound(Bounds):
 
 @functools.total_ordering
 class OneBound(Bounds):
+    __slots__ = ()
+
     def __le__(self, other):
         return isinstance(other, (OneBound, Top))
 
@@ -78,6 +85,8 @@ class OneBound(Bounds):
 
 @functools.total_ordering
 class Regular(Bounds):
+    __slots__ = ()
+
     def __le__(self, other):
         return isinstance(other, (Regular, Top))
 
@@ -95,6 +104,17 @@ class BoundsAnalysis(Analysis):
     bottom = Bottom()
     initial = Top(), ZeroBound(), ZeroBound()
 
+    @staticmethod
+    def abstract(n):
+        if n == 0:
+            return ZeroBound()
+        elif n == 1:
+            return OneBound()
+        elif n >= 2:
+            return Regular()
+        else:
+            return Top()
+
     @staticmethod
     def plus_1(x):
         if isinstance(x, Bottom):
@@ -154,3 +174,6 @@ class BoundsAnalysis(Analysis):
             return x
         else:
             raise TypeError('not a Bounds element: {!r}'.format(x))
+
+
+tabulate(Bounds, BoundsAnalysis)
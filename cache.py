@@ -0,0 +1,254 @@
+"""Persistent cache of analysis results
+
+Results are stored in files named by a hash of the normalized program text,
+the analysis class and its parameters, the engine and the source code of the
+modules computing the result. Entries are compressed pickles of the states in
+program point order. The least recently used entries are evicted when the total
+size of the cache exceeds its limit.
+"""
+
+
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import tempfile
+import unittest
+import zlib
+
+from threecm import format_program, parse
+
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# Modules whose source code affects the results of every analysis
+CODE_MODULES = ('analyze', 'bitvector', 'cfg', 'funcutils', 'threecm')
+
+
+def default_directory():
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'aiws15')
+
+
+@functools.lru_cache()
+def code_version(module_names):
+    """Hash of the source code of modules.
+
+    :type module_names: tuple[str]
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    for name in sorted(module_names):
+        __import__(name)
+        with open(inspect.getsourcefile(sys.modules[name]), 'rb') as fd:
+            digest.update(fd.read())
+    return digest.hexdigest()
+
+
+def analysis_modules(analysis):
+    """Modules of the classes of an analysis and of its component analyses.
+
+    :type analysis: Analysis
+    :rtype: frozenset[str]
+    """
+    modules = {cls.__module__ for cls in type(analysis).__mro__
+               if cls.__module__ != 'builtins'}
+    for component in getattr(analysis, 'analyses', ()):
+        modules |= analysis_modules(component)
+    return frozenset(modules)
+
+
+def cache_key(program, analysis, engine='worklist'):
+    """
+    :type program: list[Instruction]
+    :type analysis: Analysis
+    :type engine: str
+    :rtype: str
+    """
+    cls = type(analysis)
+    digest = hashlib.sha256()
+    digest.update(format_program(program).encode('ascii'))
+    for part in [cls.__module__, cls.__qualname__, repr(analysis), engine,
+                 code_version(tuple(sorted(set(CODE_MODULES) |
+                                           analysis_modules(analysis))))]:
+        digest.update(b'\0' + part.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Content-addressed on-disk cache of analysis results."""
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        """
+        :type directory: str | None
+        :param max_size: Maximum total size of cache entries in bytes
+        :type max_size: int
+        """
+        self.directory = directory or default_directory()
+        self.max_size = max_size
+        # Total size of the entries as of the last scan plus the entries
+        # stored since then, None until the first scan. Other processes
+        # sharing the directory are only accounted for by scans.
+        self._size = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pickle.z')
+
+    def get(self, program, analysis, engine='worklist'):
+        """Cached result of an analysis or None.
+
+        :type program: list[Instruction]
+        :type analysis: Analysis
+        :type engine: str
+        :rtype: dict[int, (Lattice, Lattice, Lattice)] | None
+        """
+        path = self._path(cache_key(program, analysis, engine))
+        try:
+            with open(path, 'rb') as fd:
+                states = pickle.loads(zlib.decompress(fd.read()))
+        except FileNotFoundError:
+            return None
+        except Exception:
+            self._remove(path)
+            return None
+        if len(states) != len(program):
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return dict(enumerate(states, 1))
+
+    def put(self, program, analysis, result, engine='worklist'):
+        """Store the result of an analysis.
+
+        :type program: list[Instruction]
+        :type analysis: Analysis
+        :type result: dict[int, (Lattice, Lattice, Lattice)]
+        :type engine: str
+        """
+        path = self._path(cache_key(program, analysis, engine))
+        states = [result[pc] for pc in range(1, len(program) + 1)]
+        data = zlib.compress(pickle.dumps(states, pickle.HIGHEST_PROTOCOL))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temporary, path)
+        except BaseException:
+            self._remove(temporary)
+            raise
+        if self._size is not None:
+            self._size += len(data) - replaced
+        if self._size is None or self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries above the size limit.
+
+        The cache directory is scanned, so `put` calls this only when the
+        estimated total size exceeds the limit.
+        """
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.pickle.z'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+        self._size = total
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = ResultCache(self.directory.name)
+        self.program = parse('zero x 6 else 2\n'
+                             'inc y\n'
+                             'dec x\n'
+                             'zero x 1 else 1\n'
+                             'inc z\n'
+                             'stop\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        from analyze import analyze
+        from exercise03 import ParityAnalysis
+        from exercise04 import IntervalAnalysis
+
+        for analysis in [ParityAnalysis(), IntervalAnalysis()]:
+            self.assertIsNone(self.cache.get(self.program, analysis))
+            result = analyze(self.program, analysis)
+            self.cache.put(self.program, analysis, result)
+            self.assertEqual(result, self.cache.get(self.program, analysis))
+        self.assertIsNone(self.cache.get(self.program, ParityAnalysis(),
+                                         engine='bitvector'))
+        self.assertIsNone(self.cache.get(self.program,
+                                         IntervalAnalysis(narrowing_steps=1)))
+
+    def test_component_modules(self):
+        from product import ProductAnalysis
+
+        self.assertLessEqual({'product', 'exercise03', 'bounds', 'exercise04',
+                              'threecm'},
+                             analysis_modules(ProductAnalysis()))
+
+    def test_eviction(self):
+        from analyze import analyze
+        from bounds import BoundsAnalysis
+        from exercise03 import ParityAnalysis
+
+        parity, bounds = ParityAnalysis(), BoundsAnalysis()
+        self.cache.put(self.program, parity, analyze(self.program, parity))
+        size = sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(self.directory.name)
+                   for name in names)
+        self.cache.max_size = size + size // 2
+        self.cache.put(self.program, bounds, analyze(self.program, bounds))
+        self.assertIsNone(self.cache.get(self.program, parity))
+        self.assertIsNotNone(self.cache.get(self.program, bounds))
+
+    def test_eviction_scans(self):
+        from unittest import mock
+
+        from analyze import analyze
+        from exercise03 import ParityAnalysis
+
+        analysis = ParityAnalysis()
+        with mock.patch('os.walk', side_effect=os.walk) as walk:
+            for i in range(10):
+                program = self.program + parse('inc x\n' * i)
+                self.cache.put(program, analysis, analyze(program, analysis))
+            self.assertEqual(1, walk.call_count)
+            self.cache.max_size = 0
+            self.cache.put(self.program, analysis,
+                           analyze(self.program, analysis))
+            self.assertEqual(2, walk.call_count)
+        self.assertEqual(0, self.cache._size)
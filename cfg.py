@@ -0,0 +1,259 @@
+"""Control-flow graph of 3 Counter Machine programs"""
+
+
+from collections import namedtuple
+import unittest
+
+from threecm import Inc, Dec, Zero, Stop, Analysis, parse
+
+
+class Edge(namedtuple('Edge', 'source target operation v')):
+    """Control-flow edge labeled by the name of an Analysis transfer function.
+    """
+    pass
+
+
+def var_function(f, v):
+    """Lift a transfer function of a single variable to (x, y, z) states.
+
+    :type f: (Lattice) -> Lattice
+    :type v: str
+    :rtype: ((Lattice, Lattice, Lattice)) -> (Lattice, Lattice, Lattice)
+    """
+    if v == 'x':
+        def g(states):
+            x, y, z = states
+            return f(x), y, z
+    elif v == 'y':
+        def g(states):
+            x, y, z = states
+            return x, f(y), z
+    elif v == 'z':
+        def g(states):
+            x, y, z = states
+            return x, y, f(z)
+    else:
+        raise ValueError('unknown variable: {}'.format(v))
+    return g
+
+
+def state_function(f, v):
+    """Bind the variable of a transfer function of a relational analysis.
+
+    :type f: (Lattice, str) -> Lattice
+    :type v: str
+    :rtype: (Lattice) -> Lattice
+    """
+    def g(state):
+        return f(state, v)
+    return g
+
+
+class ControlFlowGraph:
+    """Control-flow graph compiled once from a parsed program.
+
+    Program points are numbered from 1 like in the program itself, so the
+    successor and predecessor lists have an unused entry at index 0. Edges to
+    program points outside of the program are dropped since the machine fails
+    there.
+    """
+
+    def __init__(self, program):
+        """
+        :type program: list[Instruction]
+        """
+        self.program = program
+        self.size = len(program)
+        self.edges = []
+        self.successors = [[] for _ in range(self.size + 1)]
+        self.predecessors = [[] for _ in range(self.size + 1)]
+        self._transfers = {}
+        self._loop_heads = None
+        self._components = None
+        for pc, i in enumerate(program, 1):
+            if isinstance(i, Inc):
+                self._add(Edge(pc, pc + 1, 'plus_1', i.v))
+            elif isinstance(i, Dec):
+                self._add(Edge(pc, pc + 1, 'minus_1', i.v))
+            elif isinstance(i, Zero):
+                self._add(Edge(pc, i.pc1, 'is_zero', i.v))
+                self._add(Edge(pc, i.pc2, 'non_zero', i.v))
+            elif isinstance(i, Stop):
+                pass
+            else:
+                raise ValueError('unknown instruction: {}'.format(i))
+
+    def _add(self, edge):
+        if 0 < edge.target <= self.size:
+            self.edges.append(edge)
+            self.successors[edge.source].append(edge)
+            self.predecessors[edge.target].append(edge)
+
+    @property
+    def pcs(self):
+        return range(1, self.size + 1)
+
+    def loop_heads(self):
+        """Targets of back edges of a depth-first search.
+
+        The search starts at program point 1 and continues from unvisited
+        program points in order, so every cycle contains a loop head.
+
+        :rtype: frozenset[int]
+        """
+        if self._loop_heads is not None:
+            return self._loop_heads
+        new, active, done = range(3)
+        status = [new] * (self.size + 1)
+        heads = set()
+        for root in self.pcs:
+            if status[root] != new:
+                continue
+            status[root] = active
+            stack = [(root, iter(self.successors[root]))]
+            while stack:
+                pc, edges = stack[-1]
+                for edge in edges:
+                    if status[edge.target] == new:
+                        status[edge.target] = active
+                        stack.append((edge.target,
+                                      iter(self.successors[edge.target])))
+                        break
+                    elif status[edge.target] == active:
+                        heads.add(edge.target)
+                else:
+                    status[pc] = done
+                    stack.pop()
+        self._loop_heads = frozenset(heads)
+        return self._loop_heads
+
+    def components(self):
+        """Strongly connected components in topological order.
+
+        Components are computed by Tarjan's algorithm, every component lists
+        its program points in increasing order.
+
+        :rtype: list[tuple[int]]
+        """
+        if self._components is not None:
+            return self._components
+        index = [0] * (self.size + 1)
+        low = [0] * (self.size + 1)
+        on_stack = [False] * (self.size + 1)
+        stack = []
+        components = []
+        counter = 1
+        for root in self.pcs:
+            if index[root]:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = True
+            path = [(root, iter(self.successors[root]))]
+            while path:
+                pc, edges = path[-1]
+                for edge in edges:
+                    target = edge.target
+                    if not index[target]:
+                        index[target] = low[target] = counter
+                        counter += 1
+                        stack.append(target)
+                        on_stack[target] = True
+                        path.append((target, iter(self.successors[target])))
+                        break
+                    elif on_stack[target]:
+                        low[pc] = min(low[pc], index[target])
+                else:
+                    path.pop()
+                    if path:
+                        parent = path[-1][0]
+                        low[parent] = min(low[parent], low[pc])
+                    if low[pc] == index[pc]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack[member] = False
+                            component.append(member)
+                            if member == pc:
+                                break
+                        components.append(tuple(sorted(component)))
+        # Tarjan's algorithm finds components in reverse topological order
+        components.reverse()
+        self._components = components
+        return components
+
+    def transfers(self, analysis):
+        """Successors of every program point with pre-bound transfer functions.
+
+        The result is computed once per analysis and reused afterwards.
+
+        :type analysis: Analysis
+        :rtype: list[list[(int, callable)]]
+        """
+        try:
+            return self._transfers[analysis]
+        except KeyError:
+            pass
+        functions = {}
+        lift = state_function if analysis.relational else var_function
+        result = [[] for _ in range(self.size + 1)]
+        for edge in self.edges:
+            key = edge.operation, edge.v
+            if key not in functions:
+                f = getattr(analysis, edge.operation)
+                functions[key] = lift(f, edge.v)
+            result[edge.source].append((edge.target, functions[key]))
+        self._transfers[analysis] = result
+        return result
+
+
+class ControlFlowGraphTest(unittest.TestCase):
+    def test_edges(self):
+        cfg = ControlFlowGraph(parse('dec y\n'
+                                     'zero y 1 else 3\n'
+                                     'stop\n'))
+        self.assertEqual([Edge(1, 2, 'minus_1', 'y')], cfg.successors[1])
+        self.assertEqual([Edge(2, 1, 'is_zero', 'y'),
+                          Edge(2, 3, 'non_zero', 'y')], cfg.successors[2])
+        self.assertEqual([Edge(2, 1, 'is_zero', 'y')], cfg.predecessors[1])
+        self.assertEqual([], cfg.successors[3])
+
+    def test_out_of_bounds(self):
+        cfg = ControlFlowGraph(parse('zero x 1 else 5\n'))
+        self.assertEqual([Edge(1, 1, 'is_zero', 'x')], cfg.edges)
+
+    def test_loop_heads(self):
+        cfg = ControlFlowGraph(parse('zero x 5 else 2\n'
+                                     'dec x\n'
+                                     'inc y\n'
+                                     'zero z 1 else 1\n'
+                                     'stop\n'))
+        self.assertEqual({1}, cfg.loop_heads())
+        cfg = ControlFlowGraph(parse('inc y\n'
+                                     'zero y 4 else 3\n'
+                                     'zero y 3 else 2\n'
+                                     'stop\n'))
+        self.assertEqual({2, 3}, cfg.loop_heads())
+
+    def test_components(self):
+        cfg = ControlFlowGraph(parse('inc y\n'
+                                     'zero x 5 else 3\n'
+                                     'dec x\n'
+                                     'zero x 2 else 2\n'
+                                     'zero y 6 else 7\n'
+                                     'inc z\n'
+                                     'stop\n'))
+        self.assertEqual([(1,), (2, 3, 4), (5,), (6,), (7,)],
+                         cfg.components())
+
+    def test_transfers_are_reused(self):
+        cfg = ControlFlowGraph(parse('inc x\n'
+                                     'inc y\n'
+                                     'inc x\n'
+                                     'stop\n'))
+        analysis = Analysis()
+        transfers = cfg.transfers(analysis)
+        self.assertIs(transfers, cfg.transfers(analysis))
+        self.assertIs(transfers[1][0][1], transfers[3][0][1])
+        self.assertIsNot(transfers[1][0][1], transfers[2][0][1])
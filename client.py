@@ -0,0 +1,201 @@
+"""Client of the 3 Counter Machine analysis daemon
+
+Usage:
+    client [options] analyze (parity|bounds|interval|zone|all)... PATH...
+    client [options] evaluate PATH...
+    client [options] (ping|status|shutdown)
+
+Sends requests to a running `daemon` and prints the results in the same
+format as `analyze` and `exercise02`. Paths are sent to the daemon, which
+reads the programs itself and keeps them parsed while they do not change. The
+client imports no analysis code, so it starts much faster than the commands
+themselves.
+
+Options:
+    --help              Show help message
+    --socket PATH       Unix socket of the daemon, $AIWS15_SOCKET or a file
+                        in the runtime directory by default
+    --input VALUE       Input value of x (non-negative) [default: 0]
+    --compile           Compile the program to Python before running it
+    --max-steps N       Report divergence after N steps
+    --timeout SECONDS   Report divergence after the time runs out, 0 for no
+                        limit, a minute by default
+
+Analysis options:
+    --bitvector         Use the vectorized engine for finite domains
+    --scc               Solve strongly connected components one at a time
+    --stats             Print fixed point statistics as JSON to stderr
+    --format FMT        Output format, text, json, ndjson or csv
+                        [default: text]
+    --widening-delay N  Updates of a loop head before widening [default: 0]
+    --thresholds        Widen to constants of the program before infinity
+    --narrowing N       Maximum number of narrowing iterations [default: 0]
+    --no-reduction      Do not refine the components of `all` by each other
+"""
+
+
+import json
+import os
+import socket
+import sys
+
+from docopt import docopt
+
+
+ANALYSES = ('parity', 'bounds', 'interval', 'zone', 'all')
+
+# The same as in `analyze`, which is not imported to keep the client fast
+FORMATS = ('text', 'json', 'ndjson', 'csv')
+CSV_COLUMNS = ('path', 'analysis', 'pc', 'instruction', 'x', 'y', 'z',
+               'y - x', 'z - x', 'z - y')
+
+
+def default_socket():
+    """Path of the socket shared by the daemon and its clients.
+
+    :rtype: str
+    """
+    path = os.environ.get('AIWS15_SOCKET')
+    if path:
+        return path
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if directory:
+        return os.path.join(directory, 'aiws15.sock')
+    return os.path.join('/tmp', 'aiws15-{}.sock'.format(os.getuid()))
+
+
+def communicate(requests, path=None):
+    """Send requests over one connection and receive their responses.
+
+    Requests are sent at once and processed by the daemon concurrently.
+    Responses of a request are yielded as soon as all the earlier requests
+    are complete; the ones of later requests are buffered until then.
+
+    :type requests: list[dict]
+    :type path: str | None
+    :return: Indices of requests and their response messages
+    :rtype: collections.Iterator[(int, dict)]
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path or default_socket())
+        data = ''.join(json.dumps(dict(request, id=i)) + '\n'
+                       for i, request in enumerate(requests))
+        sock.sendall(data.encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        buffered = [[] for _ in requests]
+        done = [False] * len(requests)
+        current = 0
+        with sock.makefile('r', encoding='utf-8') as fd:
+            for line in fd:
+                message = json.loads(line)
+                index = message['id']
+                buffered[index].append(message)
+                done[index] = is_last(message)
+                while current < len(requests):
+                    for message in buffered[current]:
+                        yield current, message
+                    buffered[current] = []
+                    if not done[current]:
+                        break
+                    current += 1
+        if current < len(requests):
+            raise ConnectionError('connection closed by the daemon')
+
+
+def is_last(message):
+    """Whether a message is the last response to a request.
+
+    :type message: dict
+    :rtype: bool
+    """
+    return 'done' in message or 'error' in message
+
+
+def analyze_requests(opts):
+    """Requests for the `analyze` command."""
+    names = [name for name in ANALYSES if opts[name]]
+    if opts['--bitvector'] and opts['--scc']:
+        raise ValueError('--bitvector and --scc cannot be combined')
+    elif opts['--bitvector']:
+        engine = 'bitvector'
+    elif opts['--scc']:
+        engine = 'scc'
+    else:
+        engine = 'worklist'
+    if opts['--format'] not in FORMATS:
+        raise ValueError('unknown format: {}'.format(opts['--format']))
+    options = {
+        'widening_delay': int(opts['--widening-delay']),
+        'thresholds': opts['--thresholds'],
+        'narrowing_steps': int(opts['--narrowing']),
+        'reduction': not opts['--no-reduction'],
+    }
+    return [{'method': 'analyze', 'path': os.path.abspath(path),
+             'analysis': name, 'engine': engine, 'options': options,
+             'stats': opts['--stats'], 'format': opts['--format']}
+            for path in opts['PATH'] for name in names]
+
+
+def evaluate_requests(opts):
+    """Requests for the `evaluate` command."""
+    budgets = {}
+    if opts['--max-steps']:
+        budgets['max_steps'] = int(opts['--max-steps'])
+    if opts['--timeout']:
+        # The daemon applies its own time budget when there is no timeout
+        budgets['timeout'] = float(opts['--timeout']) or None
+    return [dict(budgets, method='evaluate', path=os.path.abspath(path),
+                 input=int(opts['--input']), compiled=opts['--compile'])
+            for path in opts['PATH']]
+
+
+def main(argv):
+    opts = docopt(__doc__, argv=argv)
+    if opts['analyze']:
+        requests = analyze_requests(opts)
+    elif opts['evaluate']:
+        requests = evaluate_requests(opts)
+    else:
+        method = next(m for m in ['ping', 'status', 'shutdown'] if opts[m])
+        requests = [{'method': method}]
+
+    format = requests[0].get('format', 'text')
+    headers = len(requests) > 1 and format == 'text'
+    started = set()
+    written = set()
+    failed = False
+    if format == 'csv':
+        print(','.join(CSV_COLUMNS))
+    elif format == 'json':
+        print('[')
+    for index, message in communicate(requests, opts['--socket']):
+        request = requests[index]
+        if headers and index not in started:
+            started.add(index)
+            print('==> {} ({}) <=='.format(
+                request['path'], request.get('analysis', request['method'])))
+        if 'error' in message:
+            failed = True
+            print(message['error'], file=sys.stderr)
+        elif 'lines' in message:
+            if format == 'json' and index not in written:
+                if written:
+                    print(',')
+                written.add(index)
+            print('\n'.join(message['lines']))
+        elif 'result' in message:
+            print('Result: {}'.format(message['result']))
+        elif 'status' in message:
+            print(json.dumps(message['status']))
+        if message.get('stats') is not None:
+            print(json.dumps(message['stats']), file=sys.stderr)
+        if headers and is_last(message):
+            print()
+    if format == 'json':
+        print(']')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
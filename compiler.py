@@ -0,0 +1,201 @@
+"""Compilation of 3 Counter Machine programs to Python functions
+
+A program is split into basic blocks. Every block becomes straight-line Python
+code over the local variables x, y and z, and the blocks are selected by a
+binary search over their starting program points inside a single loop.
+"""
+
+
+import functools
+import unittest
+
+from threecm import Inc, Dec, Zero, Stop, parse
+
+
+def basic_blocks(program):
+    """Split a program into basic blocks.
+
+    :type program: list[Instruction]
+    :rtype: list[(int, list[Instruction])]
+    """
+    size = len(program)
+    leaders = {1} if size else set()
+    for pc, i in enumerate(program, 1):
+        if isinstance(i, Zero):
+            leaders.update(target for target in (i.pc1, i.pc2)
+                           if 0 < target <= size)
+        if isinstance(i, (Zero, Stop)) and pc < size:
+            leaders.add(pc + 1)
+    starts = sorted(leaders)
+    ends = starts[1:] + [size + 1]
+    return [(start, program[start - 1:end - 1])
+            for start, end in zip(starts, ends)]
+
+
+# Check of a checked function on a backward jump to pc
+CHECK = ['if pc == saved_pc and x == saved_x and '
+         'y == saved_y and z == saved_z:',
+         '    return watchdog.cycle(steps)',
+         'if steps >= checkpoint:',
+         '    checkpoint = watchdog.check(steps, (pc, x, y, z))',
+         '    if checkpoint is None:',
+         '        return watchdog.result',
+         '    saved_pc, saved_x, saved_y, saved_z = watchdog.saved']
+
+
+def generate(program, checked=False):
+    """Generate the source code of a function `run(x)` for a program.
+
+    The function returns the same result as `exercise02.evaluate`. A checked
+    function `run(x, watchdog)` counts the executed instructions and checks
+    the state against the `exercise02.Watchdog` on backward jumps. Every
+    cycle of states contains a backward jump, so repeated states are still
+    detected, but budgets can be exceeded by the steps between two backward
+    jumps, which are at most the size of the program.
+
+    :type program: list[Instruction]
+    :type checked: bool
+    :rtype: str
+    """
+    size = len(program)
+    blocks = basic_blocks(program)
+
+    def jump(pc, start=None):
+        if not 0 < pc <= size:
+            return ['return None']
+        elif checked and start is not None and pc <= start:
+            return ['pc = {}'.format(pc)] + CHECK + ['continue']
+        else:
+            return ['pc = {}'.format(pc), 'continue']
+
+    def block_code(start, instructions):
+        lines = ['steps += {}'.format(len(instructions))] if checked else []
+        runs = []
+        for i in instructions:
+            # Instructions are namedtuples, so Inc('y') == Dec('y')
+            if (runs and type(runs[-1][0]) is type(i) and
+                    runs[-1][0] == i and isinstance(i, (Inc, Dec))):
+                runs[-1][1] += 1
+            else:
+                runs.append([i, 1])
+        for i, count in runs:
+            if isinstance(i, Inc):
+                lines.append('{} += {}'.format(i.v, count))
+            elif isinstance(i, Dec):
+                lines.append('if {} < {}:'.format(i.v, count))
+                lines.append('    return None')
+                lines.append('{} -= {}'.format(i.v, count))
+            elif isinstance(i, Zero):
+                lines.append('if {} == 0:'.format(i.v))
+                lines.extend('    ' + line for line in jump(i.pc1, start))
+                lines.extend(jump(i.pc2, start))
+                return lines
+            elif isinstance(i, Stop):
+                lines.append('return y')
+                return lines
+            else:
+                raise ValueError('unknown instruction: {}'.format(i))
+        return lines + jump(start + len(instructions))
+
+    def dispatch(blocks):
+        if len(blocks) == 1:
+            return block_code(*blocks[0])
+        middle = len(blocks) // 2
+        return (['if pc < {}:'.format(blocks[middle][0])] +
+                ['    ' + line for line in dispatch(blocks[:middle])] +
+                dispatch(blocks[middle:]))
+
+    lines = ['def run(x, watchdog):' if checked else 'def run(x):',
+             '    y = z = 0']
+    if blocks:
+        lines.append('    pc = 1')
+        if checked:
+            lines += ['    steps = 0',
+                      '    checkpoint = watchdog.check(0, (1, x, 0, 0))',
+                      '    if checkpoint is None:',
+                      '        return watchdog.result',
+                      '    saved_pc, saved_x, saved_y, saved_z = '
+                      'watchdog.saved']
+        lines.append('    while True:')
+        lines += ['        ' + line for line in dispatch(blocks)]
+    else:
+        lines += ['    return None']
+    return '\n'.join(lines) + '\n'
+
+
+@functools.lru_cache(maxsize=64)
+def _compile(key, checked):
+    program = [cls(*args) for cls, *args in key]
+    namespace = {}
+    exec(compile(generate(program, checked), '<3cm>', 'exec'), namespace)
+    return namespace['run']
+
+
+def compile_program(program, checked=False):
+    """Compile a program into a function of the input value of x.
+
+    Compiled functions are cached by the contents of the program.
+
+    :type program: list[Instruction]
+    :param checked: Compile a function of x and an `exercise02.Watchdog`
+    :type checked: bool
+    :rtype: (int) -> int | None
+    """
+    return _compile(tuple((type(i),) + tuple(i) for i in program), checked)
+
+
+class CompilerTest(unittest.TestCase):
+    def test_basic_blocks(self):
+        program = parse('dec y\n'
+                        'zero y 1 else 3\n'
+                        'stop\n')
+        self.assertEqual([(1, program[0:2]), (3, program[2:3])],
+                         basic_blocks(program))
+
+    def test_same_as_interpreter(self):
+        from exercise02 import Watchdog, evaluate
+
+        programs = [
+            'zero x 6 else 2\n'
+            'inc y\n'
+            'dec x\n'
+            'zero x 1 else 1\n'
+            'inc z\n'
+            'stop\n',
+            'inc z\n'
+            'zero z 3 else 4\n'
+            'inc y\n'
+            'dec z\n'
+            'stop\n',
+            'dec x\n'
+            'dec x\n'
+            'inc y\n'
+            'inc y\n'
+            'stop\n',
+            'inc x\n'
+            'zero x 5 else 7\n',
+            'inc y\n'
+            'dec y\n'
+            'inc y\n'
+            'dec x\n'
+            'inc x\n'
+            'stop\n',
+            '',
+        ]
+        for text in programs:
+            program = parse(text)
+            run = compile_program(program)
+            checked = compile_program(program, checked=True)
+            for x in range(5):
+                self.assertEqual(evaluate(program, x), run(x))
+                self.assertEqual(run(x), checked(x, Watchdog(program, x)))
+
+    def test_cache(self):
+        program = parse('inc y\n'
+                        'stop\n')
+        self.assertIs(compile_program(program),
+                      compile_program(parse('inc y\n'
+                                            'stop\n')))
+        self.assertIsNot(compile_program(program),
+                         compile_program(parse('dec y\n'
+                                               'stop\n')))
@@ -0,0 +1,548 @@
+"""Analysis daemon for 3 Counter Machine
+
+Usage:
+    daemon [options]
+
+The daemon listens on a Unix socket and serves requests of `client` and other
+tools, so that they pay neither for starting Python nor for importing the
+analyses. Programs, their control flow graphs and the results of analyses are
+kept in memory while the files they were read from do not change. Analyses
+and evaluations run in a pool of worker processes.
+
+Requests and responses are JSON objects, one per line. Every request has an
+`id`, which is copied into its responses, and a `method`:
+
+    analyze     `path` or `text` of a program, `analysis`, `engine`,
+                `options` of the interval and product analyses, `stats` and
+                `format` of the lines like in `analyze`
+    evaluate    `path` or `text` of a program, `input`, `compiled`, the
+                budgets `max_steps` and `timeout` in seconds and `cycles`
+                to detect repeated states, on by default
+    ping        Check that the daemon is running
+    status      Counters of requests and cache hits
+    shutdown    Stop the daemon
+
+Requests sent over one connection are processed concurrently. Lines of an
+analysis result are streamed in messages with `lines`. The last message of a
+request has `done` and, depending on the method, the fixed point statistics
+in `stats`, the `result` of an evaluation or the `status`. Failed requests
+get a single message with `error` instead.
+
+Options:
+    --help          Show help message
+    --socket PATH   Unix socket to listen on, $AIWS15_SOCKET or a file in the
+                    runtime directory by default
+    --workers N     Number of worker processes, 0 runs the jobs in a thread of
+                    the daemon itself, the number of CPUs by default
+    --no-cache      Do not use the persistent cache of analysis results
+    --cache-dir DIR Directory of the cache of analysis results
+"""
+
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+from docopt import docopt
+from analyze import create_analysis, format_result, run_analysis
+from cache import ResultCache
+from cfg import ControlFlowGraph
+from client import communicate, default_socket
+from exercise02 import Diverges, evaluate
+from funcutils import Statistics
+from program import Program, load
+
+
+# Programs kept parsed by every worker
+MAX_PROGRAMS = 64
+
+# Analysis results kept by the daemon
+MAX_RESULTS = 1024
+
+# Lines of an analysis result per message
+CHUNK_SIZE = 1000
+
+# Seconds an evaluation runs before it is reported to diverge, so that a
+# program that does not stop cannot occupy a worker forever
+EVALUATE_TIMEOUT = 60
+
+# Maximum size of a request line, it may contain the text of a program
+MAX_REQUEST_SIZE = 64 * 1024 * 1024
+
+
+class LRUCache:
+    """Mapping that forgets the least recently used items above its size."""
+
+    def __init__(self, max_size):
+        """
+        :type max_size: int
+        """
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, key):
+        """
+        :raise KeyError: The key is not in the cache
+        """
+        value = self._items[key]
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def source_key(request):
+    """Key of the program of a request that changes with its contents.
+
+    Files are identified by their path, modification time and size, so that
+    they do not have to be read to find a cached result.
+
+    :type request: dict
+    :rtype: tuple
+    """
+    if 'text' in request:
+        text = request['text'].encode('utf-8')
+        return 'text', hashlib.sha256(text).hexdigest()
+    elif 'path' in request:
+        path = os.path.realpath(request['path'])
+        stat = os.stat(path)
+        return 'path', path, stat.st_mtime_ns, stat.st_size
+    raise ValueError('specify a path or a text of a program')
+
+
+class Workspace:
+    """Programs, control flow graphs and analyses kept by a worker.
+
+    Analyses are kept along with their programs since the control flow graph
+    binds transfer functions once per analysis object.
+    """
+
+    def __init__(self, cache=None):
+        """
+        :type cache: ResultCache | None
+        """
+        self.cache = cache
+        self.programs = LRUCache(MAX_PROGRAMS)
+
+    def entry(self, key, request):
+        """Program, its control flow graph and its analyses by name.
+
+        :type key: tuple
+        :type request: dict
+        :rtype: (Program, ControlFlowGraph, dict[str, Analysis])
+        """
+        try:
+            return self.programs.get(key)
+        except KeyError:
+            pass
+        if key[0] == 'text':
+            lines = io.StringIO(request['text'])
+            program = Program.from_lines(lines)
+        else:
+            program = load(key[1])
+        entry = program, ControlFlowGraph(program), {}
+        self.programs.put(key, entry)
+        return entry
+
+    def analyze(self, key, request):
+        """
+        :return: Lines of the result and the statistics if requested
+        :rtype: (list[str], dict | None)
+        """
+        program, cfg, analyses = self.entry(key, request)
+        name = request['analysis']
+        options = request.get('options') or {}
+        analysis_key = name, json.dumps(options, sort_keys=True)
+        analysis = analyses.get(analysis_key)
+        if analysis is None:
+            analysis = create_analysis(name, program, options)
+            analyses[analysis_key] = analysis
+        statistics = Statistics() if request.get('stats') else None
+        cache = None if statistics is not None else self.cache
+        result = run_analysis(program, analysis,
+                              request.get('engine', 'worklist'), statistics,
+                              cache, cfg)
+        header = {'path': request.get('path'), 'analysis': name}
+        lines = list(format_result(program, result,
+                                   request.get('format', 'text'), analysis,
+                                   header))
+        if statistics is not None:
+            return lines, statistics.as_dict()
+        return lines, None
+
+    def evaluate(self, key, request):
+        """
+        :return: The value of y, None if the machine fails or a description
+            of the divergence
+        :rtype: int | str | None
+        """
+        program, _, _ = self.entry(key, request)
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = evaluate(program, request.get('input', 0),
+                              compiled=request.get('compiled', False),
+                              max_steps=request.get('max_steps'),
+                              cycles=request.get('cycles', True),
+                              timeout=request.get('timeout',
+                                                  EVALUATE_TIMEOUT))
+        return str(result) if isinstance(result, Diverges) else result
+
+
+_workspace = None
+
+
+def init_worker(cache_directory=None, use_cache=True):
+    """Create the workspace of a worker process.
+
+    :type cache_directory: str | None
+    :type use_cache: bool
+    """
+    global _workspace
+    cache = ResultCache(cache_directory) if use_cache else None
+    _workspace = Workspace(cache)
+
+
+def run_task(method, key, request):
+    return getattr(_workspace, method)(key, request)
+
+
+class Daemon:
+    """Server of requests on a Unix socket."""
+
+    def __init__(self, path=None, workers=None, cache_directory=None,
+                 use_cache=True):
+        """
+        :param path: Path of the socket, `client.default_socket` by default
+        :type path: str | None
+        :param workers: Number of worker processes, 0 for a thread of the
+            daemon, the number of CPUs by default
+        :type workers: int | None
+        :type cache_directory: str | None
+        :type use_cache: bool
+        """
+        self.path = path or default_socket()
+        self.workers = os.cpu_count() if workers is None else workers
+        self.cache_directory = cache_directory
+        self.use_cache = use_cache
+        self.results = LRUCache(MAX_RESULTS)
+        self.pending = {}
+        self.counters = {'requests': 0, 'hits': 0, 'misses': 0, 'errors': 0}
+        self._executor = None
+        self._stopped = None
+        self._loop = None
+
+    async def serve(self, ready=None):
+        """Serve requests until the daemon is stopped.
+
+        :param ready: Set once the socket accepts connections
+        :type ready: threading.Event | None
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self._remove_stale_socket()
+        if self.workers > 0:
+            # Forked workers would inherit the sockets of the connections
+            # open at the time and keep them from being closed.
+            self._executor = ProcessPoolExecutor(
+                self.workers, multiprocessing.get_context('spawn'),
+                init_worker, (self.cache_directory, self.use_cache))
+        else:
+            init_worker(self.cache_directory, self.use_cache)
+            self._executor = ThreadPoolExecutor(1)
+        server = await asyncio.start_unix_server(self.handle, self.path,
+                                                 limit=MAX_REQUEST_SIZE)
+        try:
+            if ready is not None:
+                ready.set()
+            await self._stopped.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            self._executor.shutdown(cancel_futures=True)
+            with contextlib.suppress(OSError):
+                os.remove(self.path)
+
+    def stop(self):
+        """Stop serving, can be called from any thread."""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.path):
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.path)
+            except OSError:
+                os.remove(self.path)
+            else:
+                raise RuntimeError('daemon is already running at {}'.format(
+                    self.path))
+
+    async def handle(self, reader, writer):
+        """Serve requests of a connection concurrently."""
+        def send(message):
+            writer.write(json.dumps(message).encode('utf-8') + b'\n')
+
+        tasks = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                tasks.append(asyncio.ensure_future(self.respond(line, send)))
+                await writer.drain()
+            await asyncio.gather(*tasks)
+            await writer.drain()
+        except ConnectionError:
+            for task in tasks:
+                task.cancel()
+        except asyncio.CancelledError:
+            # The daemon is stopping. The cancellation is not propagated
+            # since asyncio logs handlers of connections that end with it.
+            for task in tasks:
+                task.cancel()
+        finally:
+            writer.close()
+
+    async def respond(self, line, send):
+        """Process a request and send its responses.
+
+        :type line: bytes
+        :type send: (dict) -> None
+        """
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            self.counters['requests'] += 1
+            method = request.get('method')
+            if method == 'analyze':
+                lines, stats = await self.analyze(request)
+                for start in range(0, len(lines), CHUNK_SIZE):
+                    send({'id': request_id,
+                          'lines': lines[start:start + CHUNK_SIZE]})
+                send({'id': request_id, 'done': True, 'stats': stats})
+            elif method == 'evaluate':
+                result = await self.run('evaluate', source_key(request),
+                                        request)
+                send({'id': request_id, 'done': True, 'result': result})
+            elif method == 'ping':
+                send({'id': request_id, 'done': True})
+            elif method == 'status':
+                status = dict(self.counters, results=len(self.results),
+                              workers=self.workers)
+                send({'id': request_id, 'done': True, 'status': status})
+            elif method == 'shutdown':
+                send({'id': request_id, 'done': True})
+                self.stop()
+            else:
+                raise ValueError('unknown method: {}'.format(method))
+        except Exception as e:
+            self.counters['errors'] += 1
+            send({'id': request_id,
+                  'error': '{}: {}'.format(type(e).__name__, e)})
+
+    async def analyze(self, request):
+        """Lines of an analysis result, computed once for concurrent equal
+        requests.
+
+        :type request: dict
+        :rtype: (list[str], dict | None)
+        """
+        source = source_key(request)
+        if request.get('stats'):
+            return await self.run('analyze', source, request)
+        key = (source, request['analysis'], request.get('engine', 'worklist'),
+               json.dumps(request.get('options') or {}, sort_keys=True),
+               request.get('format', 'text'), request.get('path'))
+        try:
+            result = self.results.get(key)
+        except KeyError:
+            pass
+        else:
+            self.counters['hits'] += 1
+            return result
+        future = self.pending.get(key)
+        if future is None:
+            self.counters['misses'] += 1
+            future = asyncio.ensure_future(self.run('analyze', source,
+                                                    request))
+            self.pending[key] = future
+            try:
+                result = await future
+            finally:
+                del self.pending[key]
+            self.results.put(key, result)
+            return result
+        self.counters['hits'] += 1
+        return await asyncio.shield(future)
+
+    async def run(self, method, key, request):
+        return await self._loop.run_in_executor(self._executor, run_task,
+                                                method, key, request)
+
+
+def main(argv):
+    opts = docopt(__doc__, argv=argv)
+    workers = opts['--workers']
+    daemon = Daemon(opts['--socket'],
+                    None if workers is None else int(workers),
+                    opts['--cache-dir'], not opts['--no-cache'])
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, daemon.stop)
+        await daemon.serve()
+
+    asyncio.run(serve())
+
+
+class DaemonTest(unittest.TestCase):
+    workers = 0
+
+    text = ('zero x 6 else 2\n'
+            'inc y\n'
+            'dec x\n'
+            'zero x 1 else 1\n'
+            'inc z\n'
+            'stop\n')
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'program.3cm')
+        with open(self.path, 'w') as fd:
+            fd.write(self.text)
+        self.daemon = Daemon(os.path.join(self.directory.name, 'socket'),
+                             workers=self.workers, use_cache=False)
+        ready = threading.Event()
+        self.thread = threading.Thread(
+            target=lambda: asyncio.run(self.daemon.serve(ready)))
+        self.thread.start()
+        ready.wait()
+
+    def tearDown(self):
+        self.daemon.stop()
+        self.thread.join()
+        self.directory.cleanup()
+
+    def request(self, *requests):
+        messages = [[] for _ in requests]
+        for index, message in communicate(list(requests), self.daemon.path):
+            messages[index].append(message)
+        return messages
+
+    def test_analyze(self):
+        from analyze import analyze_file
+
+        lines, _ = analyze_file(self.path, 'interval')
+        expected = list(lines)
+        request = {'method': 'analyze', 'path': self.path,
+                   'analysis': 'interval'}
+        first, second, text = self.request(
+            request, request, dict(request, path=None, text=self.text))
+        for messages in [first, second]:
+            self.assertEqual(expected, messages[0]['lines'])
+            self.assertTrue(messages[-1]['done'])
+        self.assertEqual(first[0]['lines'], second[0]['lines'])
+        self.assertEqual(expected, text[0]['lines'])
+        (status,), = self.request({'method': 'status'})
+        # The text is a different source than the file
+        self.assertEqual(2, status['status']['misses'])
+        self.assertEqual(1, status['status']['hits'])
+
+    def test_changed_file(self):
+        request = {'method': 'analyze', 'path': self.path,
+                   'analysis': 'parity'}
+        (before, _), = self.request(request)
+        with open(self.path, 'w') as fd:
+            fd.write('inc y\nstop\n')
+        (after, _), = self.request(request)
+        self.assertNotEqual(before, after)
+        self.assertEqual(2, len(after['lines']))
+
+    def test_evaluate_and_errors(self):
+        messages = self.request(
+            {'method': 'evaluate', 'path': self.path, 'input': 3},
+            {'method': 'analyze', 'text': 'inc w\n', 'analysis': 'parity'},
+            {'method': 'unknown'})
+        self.assertEqual(3, messages[0][0]['result'])
+        (message,), = self.request({'method': 'evaluate', 'max_steps': 10,
+                                    'text': 'inc y\nzero y 1 else 1\n'})
+        self.assertEqual('diverges: no result after 10 steps',
+                         message['result'])
+        self.assertIn('ParseError', messages[1][0]['error'])
+        self.assertIn('unknown method', messages[2][0]['error'])
+
+    def test_client_timeout(self):
+        import client
+
+        path = os.path.join(self.directory.name, 'loop.3cm')
+        with open(path, 'w') as fd:
+            fd.write('inc y\nzero y 1 else 1\n')
+        opts = docopt(client.__doc__, argv=['evaluate', '--timeout', '0',
+                                            '--max-steps', '1000', path])
+        request, = client.evaluate_requests(opts)
+        self.assertIsNone(request['timeout'])
+        (message,), = self.request(request)
+        self.assertEqual('diverges: no result after 1000 steps',
+                         message['result'])
+
+    def test_client_format(self):
+        import analyze
+        import client
+
+        output = os.path.join(self.directory.name, 'output')
+        for format in ['json', 'csv']:
+            argv = ['--format', format, 'parity', 'interval', self.path]
+            analyze.main(['--no-cache', '--output', output] + argv)
+            with open(output) as fd:
+                expected = fd.read()
+            buffer = io.StringIO()
+            with contextlib.redirect_stdout(buffer):
+                client.main(['--socket', self.daemon.path, 'analyze'] + argv)
+            self.assertEqual(expected, buffer.getvalue())
+        self.assertEqual(analyze.CSV_COLUMNS, client.CSV_COLUMNS)
+        self.assertEqual(analyze.FORMATS, client.FORMATS)
+
+    def test_shutdown(self):
+        self.assertEqual([[{'id': 0, 'done': True}]],
+                         self.request({'method': 'ping'}))
+        # A connection that is still open when the daemon stops
+        idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        idle.connect(self.daemon.path)
+        with idle, self.assertNoLogs('asyncio'):
+            self.assertEqual([[{'id': 0, 'done': True}]],
+                             self.request({'method': 'shutdown'}))
+            self.thread.join(10)
+        self.assertFalse(self.thread.is_alive())
+        self.assertFalse(os.path.exists(self.daemon.path))
+
+
+class ProcessDaemonTest(DaemonTest):
+    """The same requests served by a pool of worker processes."""
+
+    workers = 2
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -5,7 +5,8 @@ http://janmidtgaard.dk/aiws15/exercises1.pdf
 
 
 import unittest
-from funcutils import FixedPointNotReached, fixed_point
+from funcutils import (FixedPointNotReached, MAX_RECURSIONS, Statistics,
+                       fixed_point)
 
 
 # 1. Give an example of a transition system that converges (i.e., reaches a
@@ -107,6 +108,71 @@ class ReachingStates:
                       for new_state in self.transition_system.next(state)}
         return self.transition_system.init_states | new_states
 
+    def reachable(self, max_states=None, max_depth=MAX_RECURSIONS,
+                  stats=None):
+        """Reachable states computed by expanding only newly found states.
+
+        Gives the same result as `fixed_point(self.transition)(set())`, but
+        every state is passed to `next` once instead of once per round.
+
+        :param max_states: Maximum number of reachable states
+        :type max_states: int | None
+        :param max_depth: Maximum number of transitions from initial states
+        :type max_depth: int | None
+        :type stats: Statistics | None
+        :rtype: set[T]
+        """
+        return reachable_states(self.transition_system, max_states,
+                                max_depth, stats)
+
+
+def reachable_states(transition_system, max_states=None,
+                     max_depth=MAX_RECURSIONS, stats=None):
+    """Semi-naive computation of reachable states of a transition system.
+
+    Every round expands only the frontier of states discovered in the
+    previous round.
+
+    :type transition_system: TransitionSystem
+    :param max_states: Maximum number of reachable states
+    :type max_states: int | None
+    :param max_depth: Maximum number of transitions from initial states
+    :type max_depth: int | None
+    :type stats: Statistics | None
+    :rtype: set[T]
+    :raise FixedPointNotReached: The states exceed one of the budgets
+    """
+    next = transition_system.next
+    seen = set(transition_system.init_states)
+    if max_states is not None and len(seen) > max_states:
+        raise FixedPointNotReached(seen)
+    frontier = list(seen)
+    depth = 0
+    if stats is not None:
+        stats.start()
+    while frontier:
+        # The states are complete at the depth limit if the frontier has no
+        # new successors
+        if max_depth is not None and depth >= max_depth:
+            if any(new_state not in seen
+                   for state in frontier for new_state in next(state)):
+                raise FixedPointNotReached(seen)
+            break
+        new_states = []
+        for state in frontier:
+            for new_state in next(state):
+                if new_state not in seen:
+                    seen.add(new_state)
+                    new_states.append(new_state)
+                    if max_states is not None and len(seen) > max_states:
+                        raise FixedPointNotReached(seen)
+        if stats is not None:
+            stats.transfers += len(frontier)
+            stats.iteration(len(new_states))
+        frontier = new_states
+        depth += 1
+    return seen
+
 
 class Test(unittest.TestCase):
     def test_converging_transition_system(self):
@@ -115,6 +181,13 @@ class Test(unittest.TestCase):
         self.assertEqual((0, 1, 0, 0), f((0, 1, 0, 0)))
         self.assertEqual((5, 8, 5, 5), f((0, 1, 0, 5)))
 
+    def test_statistics(self):
+        stats = Statistics()
+        fixed_point(fibonacci_transitions, stats)((0, 1, 0, 5))
+        self.assertEqual(6, stats.iterations)
+        self.assertEqual([1, 1, 1, 1, 1, 0], stats.changes)
+        self.assertEqual(6, len(stats.iteration_times))
+
     def test_converging_reachable_states(self):
         self.assertRaises(FixedPointNotReached, fixed_point(invert), (1,))
 
@@ -126,3 +199,44 @@ class Test(unittest.TestCase):
 
         f = fixed_point(ReachingStates(IncrementTransitions).transition)
         self.assertRaises(FixedPointNotReached, f, set())
+
+    def test_semi_naive_reachable_states(self):
+        class Counter(TransitionSystem):
+            init_states = {(0, 0)}
+
+            @staticmethod
+            def next(state):
+                x, y = state
+                return {((x + 1) % 10, y), (x, (y + 1) % 7)}
+
+        for system in [InvertTransitions, Counter]:
+            reaching = ReachingStates(system)
+            self.assertEqual(fixed_point(reaching.transition)(set()),
+                             reaching.reachable())
+        stats = Statistics()
+        self.assertEqual(70, len(reachable_states(Counter, stats=stats)))
+        self.assertEqual(70, stats.transfers)
+
+        reaching = ReachingStates(Counter)
+        self.assertRaises(FixedPointNotReached, reaching.reachable,
+                          max_states=69)
+        self.assertEqual(70, len(reaching.reachable(max_states=70)))
+        self.assertRaises(FixedPointNotReached, reaching.reachable,
+                          max_depth=5)
+        # The farthest state (9, 6) is 15 transitions away
+        self.assertRaises(FixedPointNotReached, reaching.reachable,
+                          max_depth=14)
+        self.assertEqual(70, len(reaching.reachable(max_depth=15)))
+
+        class Fan(TransitionSystem):
+            init_states = {0}
+
+            @staticmethod
+            def next(state):
+                return range(1, 1001) if state == 0 else ()
+
+        with self.assertRaises(FixedPointNotReached) as context:
+            reachable_states(Fan, max_states=10)
+        self.assertEqual(11, len(context.exception.args[0]))
+        self.assertRaises(FixedPointNotReached,
+                          ReachingStates(IncrementTransitions).reachable)
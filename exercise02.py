@@ -5,17 +5,27 @@ Usage:
 
 
 Options:
-    --input VALUE   Input value of x (non-negative) [default: 0]
-    --trace         Trace machine execution
-    --help          Show help message
+    --input VALUE       Input value of x (non-negative) [default: 0]
+    --trace             Trace machine execution
+    --trace-file PATH   Record the trace to a binary file viewed by `tracer`
+    --trace-every N     Record every N-th step to the trace file [default: 1]
+    --trace-last N      Write only the last N records of the trace file
+    --compile           Compile the program to Python before running it
+    --max-steps N       Report divergence after N steps
+    --timeout SECONDS   Report divergence after the time runs out, 0 for no
+                        limit [default: 60]
+    --no-cycles         Do not detect repeated states
+    --help              Show help message
 """
 
+from collections import namedtuple
+import time
 import unittest
 import sys
 
 from docopt import docopt
-from exercise03 import Top, Odd, Even, Bottom
-from threecm import Inc, Dec, Zero, Stop, parse
+from program import Program, load
+from threecm import Inc, Dec, Zero, Stop
 
 
 def check_pc_out_of_bounds(program):
@@ -29,16 +39,207 @@ def check_pc_out_of_bounds(program):
     return all(valid(i) for i in program)
 
 
-def evaluate(program, input, trace=False):
+class Cycle(namedtuple('Cycle', 'start length state')):
+    """The state (pc, x, y, z) first reached after `start` steps that is
+    reached again every `length` steps."""
+
+
+class Diverges(namedtuple('Diverges', 'reason steps cycle')):
+    """Result of a run that does not stop.
+
+    `reason` is 'cycle' if a state repeats, 'steps' or 'time' if the step
+    or time budget ran out first. `steps` is the number of executed steps
+    and `cycle` is the Cycle for 'cycle' or None.
+    """
+
+    def __str__(self):
+        if self.cycle is not None:
+            return ('diverges: state {} repeats every {} steps from step '
+                    '{}'.format(self.cycle.state, self.cycle.length,
+                                self.cycle.start))
+        elif self.reason == 'time':
+            return 'diverges: timed out after {} steps'.format(self.steps)
+        return 'diverges: no result after {} steps'.format(self.steps)
+
+
+CLOCK_INTERVAL = 1 << 16
+
+
+class Watchdog(object):
+    """Step and time budgets and cycle detection of a run.
+
+    Runs are deterministic, so a run diverges if its state repeats. The
+    cycle is detected with Brent's algorithm in constant memory: the state
+    is saved at steps 0, 1, 2, 4, ... and the run loops if a later state
+    is equal to the saved one. Runs compare their state with `saved` on
+    backward jumps and call `check` there only when the step count reaches
+    the returned checkpoint. Every cycle of states contains a backward jump,
+    so no cycle is missed, but budgets can be exceeded by the steps between
+    two backward jumps, which are at most the size of the program.
+    """
+
+    def __init__(self, program, input, max_steps=None, timeout=None,
+                 cycles=True):
+        """
+        :type program: list[Instruction]
+        :type input: int
+        :type max_steps: int | None
+        :param timeout: Time budget in seconds
+        :type timeout: float | None
+        :param cycles: Detect repeated states
+        :type cycles: bool
+        """
+        self.program = program
+        self.input = input
+        self.max_steps = max_steps
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.monotonic() + timeout
+        self.cycles = cycles
+        # No state has pc 0, so nothing matches before the first save
+        self.saved = (0, 0, 0, 0)
+        self.saved_step = 0
+        self.result = None
+        self._next_save = 0 if cycles else None
+        self._next_clock = 0 if timeout is not None else None
+
+    def check(self, steps, state):
+        """Check the budgets and save the state for cycle detection.
+
+        :type steps: int
+        :type state: (int, int, int, int)
+        :return: The step of the next check or None if the run diverges
+        :rtype: int | None
+        """
+        if self.max_steps is not None and steps >= self.max_steps:
+            self.result = Diverges('steps', steps, None)
+            return None
+        if self._next_clock is not None and steps >= self._next_clock:
+            if time.monotonic() >= self.deadline:
+                self.result = Diverges('time', steps, None)
+                return None
+            self._next_clock = steps + CLOCK_INTERVAL
+        if self._next_save is not None and steps >= self._next_save:
+            self.saved, self.saved_step = state, steps
+            self._next_save = max(2 * steps, 1)
+        checkpoints = [c for c in (self.max_steps, self._next_clock,
+                                   self._next_save) if c is not None]
+        return min(checkpoints) if checkpoints else float('inf')
+
+    def cycle(self, steps):
+        """Result of a run whose state after `steps` steps is the saved one.
+
+        :type steps: int
+        :rtype: Diverges
+        """
+        length = steps - self.saved_step
+        start, state = cycle_start(self.program, (1, self.input, 0, 0),
+                                   length)
+        self.result = Diverges('cycle', steps, Cycle(start, length, state))
+        return self.result
+
+
+def successor(program, state):
+    """The state after executing one instruction.
+
+    :type program: list[Instruction]
+    :type state: (int, int, int, int)
+    :return: The next state or None if the machine stops or fails
+    :rtype: (int, int, int, int) | None
+    """
+    pc, x, y, z = state
+    if pc > len(program) or pc <= 0:
+        return None
+    i = program[pc - 1]
+    values = {'x': x, 'y': y, 'z': z}
+    if isinstance(i, Inc):
+        values[i.v] += 1
+        pc += 1
+    elif isinstance(i, Dec) and values[i.v] > 0:
+        values[i.v] -= 1
+        pc += 1
+    elif isinstance(i, Zero):
+        pc = i.pc1 if values[i.v] == 0 else i.pc2
+    else:
+        return None
+    return pc, values['x'], values['y'], values['z']
+
+
+def cycle_start(program, state, length):
+    """The first state of a cycle of a known length and its step.
+
+    Runs a second copy of the machine `length` steps ahead until both are in
+    the same state.
+
+    :type program: list[Instruction]
+    :param state: Initial state
+    :type state: (int, int, int, int)
+    :type length: int
+    :rtype: (int, (int, int, int, int))
+    """
+    ahead = state
+    for _ in range(length):
+        ahead = successor(program, ahead)
+    start = 0
+    while state != ahead:
+        state = successor(program, state)
+        ahead = successor(program, ahead)
+        start += 1
+    return start, state
+
+
+def evaluate(program, input, trace=False, compiled=False, tracer=None,
+             max_steps=None, timeout=None, cycles=False):
+    """Run a program.
+
+    Without budgets and cycle detection the run is not checked at all. A
+    program whose registers grow forever never repeats a state, so only the
+    budgets stop it.
+
+    :param trace: Print every executed state and instruction
+    :type trace: bool
+    :param tracer: Recorder of executed states, see `tracer.Tracer`
+    :type tracer: tracer.Tracer | None
+    :param max_steps: Step budget
+    :type max_steps: int | None
+    :param timeout: Time budget in seconds
+    :type timeout: float | None
+    :param cycles: Detect repeated states
+    :type cycles: bool
+    :return: The value of y, None if the machine fails or Diverges
+    :rtype: int | Diverges | None
+    """
     print('Running with input {}'.format(input))
+    watchdog = None
+    if cycles or max_steps is not None or timeout is not None:
+        watchdog = Watchdog(program, input, max_steps, timeout, cycles)
+    if compiled:
+        if trace or tracer is not None:
+            raise ValueError('compiled programs cannot be traced')
+        from compiler import compile_program
+        if watchdog is None:
+            return compile_program(program)(input)
+        return compile_program(program, checked=True)(input, watchdog)
+    if isinstance(program, Program):
+        # Instructions of a Program are created on every access
+        program = list(program)
     pc = 1
     x, y, z = input, 0, 0
+    if watchdog is not None:
+        # Steps are counted per straight run of instructions from `start`
+        steps, start = 0, 1
+        checkpoint = watchdog.check(0, (pc, x, y, z))
+        if checkpoint is None:
+            return watchdog.result
+        saved_pc, saved_x, saved_y, saved_z = watchdog.saved
     while True:
         if trace:
             print('Trace: ({}, {}, {}, {})'.format(pc, x, y, z))
         if pc > len(program) or pc <= 0:
             return None
         i = program[pc - 1]
+        if tracer is not None:
+            tracer.record(pc, x, y, z)
         if trace:
             print('Instruction: {}'.format(i))
         if isinstance(i, Stop):
@@ -65,29 +266,118 @@ def evaluate(program, input, trace=False):
             pc += 1
         elif isinstance(i, Zero):
             if i.v == 'x':
-                pc = i.pc1 if x == 0 else i.pc2
+                target = i.pc1 if x == 0 else i.pc2
             elif i.v == 'y':
-                pc = i.pc1 if y == 0 else i.pc2
+                target = i.pc1 if y == 0 else i.pc2
             elif i.v == 'z':
-                pc = i.pc1 if z == 0 else i.pc2
+                target = i.pc1 if z == 0 else i.pc2
             else:
                 return None
+            # Every cycle of states contains a backward jump, so the state
+            # is only checked on them
+            if watchdog is not None:
+                steps += pc - start + 1
+                start = target
+                if 0 < target <= pc:
+                    if (target == saved_pc and x == saved_x and
+                            y == saved_y and z == saved_z):
+                        return watchdog.cycle(steps)
+                    if steps >= checkpoint:
+                        checkpoint = watchdog.check(steps, (target, x, y, z))
+                        if checkpoint is None:
+                            return watchdog.result
+                        saved_pc, saved_x, saved_y, saved_z = watchdog.saved
+            pc = target
         else:
             return None
 
 
 class ParityTest(unittest.TestCase):
     def test_le(self):
+        from exercise03 import Top, Odd, Even, Bottom
+
         self.assertLess(Bottom(), Even())
         self.assertGreater(Top(), Odd())
 
+    def test_interned(self):
+        from exercise03 import Top, Odd, Even, ParityAnalysis
+
+        self.assertIs(Even(), Even())
+        self.assertIs(Top(), Odd().join(Even()))
+        self.assertIs(Odd(), ParityAnalysis.plus_1(Even()))
+        self.assertNotEqual(Odd(), Even())
+
+
+class DivergenceTest(unittest.TestCase):
+    def quiet_evaluate(self, *args, **kwargs):
+        import contextlib
+        import io
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            return evaluate(*args, **kwargs)
+
+    def test_cycle(self):
+        from threecm import parse
+
+        # x is counted down to 0 and then the last three instructions loop
+        program = parse('zero x 4 else 2\n'
+                        'dec x\n'
+                        'zero x 4 else 2\n'
+                        'zero z 5 else 5\n'
+                        'zero y 3 else 3\n')
+        for compiled in [False, True]:
+            result = self.quiet_evaluate(program, 3, compiled=compiled,
+                                         cycles=True)
+            self.assertIsInstance(result, Diverges)
+            self.assertEqual('cycle', result.reason)
+            self.assertEqual(Cycle(6, 3, (3, 0, 0, 0)), result.cycle)
+            self.assertIsNone(self.quiet_evaluate(program, 3, cycles=False,
+                                                  max_steps=10 ** 6,
+                                                  compiled=compiled)
+                              .cycle)
+
+    def test_budgets(self):
+        from threecm import parse
+
+        # y grows forever, so no state repeats
+        program = parse('inc y\n'
+                        'zero y 1 else 1\n'
+                        'stop\n')
+        for compiled in [False, True]:
+            result = self.quiet_evaluate(program, 0, max_steps=1000,
+                                         compiled=compiled)
+            self.assertEqual('steps', result.reason)
+            self.assertEqual(1000, result.steps)
+            result = self.quiet_evaluate(program, 0, timeout=0.01,
+                                         compiled=compiled)
+            self.assertEqual('time', result.reason)
+        self.assertEqual(3, self.quiet_evaluate(parse('inc y\n' * 3 +
+                                                      'stop\n'),
+                                                0, max_steps=4))
+
 
 def main(argv):
     opts = docopt(__doc__, argv=argv)
-    with open(opts['PATH'], 'r') as fd:
-        data = fd.read()
-    program = parse(data)
-    result = evaluate(program, int(opts['--input']), trace=opts['--trace'])
+    program = load(opts['PATH'])
+    tracer = None
+    if opts['--trace-file']:
+        from tracer import DEFAULT_CAPACITY, Tracer
+
+        last = opts['--trace-last']
+        tracer = Tracer(len(program), int(last or DEFAULT_CAPACITY),
+                        every=int(opts['--trace-every']),
+                        path=opts['--trace-file'], ring=last is not None)
+    max_steps, timeout = opts['--max-steps'], opts['--timeout']
+    try:
+        result = evaluate(program, int(opts['--input']),
+                          trace=opts['--trace'], compiled=opts['--compile'],
+                          tracer=tracer,
+                          max_steps=int(max_steps) if max_steps else None,
+                          timeout=float(timeout) or None,
+                          cycles=not opts['--no-cycles'])
+    finally:
+        if tracer is not None:
+            tracer.close()
     print('Result: {}'.format(result))
 
 
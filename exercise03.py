@@ -1,10 +1,12 @@
 import functools
-from funcutils import Lattice
+from funcutils import FiniteLattice, tabulate
 from threecm import Analysis
 
 
 @functools.total_ordering
-class Parity(Lattice):
+class Parity(FiniteLattice):
+    __slots__ = ()
+
     @property
     def bottom(self):
         return Bottom()
@@ -15,12 +17,11 @@ class Parity(Lattice):
     def join(self, other):
         pass
 
-    def __eq__(self, other):
-        return type(self) == type(other)
-
 
 @functools.total_ordering
 class Top(Parity):
+    __slots__ = ()
+
     def __le__(self, other):
         return isinstance(other, Top)
 
@@ -33,6 +34,8 @@ class Top(Parity):
 
 @functools.total_ordering
 class Odd(Parity):
+    __slots__ = ()
+
     def __le__(self, other):
         return isinstance(other, (Bottom, Odd))
 
@@ -48,6 +51,8 @@ class Odd(Parity):
 
 @functools.total_ordering
 class Even(Parity):
+    __slots__ = ()
+
     def __le__(self, other):
         return isinstance(other, (Bottom, Even))
 
@@ -63,6 +68,8 @@ class Even(Parity):
 
 @functools.total_ordering
 class Bottom(Parity):
+    __slots__ = ()
+
     def __le__(self, other):
         return True
 
@@ -77,6 +84,10 @@ class ParityAnalysis(Analysis):
     bottom = Bottom()
     initial = Top(), Even(), Even()
 
+    @staticmethod
+    def abstract(n):
+        return Even() if n % 2 == 0 else Odd()
+
     @staticmethod
     def non_zero(p: Parity) -> Parity:
         return p
@@ -108,3 +119,6 @@ class ParityAnalysis(Analysis):
             raise TypeError('not a Parity element: {!r}'.format(p))
 
     minus_1 = plus_1
+
+
+tabulate(Parity, ParityAnalysis)
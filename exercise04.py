@@ -1,27 +1,34 @@
 """Interval analysis of 3 Counter Machine"""
 
 
-from functools import total_ordering
+import bisect
+from collections import namedtuple
+from functools import lru_cache, total_ordering
 from numbers import Number
-from funcutils import Lattice
-from threecm import Analysis
+import unittest
+
+from funcutils import Lattice, encode_number
+from threecm import Analysis, Inc, Dec, parse
 
 
 @total_ordering
-class Interval(Lattice):
-    def __init__(self, left, right):
-        self.left = left
-        self.right = right
+class Interval(Lattice, namedtuple('Interval', 'left right')):
+    __slots__ = ()
+
+    # Compare as lattice elements, not lexicographically as tuples
+    __lt__, __gt__, __ge__ = Lattice.__lt__, Lattice.__gt__, Lattice.__ge__
 
+    @property
     def bottom(self):
         return Bottom()
 
     def join(self, other):
-        if isinstance(other, Bottom):
+        if type(other) is Bottom:
             return self
-        else:
-            return Interval(min(self.left, other.left),
-                            max(self.right, other.right))
+        left, right = self.left, self.right
+        if other.left >= left and other.right <= right:
+            return self
+        return Interval(min(left, other.left), max(right, other.right))
 
     def __le__(self, other):
         if isinstance(other, Bottom):
@@ -32,20 +39,47 @@ class Interval(Lattice):
             return False
 
     def __eq__(self, other):
-        return (super().__eq__(other) and self.left == other.left and
-                self.right == other.right)
+        return self is other or (type(self) is type(other) and
+                                 self.left == other.left and
+                                 self.right == other.right)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = tuple.__hash__
 
-    def widen(self, other):
+    def widen(self, other, thresholds=()):
+        """Widen to the nearest thresholds or to infinity.
+
+        :type other: Interval
+        :param thresholds: Sorted bounds to try before infinity
+        :type thresholds: collections.Sequence[int]
+        """
         if isinstance(other, Bottom):
             return self
-        else:
-            left = float('-inf') if other.left < self.left else self.left
-            right = float('+inf') if other.right > self.right else self.right
-            return Interval(left, right)
+        left, right = self.left, self.right
+        if other.left < self.left:
+            i = bisect.bisect_right(thresholds, other.left)
+            left = thresholds[i - 1] if i > 0 else float('-inf')
+        if other.right > self.right:
+            i = bisect.bisect_left(thresholds, other.right)
+            right = thresholds[i] if i < len(thresholds) else float('+inf')
+        return Interval(left, right)
+
+    def narrow(self, other):
+        """Refine infinite bounds by the bounds of a smaller interval."""
+        if isinstance(other, Bottom):
+            return other
+        left = other.left if self.left == float('-inf') else self.left
+        right = other.right if self.right == float('+inf') else self.right
+        return Interval(left, right)
 
     def __repr__(self):
         return 'Interval({}, {})'.format(self.left, self.right)
 
+    def to_json(self):
+        return [encode_number(self.left), encode_number(self.right)]
+
     def __contains__(self, x):
         if isinstance(x, Number):
             return self.left <= x <= self.right
@@ -53,8 +87,23 @@ class Interval(Lattice):
 
 @total_ordering
 class Bottom(Interval):
-    def __init__(self):
-        super().__init__(0, 0)
+    """The empty interval, a single shared instance."""
+
+    __slots__ = ()
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls, 0, 0)
+        return cls._instance
+
+    def __eq__(self, other):
+        return self is other
+
+    __hash__ = object.__hash__
+
+    def __reduce__(self):
+        return Bottom, ()
 
     def join(self, other):
         return other
@@ -65,21 +114,70 @@ class Bottom(Interval):
     def __repr__(self):
         return 'Bottom()'
 
+    def to_json(self):
+        return 'Bottom'
+
     def __contains__(self, item):
         return False
 
-    def widen(self, other):
+    def widen(self, other, thresholds=()):
         return other
 
+    def narrow(self, other):
+        return self
+
 
 top = Interval(float('-inf'), float('+inf'))
+zero = Interval(0, 0)
+
+
+def program_thresholds(program):
+    """Widening thresholds for the constants of a program.
+
+    3CM programs have no literals, so the constants are the numbers of
+    consecutive increments and decrements of a variable, and 0.
+
+    :type program: list[Instruction]
+    :rtype: tuple[int]
+    """
+    thresholds = {0}
+    previous, count = None, 0
+    for i in program:
+        if (isinstance(i, (Inc, Dec)) and type(i) is type(previous) and
+                i == previous):
+            count += 1
+        else:
+            count = 1
+        if isinstance(i, (Inc, Dec)):
+            thresholds.add(count if isinstance(i, Inc) else -count)
+        previous = i if isinstance(i, (Inc, Dec)) else None
+    return tuple(sorted(thresholds))
 
 
 class IntervalAnalysis(Analysis):
     bottom = Bottom()
     initial = top, Interval(0, 0), Interval(0, 0)
 
+    def __init__(self, widening_delay=0, thresholds=(), narrowing_steps=0):
+        """
+        :param widening_delay: Number of updates of a loop head before
+            widening
+        :type widening_delay: int
+        :param thresholds: Bounds to widen to before infinity
+        :type thresholds: collections.Iterable[int]
+        :param narrowing_steps: Maximum number of narrowing iterations
+        :type narrowing_steps: int
+        """
+        self.widening_delay = widening_delay
+        self.thresholds = tuple(sorted(thresholds))
+        self.narrowing_steps = narrowing_steps
+
+    @staticmethod
+    def abstract(n):
+        return Interval(n, n)
+
     @staticmethod
+    @lru_cache(maxsize=4096)
     def non_zero(x: Interval) -> Interval:
         if 0 in x:
             return top
@@ -88,18 +186,34 @@ class IntervalAnalysis(Analysis):
 
     @staticmethod
     def is_zero(x: Interval) -> Interval:
-        return Interval(0, 0)
+        return zero
 
     @staticmethod
+    @lru_cache(maxsize=4096)
     def minus_1(x: Interval) -> Interval:
         return Interval(x.left - 1, x.right - 1)
 
     @staticmethod
+    @lru_cache(maxsize=4096)
     def plus_1(x: Interval) -> Interval:
         return Interval(x.left + 1, x.right + 1)
 
+    def widen(self, previous, next):
+        """
+        :type previous: dict[int, (Interval, Interval, Interval)]
+        :type next: dict[int, (Interval, Interval, Interval)]
+        :rtype: dict[int, (Interval, Interval, Interval)]
+        """
+        t = self.thresholds
+        result = {}
+        for pc, (x_1, y_1, z_1) in previous.items():
+            x_2, y_2, z_2 = next[pc]
+            result[pc] = (x_1.widen(x_2, t), y_1.widen(y_2, t),
+                          z_1.widen(z_2, t))
+        return result
+
     @staticmethod
-    def widen(previous, next):
+    def narrow(previous, next):
         """
         :type previous: dict[int, (Interval, Interval, Interval)]
         :type next: dict[int, (Interval, Interval, Interval)]
@@ -108,5 +222,50 @@ class IntervalAnalysis(Analysis):
         result = {}
         for pc, (x_1, y_1, z_1) in previous.items():
             x_2, y_2, z_2 = next[pc]
-            result[pc] = x_1.widen(x_2), y_1.widen(y_2), z_1.widen(z_2)
+            result[pc] = x_1.narrow(x_2), y_1.narrow(y_2), z_1.narrow(z_2)
         return result
+
+
+class IntervalTest(unittest.TestCase):
+    def test_immutable(self):
+        import pickle
+
+        self.assertIs(Bottom(), Bottom())
+        self.assertIs(Bottom(), pickle.loads(pickle.dumps(Bottom())))
+        self.assertEqual(top, pickle.loads(pickle.dumps(top)))
+        self.assertEqual(1, len({Interval(0, 1), Interval(0, 1)}))
+        self.assertNotEqual(Bottom(), Interval(0, 0))
+        self.assertLess(Interval(0, 1), Interval(-1, 2))
+        self.assertFalse(hasattr(top, '__dict__'))
+        with self.assertRaises(AttributeError):
+            top.left = 0
+
+    def test_widen_to_thresholds(self):
+        self.assertEqual(Interval(0, 5),
+                         Interval(0, 1).widen(Interval(0, 3), (0, 5, 10)))
+        self.assertEqual(Interval(-1, float('inf')),
+                         Interval(0, 1).widen(Interval(-1, 11), (-1, 5, 10)))
+
+    def test_narrow(self):
+        self.assertEqual(Interval(0, 7),
+                         Interval(0, float('inf')).narrow(Interval(1, 7)))
+        self.assertEqual(Interval(0, 3),
+                         Interval(0, 3).narrow(Interval(1, 2)))
+
+    def test_thresholds(self):
+        self.assertEqual((-1, 0, 1, 2, 3),
+                         program_thresholds(parse('inc y\n'
+                                                  'inc y\n'
+                                                  'inc y\n'
+                                                  'dec y\n'
+                                                  'stop\n')))
+
+    def test_no_widening_outside_loops(self):
+        from analyze import analyze
+
+        result = analyze(parse('inc z\n'
+                               'zero z 3 else 4\n'
+                               'inc y\n'
+                               'dec z\n'
+                               'stop\n'), IntervalAnalysis())
+        self.assertEqual((top, Interval(0, 1), Interval(-1, 0)), result[5])
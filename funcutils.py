@@ -1,5 +1,7 @@
 from abc import abstractmethod, ABCMeta
 import functools
+import json
+import time
 
 MAX_RECURSIONS = 1000
 
@@ -8,11 +10,88 @@ class FixedPointNotReached(Exception):
     pass
 
 
-def fixed_point(f):
+class Statistics:
+    """Instrumentation of a fixed point computation.
+
+    An iteration is one application of the function for `fixed_point` and one
+    pass over the worklist for worklist solvers. `changes` holds the number of
+    program points whose value changed in every iteration.
+    """
+
+    def __init__(self):
+        self.iterations = 0
+        self.iteration_times = []
+        self.changes = []
+        self.widenings = 0
+        self.transfers = 0
+        self.time = 0.0
+        self._start = None
+
+    def start(self):
+        self._start = time.perf_counter()
+
+    def iteration(self, changes):
+        """Record the end of an iteration.
+
+        :type changes: int
+        """
+        now = time.perf_counter()
+        self.iterations += 1
+        self.iteration_times.append(now - self._start)
+        self.changes.append(changes)
+        self.time += now - self._start
+        self._start = now
+
+    def merge(self, record):
+        """Add the statistics of another computation.
+
+        :param record: Statistics as returned by `as_dict`
+        :type record: dict
+        """
+        self.iterations += record['iterations']
+        self.iteration_times.extend(record['iteration_times'])
+        self.changes.extend(record['changes'])
+        self.widenings += record['widenings']
+        self.transfers += record['transfers']
+        self.time += record['time']
+
+    def as_dict(self):
+        return {
+            'iterations': self.iterations,
+            'time': self.time,
+            'iteration_times': self.iteration_times,
+            'changes': self.changes,
+            'widenings': self.widenings,
+            'transfers': self.transfers,
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict())
+
+
+def count_changes(x, y):
+    """Number of keys whose values differ, or 1 if non-dict values differ."""
+    if isinstance(x, dict) and isinstance(y, dict):
+        return sum(1 for k, v in y.items() if x.get(k) != v)
+    else:
+        return int(x != y)
+
+
+def fixed_point(f, stats=None):
+    """
+    :type f: (T) -> T
+    :type stats: Statistics | None
+    :rtype: (T) -> T
+    """
 
     def g(x):
+        if stats is not None:
+            stats.start()
         for i in range(MAX_RECURSIONS):
             y = f(x)
+            if stats is not None:
+                stats.transfers += 1
+                stats.iteration(count_changes(x, y))
             if y == x:
                 return y
             else:
@@ -25,6 +104,15 @@ def fixed_point(f):
 
 @functools.total_ordering
 class Lattice(metaclass=ABCMeta):
+    """Immutable element of a lattice.
+
+    Elements have no instance dictionary and cannot be modified after
+    construction, so equal elements have equal hashes and can be used as
+    dictionary keys.
+    """
+
+    __slots__ = ()
+
     @property
     @abstractmethod
     def bottom(self):
@@ -41,5 +129,94 @@ class Lattice(metaclass=ABCMeta):
     def __eq__(self, other):
         return type(self) == type(other)
 
+    def __hash__(self):
+        return hash(type(self))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError('{} is immutable'.format(type(self).__name__))
+
     def widen(self, other):
         return self
+
+    def narrow(self, other):
+        return self
+
+    def to_json(self):
+        """Stable encoding of the element as a JSON value.
+
+        Elements are encoded by the name of their class unless they carry
+        data.
+
+        :rtype: str | int | list | dict
+        """
+        return type(self).__name__
+
+
+def encode_number(value):
+    """JSON encoding of a bound that may be infinite.
+
+    JSON has no infinities, so they are the strings "inf" and "-inf".
+
+    :type value: int | float
+    :rtype: int | str
+    """
+    if value == float('inf'):
+        return 'inf'
+    elif value == float('-inf'):
+        return '-inf'
+    return int(value)
+
+
+class FiniteLattice(Lattice):
+    """Lattice with finitely many elements, one per concrete class.
+
+    Every element class has a single interned instance, so equality is an
+    identity check.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls):
+        instance = cls.__dict__.get('_instance')
+        if instance is None:
+            instance = super().__new__(cls)
+            cls._instance = instance
+        return instance
+
+    def __eq__(self, other):
+        return self is other
+
+    __hash__ = object.__hash__
+
+
+TRANSFER_FUNCTIONS = ('plus_1', 'minus_1', 'is_zero', 'non_zero')
+
+
+def tabulate(lattice, analysis=None):
+    """Replace the operations of a finite lattice by table lookups.
+
+    The tables are computed once from the methods of the element classes, i.e.
+    the direct subclasses of `lattice`. If `analysis` is given, its transfer
+    functions are tabulated as well. The elements are stored in
+    `lattice.elements`.
+
+    :type lattice: type
+    :type analysis: type | None
+    """
+    elements = tuple(cls() for cls in lattice.__subclasses__())
+    joins = {a: {b: a.join(b) for b in elements} for a in elements}
+    orders = {a: {b: a <= b for b in elements} for a in elements}
+    for a in elements:
+        cls = type(a)
+        cls.join = lambda self, other, table=joins[a]: table[other]
+        cls.__le__ = (lambda self, other, table=orders[a]:
+                      table.get(other, NotImplemented))
+    lattice.elements = elements
+    if analysis is not None:
+        for name in TRANSFER_FUNCTIONS:
+            f = getattr(analysis, name)
+            table = {a: f(a) for a in elements}
+            setattr(analysis, name, staticmethod(table.__getitem__))
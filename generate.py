@@ -0,0 +1,139 @@
+"""Generate a random 3 Counter Machine program
+
+Usage:
+    generate [options] SIZE
+
+
+Options:
+    --seed N            Random seed [default: 0]
+    --loops WEIGHT      Weight of nested counter loops [default: 1]
+    --straight WEIGHT   Weight of straight-line code [default: 1]
+    --branches WEIGHT   Weight of dense forward branching [default: 1]
+    --help              Show help message
+"""
+
+
+import random
+import sys
+import unittest
+
+from docopt import docopt
+from threecm import Inc, Dec, Zero, Stop, format_program, parse
+
+
+VARIABLES = 'xyz'
+
+
+class Generator:
+    """Seeded generator of terminating programs.
+
+    Programs are built from segments of straight-line increments, forward
+    branches and loops that drain one counter into another, optionally through
+    an inner loop over the third counter. Values are only moved by loops and
+    only increased by straight-line code, so every program stops after a
+    number of steps polynomial in its size and input.
+    """
+
+    def __init__(self, seed=0, loops=1.0, straight=1.0, branches=1.0):
+        self.random = random.Random(seed)
+        self.weights = [('loops', loops), ('straight', straight),
+                        ('branches', branches)]
+        self.program = []
+
+    @property
+    def pc(self):
+        """Program point of the next instruction."""
+        return len(self.program) + 1
+
+    def emit(self, instruction):
+        self.program.append(instruction)
+
+    def straight(self, size):
+        for _ in range(size):
+            self.emit(Inc(self.random.choice(VARIABLES)))
+
+    def branches(self, size):
+        end = self.pc + size
+        for _ in range(size):
+            if self.random.random() < 0.5:
+                self.emit(Inc(self.random.choice(VARIABLES)))
+            else:
+                pc1 = self.random.randint(self.pc + 1, end)
+                pc2 = self.random.randint(self.pc + 1, end)
+                self.emit(Zero(self.random.choice(VARIABLES), pc1, pc2))
+
+    def loop(self, nested):
+        source, inner, target = self.random.sample(VARIABLES, 3)
+        head = self.pc
+        body_size = 7 if nested else 3
+        end = head + 1 + body_size
+        self.emit(Zero(source, end, head + 1))
+        self.emit(Dec(source))
+        if nested:
+            inner_head = self.pc + 1
+            self.emit(Inc(inner))
+            self.emit(Zero(inner, inner_head + 4, inner_head + 1))
+            self.emit(Dec(inner))
+            self.emit(Inc(target))
+            self.emit(Zero(inner, inner_head + 4, inner_head + 1))
+        else:
+            self.emit(Inc(target))
+        self.emit(Zero(source, end, head + 1))
+
+    def generate(self, size):
+        """Generate a program of about `size` instructions ending with stop.
+
+        :type size: int
+        :rtype: list[Instruction]
+        """
+        self.program = []
+        kinds, weights = zip(*self.weights)
+        while self.pc < size:
+            kind = self.random.choices(kinds, weights)[0]
+            if kind == 'loops':
+                self.loop(nested=self.random.random() < 0.5)
+            elif kind == 'straight':
+                self.straight(self.random.randint(1, 20))
+            elif kind == 'branches':
+                self.branches(self.random.randint(1, 10))
+        self.emit(Stop())
+        return self.program
+
+
+def generate(size, seed=0, **weights):
+    """Generate a random terminating program.
+
+    :type size: int
+    :type seed: int
+    :rtype: list[Instruction]
+    """
+    return Generator(seed, **weights).generate(size)
+
+
+def main(argv):
+    opts = docopt(__doc__, argv=argv)
+    program = generate(int(opts['SIZE']), seed=int(opts['--seed']),
+                       loops=float(opts['--loops']),
+                       straight=float(opts['--straight']),
+                       branches=float(opts['--branches']))
+    sys.stdout.write(format_program(program))
+
+
+class GeneratorTest(unittest.TestCase):
+    def test_deterministic(self):
+        self.assertEqual(generate(100, seed=1), generate(100, seed=1))
+        self.assertNotEqual(generate(100, seed=1), generate(100, seed=2))
+
+    def test_programs_stop(self):
+        from compiler import compile_program
+
+        for seed in range(20):
+            program = generate(200, seed=seed)
+            self.assertEqual(program, parse(format_program(program)))
+            run = compile_program(program)
+            for x in range(3):
+                self.assertIsNotNone(run(x))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,201 @@
+"""Incremental re-analysis of edited 3 Counter Machine programs
+
+An edit is described by the longest common prefix and suffix of the old and
+the new program. States of program points that are not reachable from the
+edited region are carried over from the previous solution; only the reachable
+part of the program is reset and iterated again.
+"""
+
+
+import unittest
+
+from analyze import analyze, initial_states, narrow, solve
+from cfg import ControlFlowGraph
+from threecm import Inc, Dec, Zero, parse
+
+
+# Above this fraction of affected program points a full run is cheaper
+MAX_AFFECTED = 0.5
+
+
+def shape(instruction):
+    """Instruction without its jump targets."""
+    return type(instruction), getattr(instruction, 'v', None)
+
+
+def targets(instruction, pc):
+    """Program points the machine may continue at after an instruction."""
+    if isinstance(instruction, Zero):
+        return [instruction.pc1, instruction.pc2]
+    elif isinstance(instruction, (Inc, Dec)):
+        return [pc + 1]
+    else:
+        return []
+
+
+def map_program_points(old_program, program):
+    """Map program points of the old program to the new one.
+
+    Instructions of the common prefix and suffix are mapped, the ones in
+    between are considered edited.
+
+    :type old_program: list[Instruction]
+    :type program: list[Instruction]
+    :return: The mapping and the edited program points of the new program
+    :rtype: ((int) -> int | None, range)
+    """
+    old_size, size = len(old_program), len(program)
+    prefix = 0
+    while (prefix < min(old_size, size) and
+           shape(old_program[prefix]) == shape(program[prefix])):
+        prefix += 1
+    suffix = 0
+    while (suffix < min(old_size, size) - prefix and
+           shape(old_program[old_size - suffix - 1]) ==
+           shape(program[size - suffix - 1])):
+        suffix += 1
+    delta = size - old_size
+
+    def mapping(pc):
+        if 0 < pc <= prefix:
+            return pc
+        elif old_size - suffix < pc <= old_size:
+            return pc + delta
+        else:
+            return None
+
+    return mapping, range(prefix + 1, size - suffix + 1)
+
+
+def changed_program_points(old_program, cfg, mapping, edited):
+    """Program points whose state may differ from the previous solution.
+
+    These are the edited instructions, mapped instructions whose jump targets
+    changed, the targets of removed or changed old instructions, and
+    everything reachable from them.
+
+    :type old_program: list[Instruction]
+    :type cfg: ControlFlowGraph
+    :type mapping: (int) -> int | None
+    :type edited: range
+    :rtype: set[int]
+    """
+    program = cfg.program
+    seeds = set(edited)
+    for old_pc, old in enumerate(old_program, 1):
+        pc = mapping(old_pc)
+        if pc is not None:
+            # Fall-through edges inside the prefix or suffix stay the same
+            if not isinstance(old, Zero) and mapping(old_pc + 1) == pc + 1:
+                continue
+            mapped = [mapping(t) for t in targets(old, old_pc)]
+            if mapped == targets(program[pc - 1], pc):
+                continue
+            seeds.add(pc)
+        seeds.update(mapping(t) for t in targets(old, old_pc))
+    seeds.discard(None)
+
+    affected = set()
+    stack = [pc for pc in seeds if 0 < pc <= cfg.size]
+    while stack:
+        pc = stack.pop()
+        if pc not in affected:
+            affected.add(pc)
+            stack.extend(e.target for e in cfg.successors[pc])
+    return affected
+
+
+def reanalyze(old_program, old_result, program, analysis, cfg=None,
+              stats=None):
+    """Analyze an edited program reusing the result for the old program.
+
+    The result is the same as the one of `analyze.analyze` for domains
+    without widening. With widening, states carried over from the previous
+    solution may differ from a run from scratch, but they are still a fixed
+    point of the new program.
+
+    :type old_program: list[Instruction]
+    :param old_result: Result of the same analysis for the old program
+    :type old_result: dict[int, (Lattice, Lattice, Lattice)]
+    :type program: list[Instruction]
+    :type analysis: Analysis
+    :type cfg: ControlFlowGraph | None
+    :type stats: Statistics | None
+    :rtype: dict[int, (Lattice, Lattice, Lattice)]
+    """
+    if cfg is None:
+        cfg = ControlFlowGraph(program)
+    mapping, edited = map_program_points(old_program, program)
+    if len(old_result) != len(old_program) or (cfg.size and mapping(1) != 1):
+        return analyze(program, analysis, cfg, stats)
+    affected = changed_program_points(old_program, cfg, mapping, edited)
+    if len(affected) > MAX_AFFECTED * cfg.size:
+        return analyze(program, analysis, cfg, stats)
+
+    s_hat = initial_states(cfg, analysis)
+    for old_pc, states in old_result.items():
+        pc = mapping(old_pc)
+        if pc is not None and pc not in affected:
+            s_hat[pc] = states
+    # Unaffected predecessors have to propagate their states into the reset
+    # region again.
+    pcs = {e.source for pc in affected for e in cfg.predecessors[pc]}
+    pcs.update(affected)
+    s_hat = solve(cfg, analysis, s_hat, sorted(pcs), stats)
+    return narrow(cfg, analysis, s_hat, stats)
+
+
+class IncrementalTest(unittest.TestCase):
+    old_text = ('inc y\n'
+                'zero x 6 else 3\n'
+                'inc y\n'
+                'dec x\n'
+                'zero x 6 else 3\n'
+                'inc z\n'
+                'stop\n')
+
+    def check(self, text):
+        from bounds import BoundsAnalysis
+        from exercise03 import ParityAnalysis
+        from exercise04 import IntervalAnalysis
+
+        old_program, program = parse(self.old_text), parse(text)
+        for analysis in [ParityAnalysis(), BoundsAnalysis(),
+                         IntervalAnalysis()]:
+            old_result = analyze(old_program, analysis)
+            self.assertEqual(analyze(program, analysis),
+                             reanalyze(old_program, old_result, program,
+                                       analysis))
+
+    def test_unchanged(self):
+        self.check(self.old_text)
+
+    def test_changed_tail(self):
+        self.check('inc y\n'
+                   'zero x 6 else 3\n'
+                   'inc y\n'
+                   'dec x\n'
+                   'zero x 6 else 3\n'
+                   'dec z\n'
+                   'stop\n')
+
+    def test_inserted(self):
+        self.check('inc y\n'
+                   'zero x 7 else 3\n'
+                   'inc y\n'
+                   'dec x\n'
+                   'dec x\n'
+                   'zero x 7 else 3\n'
+                   'inc z\n'
+                   'stop\n')
+
+    def test_mapping(self):
+        mapping, edited = map_program_points(parse('inc x\n'
+                                           'inc y\n'
+                                           'stop\n'),
+                                     parse('inc x\n'
+                                           'inc z\n'
+                                           'inc z\n'
+                                           'stop\n'))
+        self.assertEqual([1, None, 4], [mapping(pc) for pc in [1, 2, 3]])
+        self.assertEqual(range(2, 4), edited)
@@ -0,0 +1,189 @@
+"""Lockstep evaluation of a 3 Counter Machine program over many inputs
+
+Every input is a lane with its own program counter and registers. All lanes
+execute one instruction per step; the updates for every instruction kind are
+applied to the lanes at such instructions at once as masked array operations.
+Lanes retire when they stop, fail or run out of steps.
+"""
+
+
+from collections import namedtuple
+import unittest
+
+import numpy as np
+
+from program import Program, INC, DEC, ZERO, STOP
+from threecm import Inc, Dec, Zero, Stop, parse
+
+
+FAIL = STOP + 1
+
+STOPPED, FAILED, RUNNING = range(3)
+
+VARIABLES = 'xyz'
+
+
+class BatchResult(namedtuple('BatchResult', 'values status steps')):
+    """Results of lockstep evaluation.
+
+    `values` holds the result y of lanes whose status is STOPPED and 0
+    otherwise, `status` is one of STOPPED, FAILED or RUNNING (the step
+    budget ran out), `steps` is the number of executed instructions.
+    """
+
+    def results(self):
+        """Results in the form returned by `exercise02.evaluate`.
+
+        Lanes that are still running are reported as None as well.
+
+        :rtype: list[int | None]
+        """
+        return [int(v) if s == STOPPED else None
+                for v, s in zip(self.values.tolist(), self.status.tolist())]
+
+
+def instruction_arrays(program):
+    """Opcodes, registers and jump targets indexed by program point.
+
+    Index 0 and index len(program) + 1 hold FAIL instructions, and jumps
+    outside of the program lead to index 0.
+
+    :type program: list[Instruction] | Program
+    :rtype: (ndarray, ndarray, ndarray, ndarray)
+    """
+    size = len(program)
+    opcode = np.full(size + 2, FAIL, dtype=np.int8)
+    register = np.zeros(size + 2, dtype=np.int8)
+    pc1 = np.zeros(size + 2, dtype=np.int64)
+    pc2 = np.zeros(size + 2, dtype=np.int64)
+
+    if isinstance(program, Program):
+        opcode[1:-1] = program.opcodes
+        register[1:-1] = program.registers
+        pc1[1:-1] = program.pc1
+        pc2[1:-1] = program.pc2
+        pc1[(pc1 < 0) | (pc1 > size)] = 0
+        pc2[(pc2 < 0) | (pc2 > size)] = 0
+        return opcode, register, pc1, pc2
+
+    def target(pc):
+        return pc if 0 < pc <= size else 0
+
+    for pc, i in enumerate(program, 1):
+        if isinstance(i, Inc):
+            opcode[pc] = INC
+        elif isinstance(i, Dec):
+            opcode[pc] = DEC
+        elif isinstance(i, Zero):
+            opcode[pc] = ZERO
+            pc1[pc] = target(i.pc1)
+            pc2[pc] = target(i.pc2)
+        elif isinstance(i, Stop):
+            opcode[pc] = STOP
+            continue
+        else:
+            raise ValueError('unknown instruction: {}'.format(i))
+        if i.v not in VARIABLES:
+            opcode[pc] = FAIL
+        else:
+            register[pc] = VARIABLES.index(i.v)
+    return opcode, register, pc1, pc2
+
+
+def evaluate_batch(program, inputs, max_steps=1000000, visit=None):
+    """Run a program on many input values of x in lockstep.
+
+    :type program: list[Instruction] | Program
+    :type inputs: collections.Iterable[int] | ndarray
+    :param max_steps: Step budget, either one for all lanes or one per lane
+    :type max_steps: int | ndarray
+    :param visit: Function called before every step with the indices of the
+        running lanes, their program points, their registers as an array of
+        shape (3, lanes) and the number of the step. Lanes that jumped out
+        of the program are at 0 or at len(program) + 1.
+    :type visit: (ndarray, ndarray, ndarray, int) -> None
+    :rtype: BatchResult
+    """
+    opcode, register, pc1, pc2 = instruction_arrays(program)
+    inputs = np.asarray(inputs, dtype=np.int64).ravel()
+    lanes = len(inputs)
+    budget = np.broadcast_to(np.asarray(max_steps, dtype=np.int64), (lanes,))
+
+    registers = np.zeros((3, lanes), dtype=np.int64)
+    registers[0] = inputs
+    pc = np.ones(lanes, dtype=np.int64)
+    values = np.zeros(lanes, dtype=np.int64)
+    status = np.full(lanes, RUNNING, dtype=np.int8)
+    steps = np.zeros(lanes, dtype=np.int64)
+
+    active = np.arange(lanes)
+    step = 0
+    while active.size:
+        active = active[budget[active] > step]
+        if not active.size:
+            break
+        p = pc[active]
+        if visit is not None:
+            visit(active, p, registers[:, active], step)
+        o = opcode[p]
+        r = register[p].astype(np.int64)
+        current = registers[r, active]
+
+        stop = o == STOP
+        values[active[stop]] = registers[1, active[stop]]
+        status[active[stop]] = STOPPED
+
+        fail = (o == FAIL) | ((o == DEC) & (current == 0))
+        status[active[fail]] = FAILED
+
+        inc = o == INC
+        registers[r[inc], active[inc]] += 1
+        dec = (o == DEC) & ~fail
+        registers[r[dec], active[dec]] -= 1
+        pc[active[inc | dec]] += 1
+
+        zero = o == ZERO
+        pc[active[zero]] = np.where(current[zero] == 0, pc1[p[zero]],
+                                    pc2[p[zero]])
+
+        step += 1
+        steps[active] = step
+        active = active[~(stop | fail)]
+
+    return BatchResult(values, status, steps)
+
+
+class LockstepTest(unittest.TestCase):
+    def test_same_as_interpreter(self):
+        from exercise02 import evaluate
+
+        programs = [
+            'zero x 6 else 2\n'
+            'inc y\n'
+            'dec x\n'
+            'zero x 1 else 1\n'
+            'inc z\n'
+            'stop\n',
+            'dec x\n'
+            'inc y\n'
+            'zero x 4 else 1\n'
+            'stop\n',
+            'inc x\n'
+            'zero x 5 else 7\n',
+        ]
+        for text in programs:
+            program = parse(text)
+            expected = [evaluate(program, x) for x in range(10)]
+            self.assertEqual(expected,
+                             evaluate_batch(program, range(10)).results())
+            self.assertEqual(expected,
+                             evaluate_batch(Program(program),
+                                            range(10)).results())
+
+    def test_step_budget(self):
+        program = parse('inc y\n'
+                        'zero y 1 else 1\n'
+                        'stop\n')
+        result = evaluate_batch(program, [0, 1], max_steps=[10, 3])
+        self.assertEqual([RUNNING, RUNNING], result.status.tolist())
+        self.assertEqual([10, 3], result.steps.tolist())
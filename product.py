@@ -0,0 +1,336 @@
+"""Reduced product of analyses of 3 Counter Machine
+
+The product runs several non-relational analyses in a single fixed point
+computation. The value of a variable is a tuple of the values of every
+component. After every transfer function the components are reduced: the
+facts about the concrete value that each of them knows, i.e. bounds and
+parity, are combined and used to refine all the others.
+"""
+
+
+from functools import lru_cache
+import unittest
+
+import bounds
+import exercise03
+import exercise04
+from bounds import BoundsAnalysis
+from exercise03 import ParityAnalysis
+from exercise04 import Interval, IntervalAnalysis
+from funcutils import Lattice
+from threecm import Analysis, parse
+
+
+INF = float('inf')
+
+
+class Product(Lattice, tuple):
+    """Values of a variable in every component of a product analysis."""
+
+    __slots__ = ()
+
+    # Compare as lattice elements, not lexicographically as tuples
+    __lt__, __gt__, __ge__ = Lattice.__lt__, Lattice.__gt__, Lattice.__ge__
+
+    @property
+    def bottom(self):
+        return Product(c.bottom for c in self)
+
+    def join(self, other):
+        if self is other:
+            return self
+        return join(self, other)
+
+    def __le__(self, other):
+        return all(a.join(b) == b for a, b in zip(self, other))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = tuple.__hash__
+
+    def __repr__(self):
+        return 'Product({})'.format(', '.join(map(repr, self)))
+
+    def to_json(self):
+        return [c.to_json() for c in self]
+
+
+@lru_cache(maxsize=4096)
+def join(a, b):
+    """
+    :type a: Product
+    :type b: Product
+    :rtype: Product
+    """
+    joined = Product(x.join(y) for x, y in zip(a, b))
+    if joined == a:
+        return a
+    elif joined == b:
+        return b
+    return joined
+
+
+def facts(value):
+    """Lower bound, upper bound and parity of a component value.
+
+    The parity is 0 or 1 or None if it is unknown.
+
+    :type value: Lattice
+    :return: The facts or None for bottom
+    :rtype: (float, float, int | None) | None
+    """
+    if isinstance(value, exercise03.Parity):
+        if isinstance(value, exercise03.Bottom):
+            return None
+        elif isinstance(value, exercise03.Even):
+            return -INF, INF, 0
+        elif isinstance(value, exercise03.Odd):
+            return -INF, INF, 1
+    elif isinstance(value, bounds.Bounds):
+        if isinstance(value, bounds.Bottom):
+            return None
+        elif isinstance(value, bounds.ZeroBound):
+            return 0, 0, 0
+        elif isinstance(value, bounds.OneBound):
+            return 1, 1, 1
+        elif isinstance(value, bounds.Regular):
+            return 2, INF, None
+    elif isinstance(value, Interval):
+        if isinstance(value, exercise04.Bottom):
+            return None
+        return value.left, value.right, None
+    return -INF, INF, None
+
+
+def meet_facts(values):
+    """Combine the facts of component values.
+
+    :type values: collections.Iterable[Lattice]
+    :return: The facts or None if the values are contradictory
+    :rtype: (float, float, int | None) | None
+    """
+    lower, upper, parity = -INF, INF, None
+    for value in values:
+        f = facts(value)
+        if f is None:
+            return None
+        lower, upper = max(lower, f[0]), min(upper, f[1])
+        if f[2] is not None:
+            if parity is not None and parity != f[2]:
+                return None
+            parity = f[2]
+    if parity is not None:
+        if lower > -INF and lower % 2 != parity:
+            lower += 1
+        if upper < INF and upper % 2 != parity:
+            upper -= 1
+    if lower > upper:
+        return None
+    if lower == upper:
+        parity = lower % 2
+    return lower, upper, parity
+
+
+def meet(a, b):
+    """Meet of elements of Parity or Bounds.
+
+    Their elements between bottom and top are pairwise disjoint. The order is
+    derived from the join since it is the one operation all domains agree on.
+    """
+    joined = a.join(b)
+    if joined == b:
+        return a
+    elif joined == a:
+        return b
+    else:
+        return a.bottom
+
+
+def refine(value, lower, upper, parity):
+    """Refine a component value by facts about the concrete value.
+
+    :type value: Lattice
+    :type lower: float
+    :type upper: float
+    :type parity: int | None
+    :rtype: Lattice
+    """
+    if isinstance(value, exercise03.Parity):
+        if parity == 0:
+            return meet(value, exercise03.Even())
+        elif parity == 1:
+            return meet(value, exercise03.Odd())
+    elif isinstance(value, bounds.Bounds):
+        if lower == upper == 0:
+            return meet(value, bounds.ZeroBound())
+        elif lower == upper == 1:
+            return meet(value, bounds.OneBound())
+        elif lower >= 2:
+            return meet(value, bounds.Regular())
+    elif isinstance(value, Interval):
+        if (lower, upper) != (value.left, value.right):
+            return Interval(lower, upper)
+    return value
+
+
+@lru_cache(maxsize=4096)
+def reduce(value):
+    """Reduced product value.
+
+    :type value: Product
+    :rtype: Product
+    """
+    f = meet_facts(value)
+    if f is None:
+        return value.bottom
+    return Product(refine(c, *f) for c in value)
+
+
+class ProductAnalysis(Analysis):
+    def __init__(self, analyses=None, reduction=True):
+        """
+        :param analyses: Non-relational analyses, parity, bounds and interval
+            by default
+        :type analyses: collections.Iterable[Analysis] | None
+        :param reduction: Refine the components by each other
+        :type reduction: bool
+        """
+        if analyses is None:
+            analyses = ParityAnalysis(), BoundsAnalysis(), IntervalAnalysis()
+        self.analyses = tuple(analyses)
+        self.reduction = reduction
+        for analysis in self.analyses:
+            if analysis.relational:
+                raise ValueError('relational analyses are not supported: '
+                                 '{!r}'.format(analysis))
+        self.bottom = Product(a.bottom for a in self.analyses)
+        self.initial = tuple(Product(a.initial[i] for a in self.analyses)
+                             for i in range(3))
+        self.widening_delay = max(a.widening_delay for a in self.analyses)
+        self.narrowing_steps = max(a.narrowing_steps for a in self.analyses)
+        self._transfers = {}
+
+    def __getstate__(self):
+        state = dict(vars(self))
+        state['_transfers'] = {}
+        return state
+
+    def _transfer(self, name, value):
+        try:
+            f = self._transfers[name]
+        except KeyError:
+            functions = [getattr(a, name) for a in self.analyses]
+
+            @lru_cache(maxsize=4096)
+            def f(value):
+                result = Product(g(c) for g, c in zip(functions, value))
+                return reduce(result) if self.reduction else result
+
+            self._transfers[name] = f
+        return f(value)
+
+    def abstract(self, n):
+        return Product(a.abstract(n) for a in self.analyses)
+
+    def plus_1(self, x):
+        return self._transfer('plus_1', x)
+
+    def minus_1(self, x):
+        return self._transfer('minus_1', x)
+
+    def is_zero(self, x):
+        return self._transfer('is_zero', x)
+
+    def non_zero(self, x):
+        return self._transfer('non_zero', x)
+
+    def _componentwise(self, name, previous, next):
+        """Apply widen or narrow of every component analysis."""
+        results = []
+        for i, analysis in enumerate(self.analyses):
+            split = {pc: tuple(v[i] for v in states)
+                     for pc, states in next.items()}
+            # The default operator of finite domains just takes the new state
+            if getattr(type(analysis), name) is not getattr(Analysis, name):
+                split = getattr(analysis, name)(
+                    {pc: tuple(v[i] for v in states)
+                     for pc, states in previous.items()}, split)
+            results.append(split)
+        return {pc: tuple(Product(r[pc][v] for r in results)
+                          for v in range(3))
+                for pc in previous}
+
+    def widen(self, previous, next):
+        """
+        :type previous: dict[int, (Product, Product, Product)]
+        :type next: dict[int, (Product, Product, Product)]
+        :rtype: dict[int, (Product, Product, Product)]
+        """
+        return self._componentwise('widen', previous, next)
+
+    def narrow(self, previous, next):
+        """
+        :type previous: dict[int, (Product, Product, Product)]
+        :type next: dict[int, (Product, Product, Product)]
+        :rtype: dict[int, (Product, Product, Product)]
+        """
+        return self._componentwise('narrow', previous, next)
+
+
+class ProductTest(unittest.TestCase):
+    def test_reduce(self):
+        value = reduce(Product((exercise03.Top(), bounds.Top(),
+                                Interval(0, 0))))
+        self.assertEqual(Product((exercise03.Even(), bounds.ZeroBound(),
+                                  Interval(0, 0))), value)
+        value = reduce(Product((exercise03.Odd(), bounds.Regular(),
+                                Interval(-5, 4))))
+        self.assertEqual(Interval(3, 3), value[2])
+        self.assertEqual(exercise03.Odd(), value[0])
+        value = reduce(Product((exercise03.Odd(), bounds.ZeroBound(),
+                                Interval(0, 7))))
+        self.assertEqual(ProductAnalysis().bottom, value)
+
+    def test_same_as_components(self):
+        from analyze import analyze
+
+        program = parse('zero x 6 else 2\n'
+                        'inc y\n'
+                        'dec x\n'
+                        'zero x 1 else 1\n'
+                        'inc z\n'
+                        'stop\n')
+        analyses = ParityAnalysis(), BoundsAnalysis(), IntervalAnalysis()
+        separate = [analyze(program, a) for a in analyses]
+        for reduction in [False, True]:
+            result = analyze(program, ProductAnalysis(analyses, reduction))
+            for pc, states in result.items():
+                for i, expected in enumerate(separate):
+                    components = tuple(v[i] for v in states)
+                    if reduction:
+                        self.assertTrue(all(
+                            a.join(b) == b
+                            for a, b in zip(components, expected[pc])))
+                    else:
+                        self.assertEqual(expected[pc], components)
+        self.assertEqual(Product((exercise03.Even(), bounds.ZeroBound(),
+                                  Interval(0, 0))), result[6][0])
+
+    def test_reduction_prunes_branches(self):
+        from analyze import analyze
+
+        program = parse('inc y\n'
+                        'inc y\n'
+                        'zero y 5 else 4\n'
+                        'stop\n'
+                        'inc z\n'
+                        'stop\n')
+        self.assertEqual(Interval(0, 0),
+                         analyze(program, IntervalAnalysis())[5][1])
+        # Bounds knows that y is at least 2, so it cannot be zero
+        analysis = ProductAnalysis()
+        self.assertEqual(analysis.bottom, analyze(program, analysis)[5][1])
@@ -0,0 +1,427 @@
+"""Compact representation of 3 Counter Machine programs
+
+Instructions are stored in parallel arrays of opcodes, registers and jump
+targets instead of a list of instruction objects. Instruction objects are
+created on access.
+
+Parsed programs are saved in a binary format next to their source files with
+the extension .3cmc. It consists of a header followed by the columns:
+
+    magic       4 bytes b'3CMC'
+    version     2 bytes and 2 bytes of padding
+    count       4 bytes, the number of instructions
+    size        8 bytes, the size of the source file
+    mtime       8 bytes, the modification time of the source file in ns
+    checksum    4 bytes, CRC-32 of the columns
+    opcodes     count bytes
+    registers   count bytes and padding to a multiple of 4 bytes
+    pc1         4 * count bytes
+    pc2         4 * count bytes
+
+Integers are little-endian. Compiled programs are memory-mapped and their
+columns are views of the mapped file, so loading them copies nothing.
+"""
+
+
+from array import array
+from collections.abc import Sequence
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+
+from threecm import Inc, Dec, Zero, Stop, ParseError, parse, parse_line
+
+
+INSTRUCTIONS = (Inc, Dec, Zero, Stop)
+INC, DEC, ZERO, STOP = range(len(INSTRUCTIONS))
+REGISTERS = 'xyz'
+UNARY = {'inc': INC, 'dec': DEC}
+VARIABLES = {v: i for i, v in enumerate(REGISTERS)}
+
+# Jump targets are stored as 4 byte signed integers
+MAX_TARGET = 2 ** 31 - 1
+
+MAGIC = b'3CMC'
+VERSION = 1
+HEADER = struct.Struct('<4sH2xIqqI')
+COMPILED_SUFFIX = '.3cmc'
+
+
+class FormatError(Exception):
+    pass
+
+
+class Program(Sequence):
+    """Program backed by columns of opcodes, registers and jump targets.
+
+    Indexing returns the same instruction objects as `threecm.parse`. The
+    register and the jump targets of instructions that have none are 0.
+    """
+
+    def __init__(self, instructions=()):
+        """
+        :type instructions: collections.Iterable[Instruction]
+        """
+        self.opcodes = array('b')
+        self.registers = array('b')
+        self.pc1 = array('i')
+        self.pc2 = array('i')
+        self.extend(instructions)
+
+    @classmethod
+    def from_columns(cls, opcodes, registers, pc1, pc2):
+        """Program backed by existing columns.
+
+        Programs backed by read-only views, e.g. of compiled files, cannot be
+        extended.
+
+        :type opcodes: array | memoryview
+        :type registers: array | memoryview
+        :type pc1: array | memoryview
+        :type pc2: array | memoryview
+        :rtype: Program
+        """
+        program = cls.__new__(cls)
+        program.opcodes = opcodes
+        program.registers = registers
+        program.pc1 = pc1
+        program.pc2 = pc2
+        return program
+
+    def append(self, instruction):
+        """
+        :type instruction: Instruction
+        """
+        if isinstance(instruction, Zero):
+            pc1, pc2 = instruction.pc1, instruction.pc2
+            if not (0 <= pc1 <= MAX_TARGET and 0 <= pc2 <= MAX_TARGET):
+                raise ValueError('jump target out of range: {}'.format(
+                    instruction))
+            self.opcodes.append(ZERO)
+        elif isinstance(instruction, (Inc, Dec)):
+            self.opcodes.append(INC if isinstance(instruction, Inc) else DEC)
+            pc1 = pc2 = 0
+        elif isinstance(instruction, Stop):
+            self.opcodes.append(STOP)
+            self.registers.append(0)
+            self.pc1.append(0)
+            self.pc2.append(0)
+            return
+        else:
+            raise ValueError('unknown instruction: {}'.format(instruction))
+        self.registers.append(REGISTERS.index(instruction.v))
+        self.pc1.append(pc1)
+        self.pc2.append(pc2)
+
+    def extend(self, instructions):
+        for instruction in instructions:
+            self.append(instruction)
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Parse a program incrementally from lines of text.
+
+        Lines may be strings or bytes, e.g. lines of a file or a memory-mapped
+        file. Every line has to end with a newline like in `threecm.parse`.
+
+        :type lines: collections.Iterable[str | bytes]
+        :rtype: Program
+        """
+        program = cls()
+        opcodes = program.opcodes.append
+        registers = program.registers.append
+        pc1 = program.pc1.append
+        pc2 = program.pc2.append
+        for lineno, line in enumerate(lines, 1):
+            if isinstance(line, bytes):
+                line = line.decode('ascii', 'replace')
+            if not line.endswith('\n'):
+                if line.strip():
+                    raise ParseError('line {}: expected a newline'.format(
+                        lineno))
+                break
+            # Well-formed lines are stored directly, anything else goes
+            # through parse_line to be reported with a proper error.
+            words = line.split()
+            size = len(words)
+            if size == 2 and words[0] in UNARY and words[1] in VARIABLES:
+                opcodes(UNARY[words[0]])
+                registers(VARIABLES[words[1]])
+                pc1(0)
+                pc2(0)
+            elif (size == 5 and words[0] == 'zero' and
+                  words[1] in VARIABLES and words[3] == 'else' and
+                  words[2].isascii() and words[2].isdigit() and
+                  words[4].isascii() and words[4].isdigit()):
+                target1, target2 = int(words[2]), int(words[4])
+                if max(target1, target2) > MAX_TARGET:
+                    raise ParseError('line {}: jump target above {}'.format(
+                        lineno, MAX_TARGET))
+                opcodes(ZERO)
+                registers(VARIABLES[words[1]])
+                pc1(target1)
+                pc2(target2)
+            elif size == 1 and words[0] == 'stop':
+                opcodes(STOP)
+                registers(0)
+                pc1(0)
+                pc2(0)
+            else:
+                program.append(parse_line(line, lineno))
+        return program
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def _instruction(self, index):
+        opcode = self.opcodes[index]
+        if opcode == STOP:
+            return Stop()
+        elif opcode == ZERO:
+            return Zero(REGISTERS[self.registers[index]], self.pc1[index],
+                        self.pc2[index])
+        else:
+            return INSTRUCTIONS[opcode](REGISTERS[self.registers[index]])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._instruction(i)
+                    for i in range(*index.indices(len(self)))]
+        return self._instruction(range(len(self))[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._instruction(index)
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Program({!r})'.format(list(self))
+
+    def __reduce__(self):
+        # Views of mapped files cannot be pickled
+        return Program.from_columns, tuple(
+            column if isinstance(column, array) else array(code, column)
+            for code, column in zip('bbii', [self.opcodes, self.registers,
+                                             self.pc1, self.pc2]))
+
+
+def load(path, compiled=True):
+    """Load a program from a text or a compiled file.
+
+    The compiled file of a text file is used if it is up to date. Otherwise
+    the text is parsed and the compiled file is written if possible.
+
+    :type path: str
+    :param compiled: Use and update the compiled file of a text file
+    :type compiled: bool
+    :rtype: Program
+    """
+    if path.endswith(COMPILED_SUFFIX):
+        return load_compiled(path)
+    if not compiled:
+        return load_text(path)
+    source = os.stat(path)
+    compiled_path = os.path.splitext(path)[0] + COMPILED_SUFFIX
+    try:
+        return load_compiled(compiled_path, source)
+    except (OSError, FormatError):
+        pass
+    program = load_text(path)
+    try:
+        save(program, compiled_path, source)
+    except OSError:
+        pass
+    return program
+
+
+def load_text(path):
+    """Load a program from a file without reading all of its text at once.
+
+    :type path: str
+    :rtype: Program
+    """
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            return Program()
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return Program.from_lines(iter(m.readline, b''))
+
+
+def little_endian(column):
+    """Bytes of an array column in little-endian order.
+
+    :type column: array | memoryview
+    :rtype: bytes
+    """
+    if sys.byteorder == 'little' or column.itemsize == 1:
+        return bytes(column)
+    swapped = array(column.typecode if isinstance(column, array)
+                    else column.format, column)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+
+def dumps(program, source=None):
+    """Compiled representation of a program.
+
+    :type program: Program
+    :param source: Status of the source file
+    :type source: os.stat_result | None
+    :rtype: bytes
+    """
+    if not isinstance(program, Program):
+        program = Program(program)
+    count = len(program)
+    padding = b'\0' * (-2 * count % 4)
+    columns = b''.join([little_endian(program.opcodes),
+                        little_endian(program.registers), padding,
+                        little_endian(program.pc1),
+                        little_endian(program.pc2)])
+    size, mtime = (source.st_size, source.st_mtime_ns) if source else (-1, -1)
+    header = HEADER.pack(MAGIC, VERSION, count, size, mtime,
+                         zlib.crc32(columns))
+    return header + columns
+
+
+def save(program, path, source=None):
+    """Write a compiled program atomically.
+
+    :type program: Program
+    :type path: str
+    :param source: Status of the source file
+    :type source: os.stat_result | None
+    """
+    data = dumps(program, source)
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                     suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        raise
+
+
+def load_compiled(path, source=None):
+    """Memory-map a compiled program.
+
+    :type path: str
+    :param source: Status of the source file the program has to match
+    :type source: os.stat_result | None
+    :raise FormatError: The file is not a valid compiled program or it is
+        out of date
+    :rtype: Program
+    """
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size < HEADER.size:
+            raise FormatError('{}: truncated header'.format(path))
+        data = memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+    magic, version, count, size, mtime, checksum = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise FormatError('{}: not a compiled program of version {}'.format(
+            path, VERSION))
+    if source is not None and (size, mtime) != (source.st_size,
+                                                source.st_mtime_ns):
+        raise FormatError('{}: out of date'.format(path))
+    columns = data[HEADER.size:]
+    offset = 2 * count + -2 * count % 4
+    if len(columns) != offset + 8 * count:
+        raise FormatError('{}: wrong size'.format(path))
+    if zlib.crc32(columns) != checksum:
+        raise FormatError('{}: wrong checksum'.format(path))
+    pc1 = columns[offset:offset + 4 * count].cast('i')
+    pc2 = columns[offset + 4 * count:].cast('i')
+    if sys.byteorder != 'little':
+        pc1, pc2 = array('i', pc1), array('i', pc2)
+        pc1.byteswap()
+        pc2.byteswap()
+    return Program.from_columns(columns[:count].cast('b'),
+                                columns[count:2 * count].cast('b'), pc1, pc2)
+
+
+class ProgramTest(unittest.TestCase):
+    text = ('zero x 6 else 2\n'
+            'inc y\n'
+            'dec x\n'
+            'zero x 1 else 1\n'
+            'inc z\n'
+            'stop\n')
+
+    def test_same_as_parse(self):
+        program = Program.from_lines(self.text.splitlines(keepends=True))
+        self.assertEqual(parse(self.text), program)
+        self.assertEqual(Dec('x'), program[2])
+        self.assertEqual(Stop(), program[-1])
+        self.assertEqual(parse(self.text)[1:4], program[1:4])
+
+    def test_errors(self):
+        with self.assertRaisesRegex(ParseError, 'line 2:'):
+            Program.from_lines([b'inc x\n', b'inc w\n'])
+        with self.assertRaisesRegex(ParseError, 'line 2:'):
+            Program.from_lines(['inc x\n', 'stop'])
+        with self.assertRaises(IndexError):
+            Program([Stop()])[1]
+        with self.assertRaisesRegex(ParseError, 'line 2: jump target'):
+            Program.from_lines(['stop\n', 'zero x 1 else 2147483648\n'])
+        with self.assertRaises(ValueError):
+            Program([Zero('x', 2 ** 31, 1)])
+
+    def test_load_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'program.3cm')
+            compiled_path = os.path.join(directory, 'program.3cmc')
+            with open(path, 'w') as fd:
+                fd.write(self.text)
+            self.assertIsInstance(load(path, compiled=False).pc1, array)
+            self.assertFalse(os.path.exists(compiled_path))
+            self.assertIsInstance(load(path).pc1, array)
+            written = os.stat(compiled_path)
+            program = load(path)
+            # The second load maps the compiled file instead of parsing
+            self.assertIsInstance(program.pc1, memoryview)
+            self.assertEqual(parse(self.text), program)
+            self.assertEqual(written.st_mtime_ns,
+                             os.stat(compiled_path).st_mtime_ns)
+
+    def test_compiled(self):
+        import pickle
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'program.3cm')
+            with open(path, 'w') as fd:
+                fd.write(self.text)
+            compiled_path = os.path.join(directory, 'program.3cmc')
+            self.assertEqual(parse(self.text), load(path))
+            program = load(path)
+            self.assertIsInstance(program.pc1, memoryview)
+            self.assertEqual(parse(self.text), program)
+            self.assertEqual(program, load(compiled_path))
+            self.assertEqual(program, pickle.loads(pickle.dumps(program)))
+
+            with open(path, 'a') as fd:
+                fd.write('inc x\n')
+            with self.assertRaisesRegex(FormatError, 'out of date'):
+                load_compiled(compiled_path, os.stat(path))
+            self.assertEqual(Inc('x'), load(path)[-1])
+
+            data = bytearray(dumps(program))
+            data[-1] ^= 1
+            with open(compiled_path, 'wb') as fd:
+                fd.write(data)
+            with self.assertRaisesRegex(FormatError, 'checksum'):
+                load_compiled(compiled_path)
+            self.assertEqual(Inc('x'), load(path)[-1])
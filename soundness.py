@@ -0,0 +1,412 @@
+"""Differential soundness check of analyses against concrete runs
+
+Usage:
+    soundness [options] [PATH...]
+
+Every program is run on the inputs 0, ..., N - 1 of x in lockstep, and the
+concrete states (x, y, z) reached at every program point are recorded. Each
+of them has to be described by the state an analysis computed for the program
+point. Programs are the files given by PATH like in `analyze` and generated
+programs.
+
+Every violation is reported as a JSON object per line with the smallest input
+and the fewest steps that reach a concrete state outside the analysis result
+at a program point. For non-relational analyses violations are reported per
+variable. A summary is printed to stderr. The exit status is 1 if there are
+violations.
+
+Options:
+    --analyses LIST     Comma-separated analyses to check
+                        [default: parity,bounds,interval]
+    --inputs N          Number of input values of x [default: 100]
+    --max-steps N       Step budget of every run [default: 100000]
+    --generate N        Number of generated programs to check [default: 0]
+    --size N            Size of generated programs [default: 100]
+    --seed N            Seed of the first generated program [default: 0]
+    --chunk N           Inputs run by a task [default: 1000]
+    --jobs N            Number of worker processes [default: 1]
+    --help              Show help message
+"""
+
+
+from collections import namedtuple
+import functools
+import json
+import sys
+import unittest
+
+from docopt import docopt
+import numpy as np
+
+from analyze import (ANALYSES, analyze, create_analysis, find_programs,
+                     state_join)
+from lockstep import evaluate_batch
+from threecm import format_instruction, parse
+
+
+VARIABLES = 'xyz'
+
+# Recorded states are deduplicated once at least this many rows are buffered
+COMPACT_ROWS = 1 << 20
+
+# Columns of recorded states
+PC, X, Y, Z, INPUT, STEP = range(6)
+
+
+class Counterexample(namedtuple('Counterexample',
+                                'pc variable state input steps abstract')):
+    """Concrete state reached at a program point but not described by the
+    abstract state there.
+
+    `variable` is the variable whose value is not described or None for
+    relational analyses, `state` is the concrete (x, y, z), `input` the value
+    of x and `steps` the number of executed instructions that reach it,
+    `abstract` is the abstract value of the variable or the abstract state.
+    """
+    pass
+
+
+def row_keys(rows):
+    """Integers that are equal for equal rows of non-negative integers.
+
+    :type rows: ndarray
+    :rtype: ndarray
+    """
+    shape = [int(m) + 1 for m in rows.max(axis=0)]
+    size = 1
+    for m in shape:
+        size *= m
+    if size < 1 << 62:
+        return np.ravel_multi_index(rows.T, shape)
+    return np.unique(rows, axis=0, return_inverse=True)[1].ravel()
+
+
+def first_rows(rows, key):
+    """Rows with the smallest input and then the fewest steps per key.
+
+    :type rows: ndarray
+    :param key: Columns identifying rows
+    :type key: list[int]
+    :rtype: ndarray
+    """
+    if not len(rows):
+        return rows
+    keys = row_keys(rows[:, key])
+    order = np.lexsort([rows[:, STEP], rows[:, INPUT], keys])
+    keys = keys[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return rows[order[first]]
+
+
+def visited_states(program, inputs, max_steps=100000):
+    """Distinct concrete states reached at program points.
+
+    Every state is reported once along with the smallest input that reaches
+    it and the fewest steps it takes.
+
+    :type program: list[Instruction] | Program
+    :type inputs: collections.Iterable[int]
+    :type max_steps: int
+    :return: Rows of program point, x, y, z, input and steps
+    :rtype: ndarray
+    """
+    inputs = np.asarray(inputs, dtype=np.int64).ravel()
+    size = len(program)
+    chunks = []
+    buffered = 0
+    limit = COMPACT_ROWS
+
+    def visit(lanes, pcs, registers, step):
+        nonlocal chunks, buffered, limit
+        inside = (pcs > 0) & (pcs <= size)
+        rows = np.empty((int(inside.sum()), 6), dtype=np.int64)
+        rows[:, PC] = pcs[inside]
+        rows[:, X:Z + 1] = registers[:, inside].T
+        rows[:, INPUT] = inputs[lanes[inside]]
+        rows[:, STEP] = step
+        chunks.append(rows)
+        buffered += len(rows)
+        if buffered >= limit:
+            chunks = [first_rows(np.concatenate(chunks), [PC, X, Y, Z])]
+            buffered = len(chunks[0])
+            # Keep the cost of compaction linear in the number of rows
+            limit = max(COMPACT_ROWS, 2 * buffered)
+
+    evaluate_batch(program, inputs, max_steps, visit)
+    if not chunks:
+        return np.empty((0, 6), dtype=np.int64)
+    return first_rows(np.concatenate(chunks), [PC, X, Y, Z])
+
+
+def check(program, analysis, states, result=None):
+    """Counterexamples to the soundness of an analysis result.
+
+    Every program point and variable, or every program point for relational
+    analyses, has at most one counterexample, the one with the smallest input
+    and the fewest steps.
+
+    :type program: list[Instruction] | Program
+    :type analysis: Analysis
+    :param states: Visited states as returned by `visited_states`
+    :type states: ndarray
+    :param result: Result of the analysis, computed if not given
+    :type result: dict[int, (Lattice, Lattice, Lattice)] | None
+    :rtype: list[Counterexample]
+    """
+    if result is None:
+        result = analyze(program, analysis)
+    counterexamples = []
+
+    if analysis.relational:
+        join = state_join(analysis)
+        for element, rows in group_by_element(states, [
+                result[pc] for pc in range(1, len(program) + 1)]):
+            values = rows[:, X:Z + 1]
+            if hasattr(element, 'contains'):
+                member = element.contains(values)
+            else:
+                member = np.array([join(analysis.abstract_state(*v), element)
+                                   == element for v in values.tolist()],
+                                  dtype=bool)
+            for row in first_rows(rows[~member], [PC]).tolist():
+                counterexamples.append(Counterexample(
+                    row[PC], None, tuple(row[X:Z + 1]), row[INPUT],
+                    row[STEP], element))
+        return sorted(counterexamples, key=lambda c: c.pc)
+
+    # Abstract values are shared between program points, so the membership
+    # of a concrete value is checked once per distinct abstract value
+    for i, v in enumerate(VARIABLES):
+        elements, ids = [], {}
+        element_ids = np.zeros(len(program) + 1, dtype=np.int64)
+        for pc in range(1, len(program) + 1):
+            element = result[pc][i]
+            element_ids[pc] = ids.setdefault(element, len(elements))
+            if element_ids[pc] == len(elements):
+                elements.append(element)
+        pairs = np.stack([element_ids[states[:, PC]], states[:, X + i]],
+                         axis=1)
+        _, index, inverse = np.unique(row_keys(pairs), return_index=True,
+                                      return_inverse=True)
+        member = np.array([analysis.abstract(value).join(elements[e]) ==
+                           elements[e] for e, value in pairs[index].tolist()],
+                          dtype=bool)
+        violations = states[~member[inverse]]
+        for row in first_rows(violations, [PC]).tolist():
+            counterexamples.append(Counterexample(
+                row[PC], v, tuple(row[X:Z + 1]), row[INPUT], row[STEP],
+                result[row[PC]][i]))
+    return sorted(counterexamples, key=lambda c: (c.pc, c.variable))
+
+
+def group_by_element(states, elements):
+    """Visited states grouped by the abstract states of their program points.
+
+    :type states: ndarray
+    :param elements: Abstract states of program points from 1
+    :type elements: list[Lattice]
+    :rtype: collections.Iterator[(Lattice, ndarray)]
+    """
+    ids = {}
+    element_ids = np.full(len(elements) + 1, -1, dtype=np.int64)
+    for pc, element in enumerate(elements, 1):
+        element_ids[pc] = ids.setdefault(element, len(ids))
+    elements = [None] + list(ids)
+    keys = element_ids[states[:, PC]]
+    order = np.argsort(keys, kind='stable')
+    for group in np.split(order, np.flatnonzero(np.diff(keys[order])) + 1):
+        if len(group) and keys[group[0]] >= 0:
+            yield elements[keys[group[0]] + 1], states[group]
+
+
+def first_counterexamples(counterexamples):
+    """The smallest counterexample per program point and variable.
+
+    :type counterexamples: collections.Iterable[Counterexample]
+    :rtype: list[Counterexample]
+    """
+    first = {}
+    for c in counterexamples:
+        key = c.pc, c.variable
+        if key not in first or (c.input, c.steps) < (first[key].input,
+                                                     first[key].steps):
+            first[key] = c
+    return sorted(first.values(), key=lambda c: (c.pc, c.variable or ''))
+
+
+@functools.lru_cache(maxsize=16)
+def load_source(source):
+    """Program of a path or of the size and seed of a generated program.
+
+    :type source: str | (int, int)
+    :rtype: list[Instruction] | Program
+    """
+    if isinstance(source, str):
+        from program import load
+        return load(source)
+    from generate import generate
+    size, seed = source
+    return generate(size, seed=seed)
+
+
+@functools.lru_cache(maxsize=64)
+def analysis_result(source, name):
+    program = load_source(source)
+    analysis = create_analysis(name, program)
+    return analysis, analyze(program, analysis)
+
+
+def run_task(task):
+    """Check analyses of a program on a range of inputs.
+
+    Programs and analysis results are kept by the worker for the other
+    ranges of inputs of the same program.
+
+    :param task: Source of the program, names of analyses, the range of
+        inputs and the step budget
+    :type task: (str | (int, int), list[str], range, int)
+    :return: Number of visited states and counterexamples by analysis name,
+        or an error message
+    :rtype: (int, dict[str, list[Counterexample]]) | str
+    """
+    source, names, inputs, max_steps = task
+    try:
+        program = load_source(source)
+        states = visited_states(program, inputs, max_steps)
+        counterexamples = {}
+        for name in names:
+            analysis, result = analysis_result(source, name)
+            counterexamples[name] = check(program, analysis, states, result)
+        return len(states), counterexamples
+    except Exception as e:
+        return '{}: {}'.format(type(e).__name__, e)
+
+
+def source_name(source):
+    if isinstance(source, str):
+        return source
+    return 'generated:{}:{}'.format(*source)
+
+
+def main(argv):
+    opts = docopt(__doc__, argv=argv)
+    names = opts['--analyses'].split(',')
+    unknown = set(names) - {name for name, _ in ANALYSES}
+    if unknown:
+        raise ValueError('unknown analyses: {}'.format(
+            ', '.join(sorted(unknown))))
+    count = int(opts['--inputs'])
+    chunk = int(opts['--chunk'])
+    max_steps = int(opts['--max-steps'])
+    size, seed = int(opts['--size']), int(opts['--seed'])
+    sources = find_programs(opts['PATH'])
+    sources.extend((size, seed + i) for i in range(int(opts['--generate'])))
+    tasks = [(source, names, range(start, min(start + chunk, count)),
+              max_steps)
+             for source in sources for start in range(0, count, chunk)]
+
+    workers = int(opts['--jobs'])
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(workers)
+        results = executor.map(run_task, tasks)
+    else:
+        executor = None
+        results = map(run_task, tasks)
+
+    found = {}
+    summary = {'programs': len(sources), 'states': 0, 'errors': 0,
+               'violations': 0}
+    try:
+        for (source, *_), outcome in zip(tasks, results):
+            if isinstance(outcome, str):
+                summary['errors'] += 1
+                print('{}: {}'.format(source_name(source), outcome),
+                      file=sys.stderr)
+                continue
+            states, counterexamples = outcome
+            summary['states'] += states
+            for name, cs in counterexamples.items():
+                found.setdefault((source, name), []).extend(cs)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    for (source, name), cs in found.items():
+        program = load_source(source)
+        for c in first_counterexamples(cs):
+            summary['violations'] += 1
+            print(json.dumps({
+                'program': source_name(source),
+                'analysis': name,
+                'pc': c.pc,
+                'instruction': format_instruction(program[c.pc - 1]),
+                'variable': c.variable,
+                'state': c.state,
+                'input': c.input,
+                'steps': c.steps,
+                'abstract': repr(c.abstract),
+            }))
+    print(json.dumps(summary), file=sys.stderr)
+    if summary['violations'] or summary['errors']:
+        sys.exit(1)
+
+
+class SoundnessTest(unittest.TestCase):
+    text = ('zero x 6 else 2\n'
+            'inc y\n'
+            'dec x\n'
+            'zero x 1 else 1\n'
+            'inc z\n'
+            'stop\n')
+
+    def test_visited_states(self):
+        states = visited_states(parse(self.text), range(3))
+        # Only the run with input 2 reaches y = 2 at pc 3, in 6 steps
+        self.assertIn([3, 1, 2, 0, 2, 6], states.tolist())
+        self.assertEqual(len(states), len({tuple(row[:4])
+                                           for row in states.tolist()}))
+        self.assertEqual({1, 2, 3, 4, 6}, set(states[:, PC].tolist()))
+
+    def test_sound(self):
+        from generate import generate
+
+        for program in [parse(self.text), generate(200, seed=3)]:
+            states = visited_states(program, range(20))
+            for name in ['parity', 'bounds', 'interval', 'zone', 'all']:
+                analysis = create_analysis(name, program)
+                self.assertEqual([], check(program, analysis, states))
+
+    def test_abstraction(self):
+        program = parse(self.text)
+        for name, _ in ANALYSES:
+            analysis = create_analysis(name, program)
+            join = state_join(analysis)
+            for x in range(4):
+                state = analysis.abstract_state(x, 0, 0)
+                # Any input is a possible initial state
+                self.assertEqual(analysis.initial,
+                                 join(state, analysis.initial), name)
+
+    def test_unsound(self):
+        from exercise03 import ParityAnalysis
+
+        class Unsound(ParityAnalysis):
+            # Increments keep the parity
+            @staticmethod
+            def plus_1(p):
+                return p
+
+        program = parse(self.text)
+        states = visited_states(program, range(5))
+        counterexamples = check(program, Unsound(), states)
+        self.assertEqual([(pc, 'y') for pc in [1, 2, 3, 4, 6]],
+                         [(c.pc, c.variable) for c in counterexamples])
+        # The shortest run that increments y stops at pc 3 after 2 steps
+        self.assertEqual(((1, 1, 0), 1, 2),
+                         counterexamples[2][2:5])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
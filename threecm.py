@@ -1,7 +1,5 @@
 from collections import namedtuple
 import unittest
-from funcparserlib.lexer import make_tokenizer
-from funcparserlib.parser import some, skip, many, finished
 
 
 class Instruction:
@@ -25,6 +23,10 @@ class Stop(Instruction, namedtuple('Stop', '')):
 
 
 def tokenize(s):
+    # funcparserlib is only needed by the reference parser, importing it
+    # lazily keeps it out of the startup time of the tools
+    from funcparserlib.lexer import make_tokenizer
+
     specs = [
         ('whitespace', (r'[ \t]',)),
         ('newline', (r'[\n]',)),
@@ -36,7 +38,17 @@ def tokenize(s):
     return [t for t in f(s) if t.type != 'whitespace']
 
 
-def parse(s):
+def parse_reference(s):
+    """Parse a program with funcparserlib.
+
+    This is the reference implementation of the grammar used for testing
+    `parse`.
+
+    :type s: str
+    :rtype: list[Instruction]
+    """
+    from funcparserlib.parser import some, skip, many, finished
+
     def value(t):
         return t.value
 
@@ -65,6 +77,93 @@ def parse(s):
     return top_level.parse(tokens)
 
 
+class ParseError(Exception):
+    pass
+
+
+VARIABLES = frozenset('xyz')
+
+
+def parse_number(word, lineno):
+    if not (word.isascii() and word.isdigit()):
+        raise ParseError('line {}: expected a number, got {!r}'.format(
+            lineno, word))
+    return int(word)
+
+
+def parse_line(line, lineno):
+    """Parse a single line of a program.
+
+    :type line: str
+    :type lineno: int
+    :rtype: Instruction
+    """
+    words = line.split()
+    if not words:
+        raise ParseError('line {}: expected an instruction'.format(lineno))
+    name = words[0]
+    if name in ('inc', 'dec'):
+        if len(words) != 2 or words[1] not in VARIABLES:
+            raise ParseError('line {}: expected "{} VARIABLE"'.format(
+                lineno, name))
+        return Inc(words[1]) if name == 'inc' else Dec(words[1])
+    elif name == 'zero':
+        if (len(words) != 5 or words[1] not in VARIABLES or
+                words[3] != 'else'):
+            raise ParseError('line {}: expected "zero VARIABLE NUMBER else '
+                             'NUMBER"'.format(lineno))
+        return Zero(words[1], parse_number(words[2], lineno),
+                    parse_number(words[4], lineno))
+    elif name == 'stop':
+        if len(words) != 1:
+            raise ParseError('line {}: expected "stop"'.format(lineno))
+        return Stop()
+    else:
+        raise ParseError('line {}: unknown instruction {!r}'.format(
+            lineno, name))
+
+
+def parse(s):
+    """Parse a program in a single pass over its lines.
+
+    Every instruction has to be terminated by a newline.
+
+    :type s: str
+    :rtype: list[Instruction]
+    """
+    lines = s.split('\n')
+    last = lines.pop()
+    if last.strip():
+        raise ParseError('line {}: expected a newline'.format(len(lines) + 1))
+    return [parse_line(line, lineno) for lineno, line in enumerate(lines, 1)]
+
+
+def format_instruction(i):
+    """Format an instruction in the syntax accepted by `parse`.
+
+    :type i: Instruction
+    :rtype: str
+    """
+    if isinstance(i, Inc):
+        return 'inc {}'.format(i.v)
+    elif isinstance(i, Dec):
+        return 'dec {}'.format(i.v)
+    elif isinstance(i, Zero):
+        return 'zero {} {} else {}'.format(i.v, i.pc1, i.pc2)
+    elif isinstance(i, Stop):
+        return 'stop'
+    else:
+        raise ValueError('unknown instruction: {}'.format(i))
+
+
+def format_program(program):
+    """
+    :type program: list[Instruction]
+    :rtype: str
+    """
+    return ''.join(format_instruction(i) + '\n' for i in program)
+
+
 class ParseTest(unittest.TestCase):
     def test_parse_0(self):
         self.assertEqual([Stop()],
@@ -86,10 +185,66 @@ class ParseTest(unittest.TestCase):
                                'zero y 1 else 3\n'
                                'stop\n'))
 
+    def test_same_as_reference(self):
+        s = ('zero x 6 else 2\n'
+             '  inc y\n'
+             'dec\tx\n'
+             'zero x 1 else 1   \n'
+             'inc z\n'
+             'stop\n')
+        self.assertEqual(parse_reference(s), parse(s))
+        self.assertEqual(parse_reference(''), parse(''))
+
+    def test_format(self):
+        s = ('dec y\n'
+             'zero y 1 else 3\n'
+             'inc x\n'
+             'stop\n')
+        self.assertEqual(s, format_program(parse(s)))
+
+    def test_errors(self):
+        with self.assertRaisesRegex(ParseError, 'line 2:'):
+            parse('inc x\n'
+                  'inc w\n')
+        with self.assertRaisesRegex(ParseError, 'line 1:'):
+            parse('zero x 1 else -2\n')
+        with self.assertRaisesRegex(ParseError, 'line 2:'):
+            parse('stop\n'
+                  '\n')
+        with self.assertRaisesRegex(ParseError, 'line 2:'):
+            parse('stop\n'
+                  'stop')
+
 
 class Analysis:
     bottom = None
     initial = None
+    widening_delay = 0
+    narrowing_steps = 0
+    # The state of a program point is a single lattice element instead of a
+    # tuple of elements for x, y and z, and transfer functions take the state
+    # and the name of the variable.
+    relational = False
+
+    def __repr__(self):
+        parameters = ['{}={!r}'.format(name, value)
+                      for name, value in sorted(vars(self).items())
+                      if not name.startswith('_')]
+        return '{}({})'.format(type(self).__name__, ', '.join(parameters))
+
+    def abstract_state(self, x, y, z):
+        """Abstraction of concrete values of the variables as a state.
+
+        Non-relational analyses define `abstract(value)`, the abstraction
+        of the value of a single variable, and relational ones override
+        this method.
+
+        :type x: int
+        :type y: int
+        :type z: int
+        :rtype: (Lattice, Lattice, Lattice) | Lattice
+        """
+        return self.abstract(x), self.abstract(y), self.abstract(z)
 
     @staticmethod
     def plus_1(x):
@@ -109,4 +264,8 @@ class Analysis:
 
     @staticmethod
     def widen(previous, next):
+        return next
+
+    @staticmethod
+    def narrow(previous, next):
         return next
\ No newline at end of file
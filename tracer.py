@@ -0,0 +1,324 @@
+"""Traces of 3 Counter Machine executions
+
+Usage:
+    tracer [options] TRACE
+
+A tracer records the states (pc, x, y, z) of `exercise02.evaluate` in a
+buffer of a fixed number of records instead of printing them. Records can be
+sampled every N steps. The buffer is either a ring that keeps the last records
+or a chunk that is appended to a trace file every time it fills up. The number
+of executed steps of every program point is always counted exactly.
+
+Trace files are written by `exercise02 --trace-file` and consist of a header
+followed by the records and the hit counts:
+
+    magic       4 bytes b'3CMT'
+    version     2 bytes and 2 bytes of padding
+    every       4 bytes, the sampling interval in steps
+    size        4 bytes, the number of instructions of the program
+    steps       8 bytes, the number of executed steps
+    count       8 bytes, the number of records
+    first       8 bytes, the step of the first record
+    records     32 * count bytes, (pc, x, y, z) as 8 byte integers
+    hits        8 * size bytes, executed steps of program points from 1
+
+Integers are little-endian. Record i is the state before step
+first + i * every, where steps are numbered from 0.
+
+Options:
+    --help          Show help message
+    --last K        Print the last K records [default: 20]
+    --hits          Print executed steps of every program point instead
+    --program PATH  Print the instructions of the traced program as well
+"""
+
+
+from array import array
+from collections import namedtuple
+from itertools import chain
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+from docopt import docopt
+
+from program import FormatError
+
+
+MAGIC = b'3CMT'
+VERSION = 1
+HEADER = struct.Struct('<4sH2xIIqqq')
+
+FIELDS = 4
+
+DEFAULT_CAPACITY = 1 << 16
+
+
+class Tracer(object):
+    """Recorder of executed states.
+
+    Records are kept as tuples in a preallocated list, so recording a step
+    costs a few list operations. Without a path the buffer is a ring of the
+    last `capacity` records. With a path, every full buffer is appended to
+    the file unless `ring` is set, in which case only the last records are
+    written when the tracer is closed.
+    """
+
+    def __init__(self, size, capacity=DEFAULT_CAPACITY, every=1, path=None,
+                 ring=None):
+        """
+        :param size: Number of instructions of the traced program
+        :type size: int
+        :param capacity: Number of records in the buffer
+        :type capacity: int
+        :param every: Record every N-th step
+        :type every: int
+        :param path: Trace file to write
+        :type path: str | None
+        :param ring: Keep only the last records, the default without a path
+        :type ring: bool | None
+        """
+        if capacity <= 0 or every <= 0:
+            raise ValueError('capacity and sampling interval must be '
+                             'positive')
+        self.size = size
+        self.capacity = capacity
+        self.every = every
+        self.path = path
+        self.ring = path is None if ring is None else ring
+        self.steps = 0
+        self.hits = [0] * (size + 1)
+        self._buffer = [None] * capacity
+        self._position = 0
+        self._wrapped = False
+        self._written = 0
+        self._countdown = 1
+        self._file = None
+        # Packing a whole chunk at once is faster than building an array
+        self._chunk = struct.Struct('<{}q'.format(FIELDS * capacity))
+        if path is not None and not self.ring:
+            self._file = open(path, 'wb')
+            self._file.write(b'\0' * HEADER.size)
+
+    def record(self, pc, x, y, z):
+        """Record the state before executing the instruction at pc.
+
+        :type pc: int
+        :type x: int
+        :type y: int
+        :type z: int
+        """
+        self.hits[pc] += 1
+        self.steps += 1
+        self._countdown -= 1
+        if self._countdown:
+            return
+        self._countdown = self.every
+        self._buffer[self._position] = (pc, x, y, z)
+        self._position += 1
+        if self._position == self.capacity:
+            self._position = 0
+            if self.ring:
+                self._wrapped = True
+            else:
+                self._flush(self._buffer)
+
+    def _flush(self, records):
+        if len(records) == self.capacity:
+            chunk = self._chunk
+        else:
+            chunk = struct.Struct('<{}q'.format(FIELDS * len(records)))
+        self._file.write(chunk.pack(*chain.from_iterable(records)))
+        self._written += len(records)
+
+    def records(self):
+        """Records in the buffer from the oldest one.
+
+        :rtype: list[(int, int, int, int)]
+        """
+        if self._wrapped:
+            return (self._buffer[self._position:] +
+                    self._buffer[:self._position])
+        return self._buffer[:self._position]
+
+    @property
+    def count(self):
+        """Number of recorded samples."""
+        return (self.steps + self.every - 1) // self.every
+
+    def close(self):
+        """Write the trace file if there is one."""
+        if self.path is None:
+            return
+        records = self.records()
+        if self.ring:
+            self._file = open(self.path, 'wb')
+            self._file.write(b'\0' * HEADER.size)
+        elif self._file is None:
+            return
+        try:
+            self._flush(records)
+            self._file.write(struct.pack('<{}q'.format(self.size),
+                                         *self.hits[1:]))
+            first = (self.count - self._written) * self.every
+            self._file.seek(0)
+            self._file.write(HEADER.pack(MAGIC, VERSION, self.every,
+                                         self.size, self.steps,
+                                         self._written, first))
+        finally:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Trace(namedtuple('Trace', 'every steps first records hits')):
+    """Contents of a trace file.
+
+    `records` is a sequence of 4 * count integers and `hits` holds the
+    executed steps of program points from 1.
+    """
+
+    def __len__(self):
+        return len(self.records) // FIELDS
+
+    def record(self, i):
+        """Step number and state (pc, x, y, z) of a record.
+
+        :type i: int
+        :rtype: (int, (int, int, int, int))
+        """
+        return (self.first + i * self.every,
+                tuple(self.records[FIELDS * i:FIELDS * (i + 1)]))
+
+
+def load_trace(path):
+    """Memory-map a trace file.
+
+    :type path: str
+    :raise FormatError: The file is not a valid trace
+    :rtype: Trace
+    """
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size < HEADER.size:
+            raise FormatError('{}: truncated header'.format(path))
+        data = memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+    magic, version, every, size, steps, count, first = HEADER.unpack_from(
+        data)
+    if magic != MAGIC or version != VERSION:
+        raise FormatError('{}: not a trace of version {}'.format(
+            path, VERSION))
+    body = data[HEADER.size:]
+    if len(body) != 8 * (FIELDS * count + size):
+        raise FormatError('{}: wrong size'.format(path))
+    records = body[:8 * FIELDS * count].cast('q')
+    hits = body[8 * FIELDS * count:].cast('q')
+    if sys.byteorder != 'little':
+        records, hits = array('q', records), array('q', hits)
+        records.byteswap()
+        hits.byteswap()
+    return Trace(every, steps, first, records, hits)
+
+
+def format_records(trace, last, program=None):
+    """Lines of the last records of a trace.
+
+    :type trace: Trace
+    :type last: int
+    :type program: list[Instruction] | None
+    :rtype: collections.Iterator[str]
+    """
+    for i in range(max(len(trace) - last, 0), len(trace)):
+        step, (pc, x, y, z) = trace.record(i)
+        line = '{}: ({}, {}, {}, {})'.format(step, pc, x, y, z)
+        if program is not None:
+            line += ' {}'.format(program[pc - 1])
+        yield line
+
+
+def format_hits(trace, program=None):
+    """Lines of the executed steps of program points that were executed.
+
+    :type trace: Trace
+    :type program: list[Instruction] | None
+    :rtype: collections.Iterator[str]
+    """
+    for pc, hits in enumerate(trace.hits, 1):
+        if hits:
+            line = '{}: {} ({:.1%})'.format(pc, hits, hits / trace.steps)
+            if program is not None:
+                line += ' {}'.format(program[pc - 1])
+            yield line
+
+
+class TracerTest(unittest.TestCase):
+    def test_ring(self):
+        tracer = Tracer(2, capacity=3, every=2)
+        for step in range(8):
+            tracer.record(step % 2 + 1, step, 0, 0)
+        self.assertEqual([(1, 2, 0, 0), (1, 4, 0, 0), (1, 6, 0, 0)],
+                         tracer.records())
+        self.assertEqual([0, 4, 4], tracer.hits)
+
+    def test_file(self):
+        from exercise02 import evaluate
+        from threecm import parse
+
+        program = parse('zero x 6 else 2\n'
+                        'inc y\n'
+                        'dec x\n'
+                        'zero x 1 else 1\n'
+                        'inc z\n'
+                        'stop\n')
+        with tempfile.TemporaryDirectory() as directory:
+            for ring in [False, True]:
+                path = os.path.join(directory, 'trace.3cmt')
+                with Tracer(len(program), capacity=4, path=path,
+                            ring=ring) as tracer:
+                    self.assertEqual(3, evaluate(program, 3, tracer=tracer))
+                trace = load_trace(path)
+                self.assertEqual((1, 14), (trace.every, trace.steps))
+                self.assertEqual([4, 3, 3, 3, 0, 1], trace.hits.tolist())
+                self.assertEqual(4 if ring else 14, len(trace))
+                self.assertEqual((13, (6, 0, 3, 0)),
+                                 trace.record(len(trace) - 1))
+                self.assertEqual(['12: (1, 0, 3, 0)', '13: (6, 0, 3, 0)'],
+                                 list(format_records(trace, 2)))
+                del trace
+
+            with open(path, 'r+b') as fd:
+                fd.truncate(HEADER.size + 8)
+            with self.assertRaisesRegex(FormatError, 'wrong size'):
+                load_trace(path)
+
+
+def main(argv):
+    opts = docopt(__doc__, argv=argv)
+    trace = load_trace(opts['TRACE'])
+    program = None
+    if opts['--program']:
+        from program import load
+
+        program = load(opts['--program'])
+        if len(program) != len(trace.hits):
+            raise SystemExit('{}: not the traced program'.format(
+                opts['--program']))
+    if opts['--hits']:
+        lines = format_hits(trace, program)
+    else:
+        lines = format_records(trace, int(opts['--last']), program)
+    for line in lines:
+        print(line)
+    print('Steps: {}, records: {}, every: {}'.format(
+        trace.steps, len(trace), trace.every), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
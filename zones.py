@@ -0,0 +1,394 @@
+"""Zone analysis of 3 Counter Machine
+
+A zone is a conjunction of constraints v_j - v_i <= c over the variables x, y
+and z and the constant v_0 = 0. It is stored as a difference-bound matrix
+where entry [i, j] is the bound of v_j - v_i, with infinity for no bound.
+Matrices are kept closed, i.e. every entry is the tightest bound implied by
+the others, so equal zones have equal matrices. Only widening produces
+matrices that are not closed. Single-variable updates close the matrix
+incrementally through the updated variable instead of running the full
+Floyd-Warshall algorithm.
+"""
+
+
+import unittest
+
+import numpy as np
+
+from funcutils import Lattice, encode_number
+from threecm import Analysis, parse
+
+
+VARIABLES = 'xyz'
+
+INDICES = {v: i for i, v in enumerate(VARIABLES, 1)}
+
+SIZE = len(VARIABLES) + 1
+
+INF = float('inf')
+
+
+def close(matrix, pivots=range(SIZE)):
+    """Shortest-path closure of a difference-bound matrix in place.
+
+    If the matrix was closed before constraints on the variables with indices
+    in `pivots` were tightened, it is enough to take the shortest paths
+    through these variables.
+
+    :type matrix: ndarray
+    :type pivots: collections.Iterable[int]
+    :return: The closed matrix or None if the constraints are unsatisfiable
+    :rtype: ndarray | None
+    """
+    for k in pivots:
+        np.minimum(matrix, matrix[:, k, None] + matrix[None, k, :],
+                   out=matrix)
+    if (matrix.diagonal() < 0).any():
+        return None
+    return matrix
+
+
+class Zone(Lattice):
+    __slots__ = ('matrix', '_key')
+
+    def __init__(self, matrix):
+        """
+        :param matrix: Difference-bound matrix, not modified afterwards
+        :type matrix: ndarray
+        """
+        matrix.flags.writeable = False
+        object.__setattr__(self, 'matrix', matrix)
+        object.__setattr__(self, '_key', matrix.tobytes())
+
+    @classmethod
+    def from_constraints(cls, constraints=()):
+        """Zone of constraints v - w <= c given as (v, w, c).
+
+        Variables are names from VARIABLES or None for the constant 0.
+
+        :type constraints: collections.Iterable[(str | None, str | None, int)]
+        :rtype: Zone
+        """
+        matrix = np.full((SIZE, SIZE), INF)
+        np.fill_diagonal(matrix, 0)
+        for v, w, c in constraints:
+            i, j = INDICES.get(w, 0), INDICES.get(v, 0)
+            matrix[i, j] = min(matrix[i, j], c)
+        return zone(close(matrix))
+
+    @property
+    def bottom(self):
+        return Bottom()
+
+    def bounds(self, v):
+        """Lower and upper bound of a variable.
+
+        :type v: str
+        :rtype: (float, float)
+        """
+        i = INDICES[v]
+        return -self.matrix[i, 0], self.matrix[0, i]
+
+    def difference(self, v, w):
+        """Lower and upper bound of v - w.
+
+        :type v: str
+        :type w: str
+        :rtype: (float, float)
+        """
+        i, j = INDICES[w], INDICES[v]
+        return -self.matrix[j, i], self.matrix[i, j]
+
+    def join(self, other):
+        if isinstance(other, Bottom):
+            return self
+        return Zone(np.maximum(self.matrix, other.matrix))
+
+    def __le__(self, other):
+        if isinstance(other, Bottom):
+            return False
+        return bool((self.matrix <= other.matrix).all())
+
+    def __eq__(self, other):
+        return (self is other or
+                (type(self) is type(other) and self._key == other._key))
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def widen(self, other):
+        """Drop the bounds that are not stable.
+
+        The result is not closed since closing it could restore dropped
+        bounds and prevent the iteration from terminating.
+        """
+        if isinstance(other, Bottom):
+            return self
+        return Zone(np.where(other.matrix <= self.matrix, self.matrix, INF))
+
+    def narrow(self, other):
+        """Refine the missing bounds by the bounds of a smaller zone."""
+        if isinstance(other, Bottom):
+            return other
+        matrix = np.where(self.matrix == INF, other.matrix, self.matrix)
+        return zone(close(matrix))
+
+    def contains(self, values):
+        """Whether concrete states belong to the zone.
+
+        :param values: Rows of values of x, y and z
+        :type values: ndarray
+        :rtype: ndarray
+        """
+        points = np.zeros((len(values), SIZE))
+        points[:, 1:] = values
+        differences = points[:, None, :] - points[:, :, None]
+        return (differences <= self.matrix).all(axis=(1, 2))
+
+    def constrain(self, v, lower=-INF, upper=INF):
+        """Meet with lower <= v <= upper.
+
+        :type v: str
+        :type lower: float
+        :type upper: float
+        :rtype: Zone
+        """
+        i = INDICES[v]
+        if -lower >= self.matrix[i, 0] and upper >= self.matrix[0, i]:
+            return self
+        matrix = self.matrix.copy()
+        matrix[i, 0] = min(matrix[i, 0], -lower)
+        matrix[0, i] = min(matrix[0, i], upper)
+        return zone(close(matrix, (i, 0)))
+
+    def shift(self, v, c):
+        """Zone after adding c to a variable.
+
+        Translating a variable keeps the matrix closed.
+
+        :type v: str
+        :type c: int
+        :rtype: Zone
+        """
+        i = INDICES[v]
+        matrix = self.matrix.copy()
+        matrix[:, i] += c
+        matrix[i, :] -= c
+        matrix[i, i] = 0
+        return Zone(matrix)
+
+    def __repr__(self):
+        """Bounds of variables and the bounds of their differences that are
+        not implied by them."""
+        constraints = []
+        for v in VARIABLES:
+            constraints.extend(format_bounds(v, *self.bounds(v)))
+        for i, w in enumerate(VARIABLES):
+            for v in VARIABLES[i + 1:]:
+                lower, upper = self.difference(v, w)
+                v_lower, v_upper = self.bounds(v)
+                w_lower, w_upper = self.bounds(w)
+                if lower <= v_lower - w_upper:
+                    lower = -INF
+                if upper >= v_upper - w_lower:
+                    upper = INF
+                constraints.extend(format_bounds('{} - {}'.format(v, w),
+                                                 lower, upper))
+        return 'Zone({})'.format(', '.join(constraints))
+
+    def to_json(self):
+        """Bounds of the variables and of their differences like "y - x"."""
+        terms = {}
+        for v in VARIABLES:
+            terms[v] = self.bounds(v)
+        for i, w in enumerate(VARIABLES):
+            for v in VARIABLES[i + 1:]:
+                terms['{} - {}'.format(v, w)] = self.difference(v, w)
+        return {term: [encode_number(lower), encode_number(upper)]
+                for term, (lower, upper) in terms.items()}
+
+    def __reduce__(self):
+        return Zone, (np.array(self.matrix),)
+
+
+class Bottom(Zone):
+    """The empty zone, a single shared instance."""
+
+    __slots__ = ()
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            instance = object.__new__(cls)
+            object.__setattr__(instance, 'matrix', None)
+            object.__setattr__(instance, '_key', None)
+            cls._instance = instance
+        return cls._instance
+
+    def __init__(self):
+        pass
+
+    def bounds(self, v):
+        return INF, -INF
+
+    def difference(self, v, w):
+        return INF, -INF
+
+    def join(self, other):
+        return other
+
+    def __le__(self, other):
+        return True
+
+    def __eq__(self, other):
+        return self is other
+
+    __hash__ = object.__hash__
+
+    def widen(self, other):
+        return other
+
+    def narrow(self, other):
+        return self
+
+    def contains(self, values):
+        return np.zeros(len(values), dtype=bool)
+
+    def constrain(self, v, lower=-INF, upper=INF):
+        return self
+
+    def shift(self, v, c):
+        return self
+
+    def __repr__(self):
+        return 'Bottom()'
+
+    def to_json(self):
+        return 'Bottom'
+
+    def __reduce__(self):
+        return Bottom, ()
+
+
+def format_bounds(term, lower, upper):
+    """
+    :type term: str
+    :type lower: float
+    :type upper: float
+    :rtype: list[str]
+    """
+    if lower == upper:
+        return ['{} = {}'.format(term, int(lower))]
+    constraints = []
+    if lower > -INF:
+        constraints.append('{} >= {}'.format(term, int(lower)))
+    if upper < INF:
+        constraints.append('{} <= {}'.format(term, int(upper)))
+    return constraints
+
+
+def zone(matrix):
+    """Zone of a closed matrix or bottom for None."""
+    return Bottom() if matrix is None else Zone(matrix)
+
+
+top = Zone.from_constraints()
+
+
+class ZoneAnalysis(Analysis):
+    bottom = Bottom()
+    initial = Zone.from_constraints([('y', None, 0), (None, 'y', 0),
+                                     ('z', None, 0), (None, 'z', 0)])
+    relational = True
+
+    @staticmethod
+    def abstract_state(x, y, z):
+        return Zone.from_constraints(
+            [c for v, n in zip(VARIABLES, (x, y, z))
+             for c in [(v, None, n), (None, v, -n)]])
+
+    @staticmethod
+    def plus_1(state, v):
+        return state.shift(v, 1)
+
+    @staticmethod
+    def minus_1(state, v):
+        # The machine fails when decrementing 0
+        return state.constrain(v, lower=1).shift(v, -1)
+
+    @staticmethod
+    def is_zero(state, v):
+        return state.constrain(v, 0, 0)
+
+    @staticmethod
+    def non_zero(state, v):
+        lower, upper = state.bounds(v)
+        if lower == 0:
+            return state.constrain(v, lower=1)
+        elif upper == 0:
+            return state.constrain(v, upper=-1)
+        else:
+            return state
+
+    @staticmethod
+    def widen(previous, next):
+        """
+        :type previous: dict[int, Zone]
+        :type next: dict[int, Zone]
+        :rtype: dict[int, Zone]
+        """
+        return {pc: zone.widen(next[pc]) for pc, zone in previous.items()}
+
+    @staticmethod
+    def narrow(previous, next):
+        """
+        :type previous: dict[int, Zone]
+        :type next: dict[int, Zone]
+        :rtype: dict[int, Zone]
+        """
+        return {pc: zone.narrow(next[pc]) for pc, zone in previous.items()}
+
+
+class ZoneTest(unittest.TestCase):
+    def test_closure(self):
+        z = Zone.from_constraints([('x', 'y', 1), ('y', None, 2)])
+        self.assertEqual((-INF, 3), z.bounds('x'))
+        self.assertIs(Bottom(), Zone.from_constraints([('x', None, 1),
+                                                       (None, 'x', -2)]))
+
+    def test_lattice(self):
+        a = Zone.from_constraints([('x', None, 1), (None, 'x', -1)])
+        b = Zone.from_constraints([('x', None, 3), (None, 'x', -3)])
+        self.assertEqual((1, 3), a.join(b).bounds('x'))
+        self.assertLessEqual(a, a.join(b))
+        self.assertFalse(a.join(b) <= a)
+        self.assertEqual((1, INF), a.widen(a.join(b)).bounds('x'))
+        self.assertEqual((1, 3), a.widen(a.join(b)).narrow(b).bounds('x'))
+        self.assertEqual(a, Zone.from_constraints([('x', None, 1),
+                                                   (None, 'x', -1)]))
+        self.assertEqual(1, len({a, a.shift('x', 0)}))
+        self.assertEqual([True, False], a.contains(np.array([[1, 5, -2],
+                                                             [2, 0, 0]]))
+                         .tolist())
+
+    def test_analysis(self):
+        from analyze import analyze
+
+        # y and z are incremented together while x counts down
+        result = analyze(parse('zero x 6 else 2\n'
+                               'dec x\n'
+                               'inc y\n'
+                               'inc z\n'
+                               'zero x 6 else 2\n'
+                               'stop\n'), ZoneAnalysis())
+        self.assertEqual((0, 0), result[6].bounds('x'))
+        self.assertEqual((0, 0), result[6].difference('y', 'z'))
+        self.assertEqual((1, 1), result[4].difference('y', 'z'))
+        self.assertEqual((0, INF), result[3].bounds('x'))
+
+    def test_unreachable(self):
+        from analyze import analyze
+
+        result = analyze(parse('dec y\n'
+                               'stop\n'), ZoneAnalysis())
+        self.assertIs(Bottom(), result[2])